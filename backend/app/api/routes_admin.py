@@ -0,0 +1,101 @@
+import asyncio
+import hmac
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import PlainTextResponse, Response
+
+from ..core.config import ADMIN_TOKEN
+from ..core.profiler import profiles
+from ..services.knowledge_bases import UnknownKnowledgeBaseError
+from ..services.rag_core import knowledge_bases
+
+
+def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    """/admin/*（與 /api/ingest）需要帶與 ADMIN_TOKEN 相同的 X-Admin-Token；未設定 ADMIN_TOKEN 時一律拒絕"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="未設定 ADMIN_TOKEN，管理端點已停用")
+    if not hmac.compare_digest(x_admin_token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="需要有效的 X-Admin-Token")
+
+
+router = APIRouter(prefix="/admin", tags=["admin"], dependencies=[Depends(require_admin)])
+
+
+@router.post("/profiler/arm")
+async def arm_profiler(path: str = "/", interval_ms: Optional[float] = None):
+    """
+    剖析下一個路徑以 path 開頭的 request（例如 /gemini_stream）
+
+    該 request 的 response header 會帶 X-Profile-Id；完成後以 GET /admin/profiler/{profile_id} 取得 flame graph
+    """
+    if interval_ms is not None and not 0.5 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms 需介於 0.5 ~ 1000")
+    session = profiles.arm(path, interval_ms)
+    return session.summary()
+
+
+@router.get("/profiler")
+async def list_profiles():
+    return profiles.list()
+
+
+@router.get("/profiler/{profile_id}")
+async def get_profile(profile_id: str, format: str = "svg"):
+    """format：svg（flame graph）/ collapsed（flamegraph.pl、speedscope 格式）/ json（摘要）"""
+    session = profiles.get(profile_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"找不到 profile: {profile_id}")
+    if format == "json":
+        return session.summary()
+    if not session.done:
+        raise HTTPException(status_code=409, detail="request 尚未完成剖析")
+    if format == "collapsed":
+        return PlainTextResponse(session.collapsed())
+    if format == "svg":
+        return Response(session.svg(), media_type="image/svg+xml")
+    raise HTTPException(status_code=400, detail=f"不支援的格式: {format}")
+
+
+# ---------- knowledge bases ----------
+@router.get("/kb")
+async def kb_status():
+    """各知識庫的常駐狀態、記憶體用量與 pinned 設定"""
+    return knowledge_bases.status()
+
+
+async def _load(name: str, reload: bool = False):
+    try:
+        await asyncio.to_thread(knowledge_bases.get, name, reload)
+    except UnknownKnowledgeBaseError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"知識庫載入失敗: {e}")
+
+
+@router.post("/kb/{name}/pin")
+async def pin_kb(name: str, pinned: bool = True):
+    """pinned 的知識庫不會因記憶體預算被卸載；pin 時尚未載入會一併載入"""
+    try:
+        kb = knowledge_bases.pin(name, pinned)
+    except UnknownKnowledgeBaseError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    if pinned:
+        await _load(name)
+    return kb.status()
+
+
+@router.post("/kb/{name}/load")
+async def load_kb(name: str, reload: bool = False):
+    """預先載入（reload=true 時重新建立索引）"""
+    await _load(name, reload)
+    return knowledge_bases.status()
+
+
+@router.post("/kb/{name}/evict")
+async def evict_kb(name: str):
+    try:
+        evicted = knowledge_bases.evict(name)
+    except UnknownKnowledgeBaseError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"name": name, "evicted": evicted}
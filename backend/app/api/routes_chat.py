@@ -1,15 +1,23 @@
-from typing import AsyncIterator, Tuple
+from typing import AsyncIterator, List, Optional, Tuple
 import os
 import asyncio
-from fastapi import APIRouter, Request, HTTPException
+from contextlib import aclosing
+from functools import partial
+from fastapi import APIRouter, Depends, Query, Request, HTTPException
 from fastapi.responses import StreamingResponse
 from google.genai.types import GenerateContentConfig
 
 from .schemas import ChatRequest
-from ..core.config import logger
+from ..core.config import (
+    logger, CHAT_SINGLE_FLIGHT, RAG_DEFAULT_KB, RAG_PREFETCH_DEBOUNCE_MS, RAG_PREFETCH_MATCH, RAG_PREFETCH_TTL,
+)
 from ..core.clients import gemini_client, openrouter_client, dms_client
-from ..services.rag_core import build_prompt, retrieve_context
-from ..utils.stream_utils import stream_content
+from ..core.tracing import span, traced_stream
+from ..services.metadata_filter import SearchFilters
+from ..services.prefetch import Prefetcher
+from ..services.rag_core import build_prompt, get_filter_values, get_index_version, knowledge_bases, retrieve_context
+from ..utils.single_flight import SingleFlight, flight_key
+from ..utils.stream_utils import cancel_on_disconnect, sse_events, upstream_texts
 
 SSE_HEADERS = {
     "Cache-Control": "no-cache, no-transform",
@@ -19,6 +27,20 @@ SSE_HEADERS = {
 
 router = APIRouter(prefix="", tags=["chat"])  # keep same paths as before
 
+# gemini_stream 的檢索參數；預取必須使用相同參數，結果才能直接沿用
+RAG_K = 5
+RAG_MAX_CHARS = 8000
+
+prefetcher = Prefetcher(
+    partial(retrieve_context, k=RAG_K, max_chars=RAG_MAX_CHARS),
+    debounce_ms=RAG_PREFETCH_DEBOUNCE_MS,
+    ttl=RAG_PREFETCH_TTL,
+    match_threshold=RAG_PREFETCH_MATCH,
+)
+
+# 相同的進行中請求（provider / model / prompt / 問題 / 參數 / 索引版本）只產生一個上游串流（SSE、/chat、WebSocket 共用）
+chat_flights = SingleFlight("chat", enabled=CHAT_SINGLE_FLIGHT)
+
 # ---------- helpers ----------
 def get_prompt_from_app(request: Request) -> str:
     # app.state.system_prompt is set in app/main.py at startup and can be reloaded
@@ -27,6 +49,173 @@ def get_prompt_from_app(request: Request) -> str:
 def is_rag_enabled(request: Request) -> bool:
     return bool(getattr(request.app.state, "RAG_ENABLED", False))
 
+def get_kb(kb: Optional[str] = Query(None, description="知識庫名稱（GET /api/knowledge_bases），省略時為預設知識庫")) -> Optional[str]:
+    if kb is not None and kb not in knowledge_bases.names():
+        raise HTTPException(status_code=404, detail=f"未知的知識庫: {kb}")
+    return kb
+
+def get_search_filters(
+    source: Optional[List[str]] = Query(None, description="來源檔名（可重複）"),
+    header: Optional[List[str]] = Query(None, description="章節路徑前綴，例如 `第 3 章 > 3.2`（可重複）"),
+    doc_type: Optional[List[str]] = Query(None, description="文件類型，例如 pdf（可重複）"),
+    ingested_from: Optional[str] = Query(None, description="匯入日期起（YYYY-MM-DD）"),
+    ingested_to: Optional[str] = Query(None, description="匯入日期迄（YYYY-MM-DD）"),
+) -> SearchFilters:
+    return SearchFilters(
+        source=source or [],
+        header_path=header or [],
+        doc_type=doc_type or [],
+        ingested_from=ingested_from,
+        ingested_to=ingested_to,
+    )
+
+
+# ---------- provider / retrieval steps (shared by SSE and WebSocket) ----------
+GEMINI_MODEL = "gemini-2.0-flash"
+OPENROUTER_MODEL = "qwen/qwen3-235b-a22b:free"
+DMS_MODEL = "openai/Qwen/Qwen3-Next-80B-A3B-Instruct"
+
+async def build_rag_contents(
+    system_prompt: str,
+    question: str,
+    filters: SearchFilters,
+    prefetch_id: Optional[str] = None,
+    kb: Optional[str] = None,
+) -> list:
+    """檢索並組成 RAG prompt；檢索失敗時退回原始問題"""
+    if not filters.is_empty():
+        logger.info(f"RAG 檢索範圍: {filters}")
+    try:
+        with span("rag.retrieve", k=RAG_K, filtered=not filters.is_empty()) as s:
+            prefetched = None
+            if prefetch_id:
+                prefetched = await prefetcher.take(
+                    prefetch_id, question, filters=filters, version=get_index_version(kb), kb=kb
+                )
+            if prefetched is not None:
+                ctx, sources = prefetched
+            else:
+                # 在執行緒中檢索：event loop 不被阻塞，client 斷線時可以立即放棄等待
+                # 知識庫尚未載入時也在執行緒中載入
+                ctx, sources = await asyncio.to_thread(
+                    retrieve_context, question, k=RAG_K, max_chars=RAG_MAX_CHARS, filters=filters, kb=kb
+                )
+            s.set(documents=len(sources), context_chars=len(ctx), prefetched=prefetched is not None)
+        with span("rag.build_prompt"):
+            sources_label = "\n".join([f"[S{i+1}] {src}" for i, src in enumerate(sources)])
+            rag_prompt = build_prompt(question, ctx, sources_label)
+        logger.info(f"✓ 使用 RAG，檢索到 {len(sources)} 個文件")
+        return [system_prompt, rag_prompt]
+    except Exception as e:
+        logger.warning(f"RAG 檢索失敗: {e}，使用原始問題")
+        return [system_prompt, question]
+
+async def connect_gemini(contents: list):
+    config = GenerateContentConfig(max_output_tokens=2000, temperature=0.7)
+    with span("llm.connect", provider="gemini", model=GEMINI_MODEL):
+        return await gemini_client.aio.models.generate_content_stream(
+            model=GEMINI_MODEL,
+            contents=contents,
+            config=config
+        )
+
+async def connect_openrouter(system_prompt: str, question: str):
+    with span("llm.connect", provider="openrouter", model=OPENROUTER_MODEL):
+        return await openrouter_client.chat.completions.create(
+            extra_headers={
+                "HTTP-Referer": os.getenv("REACT_APP_API_SERVER"),
+                "X-Title": "LLM Chatbot",
+            },
+            model=OPENROUTER_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": question},
+            ],
+            temperature=0.7,
+            max_tokens=2000,
+            stream=True,
+        )
+
+async def connect_dms(system_prompt: str, question: str):
+    with span("llm.connect", provider="dms", model=DMS_MODEL):
+        return await dms_client.chat.completions.create(
+            model=DMS_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": question},
+            ],
+            temperature=0.7,
+            max_tokens=8192,
+            presence_penalty=1.5,
+            stream=True,
+        )
+
+def gemini_rag_texts(
+    system_prompt: str,
+    question: str,
+    use_rag: bool,
+    filters: SearchFilters,
+    prefetch_id: Optional[str] = None,
+    kb: Optional[str] = None,
+    endpoint: str = "gemini_stream",
+) -> AsyncIterator[str]:
+    """Gemini（可 RAG）的文字串流；相同問題與檢索範圍的進行中請求共用同一次檢索與生成"""
+    # 不檢索時與 gemini_native 相同，共用同一個 flight
+    params = {}
+    if use_rag:
+        params = {"filters": filters.cache_key(), "kb": kb or RAG_DEFAULT_KB, "version": get_index_version(kb)}
+    key = flight_key("gemini", GEMINI_MODEL, system_prompt, question, **params)
+
+    async def produce() -> AsyncIterator[str]:
+        contents = [system_prompt, question]
+        if use_rag:
+            contents = await build_rag_contents(system_prompt, question, filters, prefetch_id, kb)
+        async for text in upstream_texts(partial(connect_gemini, contents), "gemini"):
+            yield text
+
+    return chat_flights.stream(key, produce, endpoint)
+
+def plain_texts(provider: str, model: str, system_prompt: str, question: str, connect, endpoint: str) -> AsyncIterator[str]:
+    """不檢索的 provider 串流（經 single-flight）；connect() 建立上游串流"""
+    key = flight_key(provider, model, system_prompt, question)
+    return chat_flights.stream(key, partial(upstream_texts, connect, provider), endpoint)
+
+
+# ---------- 0) Knowledge bases & RAG filter options ----------
+@router.get("/api/knowledge_bases")
+async def list_knowledge_bases():
+    """可查詢的知識庫（resident 表示目前已載入記憶體，查詢時不需等待載入）"""
+    kbs = knowledge_bases.status()["knowledge_bases"]
+    return [{"name": kb["name"], "resident": kb["resident"]} for kb in kbs]
+
+
+@router.get("/api/rag_filters")
+async def rag_filters(kb: Optional[str] = Depends(get_kb)):
+    """各篩選欄位可用的值（source / header_path / doc_type / ingested_at）"""
+    return await asyncio.to_thread(get_filter_values, kb)
+
+
+# ---------- 0b) Retrieval prefetch ----------
+@router.post("/prefetch", status_code=202)
+async def prefetch(
+    prefetch_id: str,
+    question: str,
+    request: Request,
+    filters: SearchFilters = Depends(get_search_filters),
+    kb: Optional[str] = Depends(get_kb),
+):
+    """
+    使用者輸入中的問題：debounce 後預先檢索並暖快取
+
+    送出時在 /gemini_stream 帶相同的 prefetch_id，問題相近即沿用預取的 context。
+    """
+    if not is_rag_enabled(request):
+        return {"status": "disabled"}
+    if not prefetch_id or len(prefetch_id) > 128:
+        raise HTTPException(status_code=400, detail="prefetch_id 長度需介於 1 ~ 128")
+    status = prefetcher.submit(prefetch_id, question, filters=filters, version=get_index_version(kb), kb=kb)
+    return {"status": status}
+
 
 # ---------- 1) Gemini native stream (no RAG) ----------
 @router.get("/gemini_native_stream")
@@ -41,16 +230,12 @@ async def gemini_native_stream(question: str, request: Request) -> StreamingResp
         
         try:
             logger.info(f"Gemini 原生問題: {question}")
-            config = GenerateContentConfig(max_output_tokens=2000, temperature=0.7)
-            contents = [get_prompt_from_app(request), question]
-
-            response_stream = await gemini_client.aio.models.generate_content_stream(
-                model="gemini-2.0-flash",
-                contents=contents,
-                config=config
+            system_prompt = get_prompt_from_app(request)
+            texts = plain_texts(
+                "gemini", GEMINI_MODEL, system_prompt, question,
+                partial(connect_gemini, [system_prompt, question]), "gemini_native_stream",
             )
-
-            async for line in stream_content(response_stream, "gemini"):
+            async for line in traced_stream(sse_events(texts), provider="gemini"):
                 yield line
 
         except Exception as e:
@@ -58,7 +243,7 @@ async def gemini_native_stream(question: str, request: Request) -> StreamingResp
             yield f"data: [錯誤] {str(e)}\n\n"
 
     return StreamingResponse(
-        event_generator(),
+        cancel_on_disconnect(request, event_generator(), "gemini_native_stream"),
         media_type="text/event-stream",
         headers=SSE_HEADERS
     )
@@ -66,7 +251,14 @@ async def gemini_native_stream(question: str, request: Request) -> StreamingResp
 
 # ---------- 2) Gemini stream (optional RAG) ----------
 @router.get("/gemini_stream")
-async def gemini_stream(question: str, request: Request, use_rag: bool = True) -> StreamingResponse:
+async def gemini_stream(
+    question: str,
+    request: Request,
+    use_rag: bool = True,
+    filters: SearchFilters = Depends(get_search_filters),
+    prefetch_id: Optional[str] = None,
+    kb: Optional[str] = Depends(get_kb),
+) -> StreamingResponse:
     async def event_generator() -> AsyncIterator[str]:
         if not gemini_client:
             yield "data: [錯誤] Gemini 服務未初始化\n\n"
@@ -79,26 +271,8 @@ async def gemini_stream(question: str, request: Request, use_rag: bool = True) -
             use_rag_now = use_rag and is_rag_enabled(request)
             logger.info(f"Gemini 問題 (RAG={use_rag_now}): {question}")
 
-            contents = [get_prompt_from_app(request), question]
-
-            if use_rag_now:
-                try:
-                    ctx, sources = retrieve_context(question, k=5, max_chars=8000)
-                    sources_label = "\n".join([f"[S{i+1}] {src}" for i, src in enumerate(sources)])
-                    rag_prompt = build_prompt(question, ctx, sources_label)
-                    contents = [get_prompt_from_app(request), rag_prompt]
-                    logger.info(f"✓ 使用 RAG，檢索到 {len(sources)} 個文件")
-                except Exception as e:
-                    logger.warning(f"RAG 檢索失敗: {e}，使用原始問題")
-
-            config = GenerateContentConfig(max_output_tokens=2000, temperature=0.7)
-            response_stream = await gemini_client.aio.models.generate_content_stream(
-                model="gemini-2.0-flash",
-                contents=contents,
-                config=config
-            )
-
-            async for line in stream_content(response_stream, "gemini"):
+            texts = gemini_rag_texts(get_prompt_from_app(request), question, use_rag_now, filters, prefetch_id, kb)
+            async for line in traced_stream(sse_events(texts), provider="gemini"):
                 yield line
 
         except Exception as e:
@@ -106,7 +280,7 @@ async def gemini_stream(question: str, request: Request, use_rag: bool = True) -
             yield f"data: [錯誤] {str(e)}\n\n"
 
     return StreamingResponse(
-        event_generator(),
+        cancel_on_disconnect(request, event_generator(), "gemini_stream"),
         media_type="text/event-stream",
         headers=SSE_HEADERS
     )
@@ -125,22 +299,12 @@ async def openrouter_stream(question: str, request: Request) -> StreamingRespons
 
         try:
             logger.info(f"OpenRouter 問題: {question}")
-            response = await openrouter_client.chat.completions.create(
-                extra_headers={
-                    "HTTP-Referer": os.getenv("REACT_APP_API_SERVER"),
-                    "X-Title": "LLM Chatbot",
-                },
-                model="qwen/qwen3-235b-a22b:free",
-                messages=[
-                    {"role": "system", "content": get_prompt_from_app(request)},
-                    {"role": "user", "content": question},
-                ],
-                temperature=0.7,
-                max_tokens=2000,
-                stream=True,
+            system_prompt = get_prompt_from_app(request)
+            texts = plain_texts(
+                "openrouter", OPENROUTER_MODEL, system_prompt, question,
+                partial(connect_openrouter, system_prompt, question), "openrouter_stream",
             )
-
-            async for line in stream_content(response, "openrouter"):
+            async for line in traced_stream(sse_events(texts), provider="openrouter"):
                 yield line
 
         except Exception as e:
@@ -148,7 +312,7 @@ async def openrouter_stream(question: str, request: Request) -> StreamingRespons
             yield f"data: [錯誤] {str(e)}\n\n"
 
     return StreamingResponse(
-        event_generator(),
+        cancel_on_disconnect(request, event_generator(), "openrouter_stream"),
         media_type="text/event-stream",
         headers=SSE_HEADERS
     )
@@ -167,19 +331,12 @@ async def dms_stream(question: str, request: Request) -> StreamingResponse:
 
         try:
             logger.info(f"DMS 問題: {question}")
-            response = await dms_client.chat.completions.create(
-                model="openai/Qwen/Qwen3-Next-80B-A3B-Instruct",
-                messages=[
-                    {"role": "system", "content": get_prompt_from_app(request)},
-                    {"role": "user", "content": question},
-                ],
-                temperature=0.7,
-                max_tokens=8192,
-                presence_penalty=1.5,
-                stream=True,
+            system_prompt = get_prompt_from_app(request)
+            texts = plain_texts(
+                "dms", DMS_MODEL, system_prompt, question,
+                partial(connect_dms, system_prompt, question), "dms_stream",
             )
-
-            async for line in stream_content(response, "dms"):
+            async for line in traced_stream(sse_events(texts), provider="dms"):
                 yield line
 
         except Exception as e:
@@ -187,7 +344,7 @@ async def dms_stream(question: str, request: Request) -> StreamingResponse:
             yield f"data: [錯誤] {str(e)}\n\n"
 
     return StreamingResponse(
-        event_generator(),
+        cancel_on_disconnect(request, event_generator(), "dms_stream"),
         media_type="text/event-stream",
         headers=SSE_HEADERS
     )
@@ -195,86 +352,70 @@ async def dms_stream(question: str, request: Request) -> StreamingResponse:
 
 # ---------- 5) Unified POST /chat ----------
 @router.post("/chat")
-async def chat(request_body: ChatRequest, request: Request) -> StreamingResponse:
+async def chat(
+    request_body: ChatRequest,
+    request: Request,
+    filters: SearchFilters = Depends(get_search_filters),
+) -> StreamingResponse:
+    # /chat 直接轉送給 provider、不檢索知識庫；帶檢索範圍時明確拒絕，而不是靜默忽略
+    if not filters.is_empty():
+        raise HTTPException(status_code=400, detail="/chat 不檢索知識庫，不支援檢索範圍篩選；請使用 /gemini_stream")
     provider = request_body.provider.lower()
-
-    if provider == "gemini":
-        async def generate_gemini():
-            if not gemini_client:
-                yield "錯誤: Gemini 未初始化".encode("utf-8")
-                return
-            try:
-                config = GenerateContentConfig(
-                    max_output_tokens=request_body.max_tokens,
-                    temperature=request_body.temperature,
-                )
-                contents = [get_prompt_from_app(request), request_body.message]
-                response_stream = await gemini_client.aio.models.generate_content_stream(
-                    model=request_body.model,
-                    contents=contents,
-                    config=config,
-                )
-                async for chunk in response_stream:
-                    if getattr(chunk, "text", None):
-                        yield chunk.text.encode("utf-8")
-            except Exception as e:
-                yield f"錯誤: {str(e)}".encode("utf-8")
-
-        return StreamingResponse(generate_gemini(), media_type="text/plain")
-
-    elif provider == "openrouter":
-        async def generate_openrouter():
-            if not openrouter_client:
-                yield "錯誤: OpenRouter 未初始化".encode("utf-8")
-                return
-            try:
-                response = await openrouter_client.chat.completions.create(
-                    extra_headers={
-                        "HTTP-Referer": os.getenv("REACT_APP_API_SERVER"),
-                        "X-Title": "LLM Chatbot",
-                    },
-                    model=request_body.model,
-                    messages=[
-                        {"role": "system", "content": get_prompt_from_app(request)},
-                        {"role": "user", "content": request_body.message},
-                    ],
-                    temperature=request_body.temperature,
-                    max_tokens=request_body.max_tokens,
-                    stream=True,
-                )
-                async for chunk in response:
-                    delta = getattr(chunk.choices[0].delta, "content", None)
-                    if delta:
-                        yield delta.encode("utf-8")
-            except Exception as e:
-                yield f"錯誤: {str(e)}".encode("utf-8")
-
-        return StreamingResponse(generate_openrouter(), media_type="text/plain")
-
-    elif provider == "dms":
-        async def generate_dms():
-            if not dms_client:
-                yield "錯誤: DMS 未初始化".encode("utf-8")
-                return
-            try:
-                response = await dms_client.chat.completions.create(
-                    model=request_body.model,
-                    messages=[
-                        {"role": "system", "content": get_prompt_from_app(request)},
-                        {"role": "user", "content": request_body.message},
-                    ],
-                    temperature=request_body.temperature,
-                    max_tokens=request_body.max_tokens,
-                    stream=True,
+    clients = {"gemini": gemini_client, "openrouter": openrouter_client, "dms": dms_client}
+    if provider not in clients:
+        raise HTTPException(status_code=400, detail=f"不支援的提供者: {provider}")
+    names = {"gemini": "Gemini", "openrouter": "OpenRouter", "dms": "DMS"}
+    system_prompt = get_prompt_from_app(request)
+    message, model = request_body.message, request_body.model
+
+    async def connect():
+        with span("llm.connect", provider=provider, model=model):
+            if provider == "gemini":
+                return await gemini_client.aio.models.generate_content_stream(
+                    model=model,
+                    contents=[system_prompt, message],
+                    config=GenerateContentConfig(
+                        max_output_tokens=request_body.max_tokens,
+                        temperature=request_body.temperature,
+                    ),
                 )
-                async for chunk in response:
-                    delta = getattr(chunk.choices[0].delta, "content", None)
-                    if delta:
-                        yield delta.encode("utf-8")
-            except Exception as e:
-                yield f"錯誤: {str(e)}".encode("utf-8")
+            extra = {}
+            if provider == "openrouter":
+                extra["extra_headers"] = {
+                    "HTTP-Referer": os.getenv("REACT_APP_API_SERVER"),
+                    "X-Title": "LLM Chatbot",
+                }
+            return await clients[provider].chat.completions.create(
+                **extra,
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": message},
+                ],
+                temperature=request_body.temperature,
+                max_tokens=request_body.max_tokens,
+                stream=True,
+            )
 
-        return StreamingResponse(generate_dms(), media_type="text/plain")
+    async def generate():
+        if not clients[provider]:
+            yield f"錯誤: {names[provider]} 未初始化".encode("utf-8")
+            return
+        try:
+            # /chat 只輸出 content（DMS 的 reasoning_content 不輸出），與 OpenAI 相容的 extractor 相同
+            key = flight_key(
+                provider, model, system_prompt, message,
+                temperature=request_body.temperature, max_tokens=request_body.max_tokens,
+            )
+            extractor = "gemini" if provider == "gemini" else "openai"
+            texts = chat_flights.stream(key, partial(upstream_texts, connect, extractor), f"chat:{provider}")
+            with span("llm.stream", provider=provider):
+                async with aclosing(texts) as texts:
+                    async for text in texts:
+                        yield text.encode("utf-8")
+        except Exception as e:
+            yield f"錯誤: {str(e)}".encode("utf-8")
 
-    else:
-        raise HTTPException(status_code=400, detail=f"不支援的提供者: {provider}")
+    return StreamingResponse(
+        cancel_on_disconnect(request, generate(), f"chat:{provider}"), media_type="text/plain"
+    )
@@ -1,12 +1,17 @@
 from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from ..core.clients import gemini_client, openrouter_client, dms_client
 from ..core.config import get_custom_system_prompt
+from ..core.metrics import registry
+from ..services.readiness import readiness
 
 router = APIRouter(prefix="", tags=["health"])
 
 
 @router.get("/health")
+@router.get("/health/live")
 async def health_check():
+    """liveness：行程與 event loop 還在回應（不代表可以接流量，見 /health/ready）"""
     return {
         "status": "ok",
         "providers": {
@@ -17,6 +22,16 @@ async def health_check():
     }
 
 
+@router.get("/health/ready")
+async def readiness_check(request: Request):
+    """
+    readiness：暖機完成、預設知識庫已載入、embedding 服務連得到、至少一個 LLM 提供者連線已建立；
+    未就緒時回傳 503 與原因（load balancer 以此決定是否導流量）
+    """
+    status = await readiness.check(bool(getattr(request.app.state, "RAG_ENABLED", False)))
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
 @router.post("/reload_prompt")
 async def reload_prompt(request: Request):
     """
@@ -26,3 +41,13 @@ async def reload_prompt(request: Request):
     new_prompt = get_custom_system_prompt()
     request.app.state.system_prompt = new_prompt
     return {"status": "已重新載入", "new_prompt": new_prompt}
+
+
+@router.get("/metrics")
+async def metrics(format: str = "prometheus"):
+    """
+    行程內的統計值（檢索快取命中率等）；預設 Prometheus text format，?format=json 回傳 JSON
+    """
+    if format == "json":
+        return registry.snapshot()
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
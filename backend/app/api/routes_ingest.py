@@ -0,0 +1,115 @@
+"""
+Document ingestion: /api/ingest
+
+    POST /api/ingest?filename=manual.pdf&kb=plc   request body 為檔案內容（application/octet-stream），回傳 202 + 工作
+    GET  /api/ingest                              最近的工作
+    GET  /api/ingest/{job_id}                     工作狀態（status / stage / done / total / error）
+    GET  /api/ingest/{job_id}/events              SSE：每次狀態或進度改變送出一個 data: <工作 JSON>，結束時 [DONE]
+    POST /api/ingest/{job_id}/retry               失敗的工作從最後的 checkpoint 重新執行
+
+所有端點都需要 X-Admin-Token（同 /admin；工作記錄含上傳的檔名與知識庫），未設定 ADMIN_TOKEN 時一律回傳 403；
+處理流程見 services/ingestion.py。
+"""
+import asyncio
+import json
+import uuid
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+
+from ..core.config import INGEST_MAX_MB, INGEST_PROGRESS_MS, KB_DOCUMENT_SUFFIXES, RAG_DEFAULT_KB, logger
+from ..services.ingestion import ingestion
+from ..utils.stream_utils import cancel_on_disconnect
+from .routes_admin import require_admin
+from .routes_chat import SSE_HEADERS, get_kb
+
+router = APIRouter(prefix="/api/ingest", tags=["ingest"])
+
+FINISHED = ("done", "failed")
+
+
+def require_ingestion() -> None:
+    if not ingestion.running:
+        raise HTTPException(status_code=503, detail="匯入服務未啟動，無法匯入文件")
+
+
+def get_job(job_id: str) -> dict:
+    job = ingestion.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"找不到匯入工作: {job_id}")
+    return job
+
+
+@router.post("", status_code=202, dependencies=[Depends(require_admin), Depends(require_ingestion)])
+async def ingest(
+    request: Request,
+    filename: str = Query(..., min_length=1, max_length=255, description="原始檔名（副檔名決定轉換方式，也是 source 篩選值）"),
+    kb: Optional[str] = Depends(get_kb),
+):
+    name = Path(filename).name
+    if Path(name).suffix.lower() not in KB_DOCUMENT_SUFFIXES:
+        raise HTTPException(status_code=400, detail=f"支援的文件類型: {', '.join(KB_DOCUMENT_SUFFIXES)}")
+    job_id = uuid.uuid4().hex
+    path = ingestion.upload_path(job_id, name)
+    limit = INGEST_MAX_MB << 20
+    size = 0
+    try:
+        # 邊收邊寫入磁碟，不把整個檔案留在記憶體
+        with open(path, "wb") as f:
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > limit:
+                    raise HTTPException(status_code=413, detail=f"檔案超過 {INGEST_MAX_MB} MB")
+                await asyncio.to_thread(f.write, chunk)
+        if size == 0:
+            raise HTTPException(status_code=400, detail="request body 為空（需為檔案內容）")
+    except BaseException:
+        ingestion.discard(job_id)
+        raise
+    job = await asyncio.to_thread(ingestion.submit, job_id, kb or RAG_DEFAULT_KB, name, path)
+    logger.info(f"匯入工作 {job_id} 已排入佇列：{name}（{size} bytes）→ {job['kb']}")
+    return job
+
+
+@router.get("", dependencies=[Depends(require_admin), Depends(require_ingestion)])
+async def list_jobs(limit: int = Query(50, ge=1, le=500), kb: Optional[str] = None):
+    return await asyncio.to_thread(ingestion.store.list, limit, kb)
+
+
+@router.get("/{job_id}", dependencies=[Depends(require_admin), Depends(require_ingestion)])
+async def job_status(job_id: str):
+    return await asyncio.to_thread(get_job, job_id)
+
+
+@router.get("/{job_id}/events", dependencies=[Depends(require_admin), Depends(require_ingestion)])
+async def job_events(job_id: str, request: Request) -> StreamingResponse:
+    job = await asyncio.to_thread(get_job, job_id)
+
+    async def event_generator() -> AsyncIterator[str]:
+        nonlocal job
+        last = None
+        while True:
+            if job != last:
+                yield f"data: {json.dumps(job, ensure_ascii=False)}\n\n"
+                last = job
+            if job["status"] in FINISHED:
+                break
+            await asyncio.sleep(INGEST_PROGRESS_MS / 1000)
+            job = await asyncio.to_thread(ingestion.store.get, job_id)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(
+        cancel_on_disconnect(request, event_generator(), "ingest_events"),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+
+@router.post("/{job_id}/retry", status_code=202, dependencies=[Depends(require_admin), Depends(require_ingestion)])
+async def retry_job(job_id: str):
+    job = await asyncio.to_thread(get_job, job_id)
+    if not await asyncio.to_thread(ingestion.retry, job_id):
+        raise HTTPException(status_code=409, detail=f"只有失敗的工作可以重試（目前為 {job['status']}）")
+    return await asyncio.to_thread(get_job, job_id)
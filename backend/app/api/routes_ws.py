@@ -0,0 +1,254 @@
+"""
+Multiplexed chat over one WebSocket: /ws/chat
+
+一條連線同時承載多個 chat stream，每個 stream 以 client 指定的 id 區分。所有訊息都是 JSON 陣列：
+
+client → server（一個訊息一個指令）
+    ["start",  id, {"provider": "gemini", "q": "...", "rag": true, "kb": "...", "filters": {...}, "prefetch_id": "...", "window": 65536}]
+    ["cancel", id]
+    ["credit", id, n]          # 已消化 n 個字元，允許 server 再送 n 個字元
+
+server → client（一個訊息是一批事件，WS_FLUSH_MS 內產生的事件合併送出，同一 stream 連續的 token 合併成一段）
+    [["d", id, "text"], ["d", id2, "text"], ["e", id], ["x", id3, "錯誤訊息"]]
+    d = 文字、e = 結束（第三欄為 "cancelled" 表示已取消）、x = 錯誤
+
+provider：gemini（可 RAG，同 /gemini_stream）/ gemini_native / openrouter / dms，沿用 routes_chat 的連線與檢索流程，
+也與 SSE / /chat 共用 single-flight（相同的進行中請求只產生一個上游串流）。
+flow control：每個 stream 有字元額度（start 的 window，預設 WS_STREAM_WINDOW），用完就暫停讀取上游，
+直到 client 回 credit；慢的 stream 不會拖住其他 stream，也不會在 server 端無限堆積。
+"""
+import asyncio
+import json
+from contextlib import aclosing
+from functools import partial
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+
+from ..core.clients import dms_client, gemini_client, openrouter_client
+from ..core.config import WS_FLUSH_MS, WS_MAX_STREAMS, WS_STREAM_WINDOW, logger
+from ..core.metrics import registry
+from ..core.tracing import trace_root
+from ..services.rag_core import knowledge_bases
+from .routes_chat import (
+    DMS_MODEL,
+    GEMINI_MODEL,
+    OPENROUTER_MODEL,
+    connect_dms,
+    connect_gemini,
+    connect_openrouter,
+    gemini_rag_texts,
+    get_prompt_from_app,
+    get_search_filters,
+    is_rag_enabled,
+    plain_texts,
+)
+
+router = APIRouter(tags=["chat"])
+
+_connections = registry.gauge("ws_connections_active", "Open chat WebSocket connections")
+_streams = registry.counter("ws_streams_total", "Chat streams over WebSocket by provider and outcome")
+_messages = registry.counter("ws_messages_sent_total", "WebSocket messages sent (each carries a batch of events)")
+_events = registry.counter("ws_events_sent_total", "Stream events sent over WebSocket, after merging")
+_bytes = registry.counter("ws_bytes_sent_total", "WebSocket payload bytes sent")
+
+PROVIDERS = ("gemini", "gemini_native", "openrouter", "dms")
+MAX_ID_LENGTH = 64
+
+
+def _as_list(value: Any) -> Optional[List[str]]:
+    if value is None:
+        return None
+    return [str(v) for v in value] if isinstance(value, list) else [str(value)]
+
+
+class _Stream:
+    def __init__(self, stream_id: str, window: int):
+        self.id = stream_id
+        self.credit = window
+        self.resumed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def grant(self, n: int) -> None:
+        self.credit += n
+        if self.credit > 0:
+            self.resumed.set()
+
+    async def spend(self, n: int) -> None:
+        while self.credit <= 0:
+            self.resumed.clear()
+            await self.resumed.wait()
+        self.credit -= n
+
+
+class _Connection:
+    def __init__(self, websocket: WebSocket):
+        self.ws = websocket
+        self.streams: Dict[str, _Stream] = {}
+        self._pending: List[list] = []
+        self._ready = asyncio.Event()
+        self._closed = False
+
+    # ---------- outgoing ----------
+    def emit(self, event: list) -> None:
+        pending = self._pending
+        # 同一個 stream 連續的文字合併成一個事件
+        if event[0] == "d" and pending and pending[-1][0] == "d" and pending[-1][1] == event[1]:
+            pending[-1][2] += event[2]
+        else:
+            pending.append(event)
+        self._ready.set()
+
+    async def writer(self) -> None:
+        while True:
+            await self._ready.wait()
+            await asyncio.sleep(WS_FLUSH_MS / 1000)  # 收集這段時間內所有 stream 的事件
+            batch, self._pending = self._pending, []
+            self._ready.clear()
+            if not batch:
+                continue
+            payload = json.dumps(batch, ensure_ascii=False, separators=(",", ":"))
+            try:
+                await self.ws.send_text(payload)
+            except Exception:
+                return  # 連線已關閉；由 receive 迴圈收尾
+            _messages.inc()
+            _events.inc(len(batch))
+            _bytes.inc(len(payload.encode("utf-8")))
+
+    # ---------- incoming ----------
+    def handle(self, message: Any) -> None:
+        if not isinstance(message, list) or len(message) < 2 or not isinstance(message[1], str):
+            self.emit(["x", None, "訊息格式需為 [type, id, ...]"])
+            return
+        kind, stream_id = message[0], message[1]
+        if kind == "start":
+            self.start(stream_id, message[2] if len(message) > 2 and isinstance(message[2], dict) else {})
+        elif kind == "cancel":
+            stream = self.streams.get(stream_id)
+            if stream is not None and stream.task is not None:
+                stream.task.cancel()
+        elif kind == "credit":
+            stream = self.streams.get(stream_id)
+            if stream is not None and len(message) > 2 and isinstance(message[2], int) and message[2] > 0:
+                stream.grant(message[2])
+        else:
+            self.emit(["x", stream_id, f"不支援的訊息類型: {kind}"])
+
+    def start(self, stream_id: str, options: Dict[str, Any]) -> None:
+        if not stream_id or len(stream_id) > MAX_ID_LENGTH:
+            self.emit(["x", stream_id, f"stream id 長度需介於 1 ~ {MAX_ID_LENGTH}"])
+            return
+        if stream_id in self.streams:
+            self.emit(["x", stream_id, "stream id 已在使用中"])
+            return
+        if len(self.streams) >= WS_MAX_STREAMS:
+            self.emit(["x", stream_id, f"同時進行的 stream 上限為 {WS_MAX_STREAMS}"])
+            return
+        provider = options.get("provider", "gemini")
+        question = options.get("q")
+        if provider not in PROVIDERS or not isinstance(question, str) or not question.strip():
+            self.emit(["x", stream_id, "需要 provider（gemini / gemini_native / openrouter / dms）與 q"])
+            return
+        kb = options.get("kb")
+        if kb is not None and kb not in knowledge_bases.names():
+            self.emit(["x", stream_id, f"未知的知識庫: {kb}"])
+            return
+        window = options.get("window")
+        stream = _Stream(stream_id, window if isinstance(window, int) and window > 0 else WS_STREAM_WINDOW)
+        self.streams[stream_id] = stream
+        stream.task = asyncio.create_task(self.run(stream, provider, question, options))
+
+    # ---------- one chat stream ----------
+    def upstream(self, provider: str, question: str, options: Dict[str, Any]) -> AsyncIterator[str]:
+        system_prompt = get_prompt_from_app(self.ws)
+        endpoint = f"ws:{provider}"
+        if provider in ("gemini", "gemini_native"):
+            if not gemini_client:
+                raise RuntimeError("Gemini 服務未初始化")
+            if provider == "gemini" and options.get("rag", True) and is_rag_enabled(self.ws):
+                f = options.get("filters") or {}
+                filters = get_search_filters(
+                    source=_as_list(f.get("source")),
+                    header=_as_list(f.get("header")),
+                    doc_type=_as_list(f.get("doc_type")),
+                    ingested_from=f.get("ingested_from"),
+                    ingested_to=f.get("ingested_to"),
+                )
+                return gemini_rag_texts(
+                    system_prompt, question, True, filters, options.get("prefetch_id"), options.get("kb"), endpoint
+                )
+            return plain_texts(
+                "gemini", GEMINI_MODEL, system_prompt, question,
+                partial(connect_gemini, [system_prompt, question]), endpoint,
+            )
+        if provider == "openrouter":
+            if not openrouter_client:
+                raise RuntimeError("OpenRouter 服務未初始化")
+            return plain_texts(
+                "openrouter", OPENROUTER_MODEL, system_prompt, question,
+                partial(connect_openrouter, system_prompt, question), endpoint,
+            )
+        if not dms_client:
+            raise RuntimeError("DMS 服務未初始化")
+        return plain_texts(
+            "dms", DMS_MODEL, system_prompt, question, partial(connect_dms, system_prompt, question), endpoint,
+        )
+
+    async def run(self, stream: _Stream, provider: str, question: str, options: Dict[str, Any]) -> None:
+        outcome = "completed"
+        try:
+            with trace_root("WS /ws/chat", provider=provider, stream_id=stream.id) as root:
+                logger.info(f"WebSocket stream {stream.id} ({provider}): {question}")
+                chars = 0
+                async with aclosing(self.upstream(provider, question, options)) as texts:
+                    async for text in texts:
+                        # 額度用完時在這裡等待；上游由 single-flight 繼續接收，這個 stream 之後從進度處接上
+                        await stream.spend(len(text))
+                        self.emit(["d", stream.id, text])
+                        chars += len(text)
+                root.set(chars=chars)
+            self.emit(["e", stream.id])
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            if not self._closed:
+                self.emit(["e", stream.id, "cancelled"])
+            raise
+        except Exception as e:
+            outcome = "error"
+            logger.error(f"WebSocket stream {stream.id} 錯誤: {e}")
+            self.emit(["x", stream.id, str(e)])
+        finally:
+            self.streams.pop(stream.id, None)
+            _streams.inc(provider=provider, outcome=outcome)
+
+    async def close(self) -> None:
+        self._closed = True
+        tasks = [s.task for s in self.streams.values() if s.task is not None]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+@router.websocket("/ws/chat")
+async def ws_chat(websocket: WebSocket):
+    await websocket.accept()
+    conn = _Connection(websocket)
+    writer = asyncio.create_task(conn.writer())
+    _connections.inc()
+    try:
+        while True:
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+            except ValueError:
+                conn.emit(["x", None, "訊息需為 JSON"])
+                continue
+            conn.handle(message)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        _connections.dec()
+        await conn.close()   # client 離線：取消所有進行中的 stream（連帶關閉上游連線）
+        writer.cancel()
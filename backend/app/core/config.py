@@ -16,3 +16,87 @@ def get_custom_system_prompt() -> str:
     parts = [v for k, v in sorted(os.environ.items()) if k.startswith("CUSTOM_PROMPT_")]
     return " ".join(p.strip() for p in parts if p) or \
         "You are a helpful AI assistant that replies in Markdown."
+
+# ---- RAG settings ----
+RAG_SOURCE_PDF = os.getenv("RAG_SOURCE_PDF", "D:/Build_RAG_Locally/DIADesigner-ST-CODE.pdf")
+RAG_DEFAULT_KB = os.getenv("RAG_DEFAULT_KB", "default")           # 未指定 kb 的查詢使用的知識庫
+RAG_KB_DIR = os.getenv("RAG_KB_DIR", "")                           # 目錄下每個文件各為一個知識庫（名稱 = 檔名主檔名）
+RAG_KB_PINNED = [n.strip() for n in os.getenv("RAG_KB_PINNED", "").split(",") if n.strip()]
+RAG_KB_MEMORY_MB = int(os.getenv("RAG_KB_MEMORY_MB", "4096"))     # 所有知識庫常駐記憶體的總預算
+KB_DOCUMENT_SUFFIXES = (".pdf", ".docx", ".pptx", ".xlsx", ".html", ".md")
+
+def get_knowledge_bases() -> dict:
+    """
+    知識庫名稱 → 來源文件
+
+    RAG_KNOWLEDGE_BASES="plc=D:/docs/plc.pdf;drives=D:/docs/drives.pdf" 明確指定，
+    再加上 RAG_KB_DIR 目錄下的文件；預設知識庫未指定時對應 RAG_SOURCE_PDF。
+    """
+    kbs = {}
+    if RAG_KB_DIR and os.path.isdir(RAG_KB_DIR):
+        for entry in sorted(os.listdir(RAG_KB_DIR)):
+            stem, suffix = os.path.splitext(entry)
+            if suffix.lower() in KB_DOCUMENT_SUFFIXES:
+                kbs[stem] = os.path.join(RAG_KB_DIR, entry)
+    for item in os.getenv("RAG_KNOWLEDGE_BASES", "").split(";"):
+        name, sep, path = item.partition("=")
+        if sep and name.strip() and path.strip():
+            kbs[name.strip()] = path.strip()
+    kbs.setdefault(RAG_DEFAULT_KB, RAG_SOURCE_PDF)
+    return kbs
+
+DOCLING_CACHE_DIR = os.getenv("DOCLING_CACHE_DIR", "cache/docling")    # docling 轉換結果快取（依來源雜湊 + docling 版本 / 選項）
+DOCLING_PAGE_BATCH = int(os.getenv("DOCLING_PAGE_BATCH", "0"))         # >0 時 PDF 每幾頁轉換並快取一次；0 整份轉換
+RAG_EMBED_MODEL = os.getenv("RAG_EMBED_MODEL", "nomic-embed-text")
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+RAG_CHUNK_MAX_TOKENS = int(os.getenv("RAG_CHUNK_MAX_TOKENS", "512"))
+RAG_CHUNK_OVERLAP_TOKENS = int(os.getenv("RAG_CHUNK_OVERLAP_TOKENS", "64"))
+RAG_DEDUP_THRESHOLD = float(os.getenv("RAG_DEDUP_THRESHOLD", "0.85"))  # >= 1.0 關閉近似重複移除
+RAG_VECTOR_STORAGE = os.getenv("RAG_VECTOR_STORAGE", "flat").lower()   # flat | fp16 | sq8 | pq
+RAG_PQ_M = int(os.getenv("RAG_PQ_M", "64"))   # PQ 子向量數（每個向量 M bytes）
+RAG_PQ_NBITS = int(os.getenv("RAG_PQ_NBITS", "8"))
+RAG_RERANK_CANDIDATES = int(os.getenv("RAG_RERANK_CANDIDATES", "100"))  # 0 關閉原始向量精確重排
+RAG_SHARDS = int(os.getenv("RAG_SHARDS", "0"))                 # >1 時向量分散到多個 worker 行程平行搜尋
+RAG_SHARD_THREADS = int(os.getenv("RAG_SHARD_THREADS", "1"))   # 每個 shard 行程的 faiss 執行緒數
+RAG_EMBED_CACHE_MB = int(os.getenv("RAG_EMBED_CACHE_MB", "32"))              # 查詢向量快取上限
+RAG_EMBED_CACHE_TTL = float(os.getenv("RAG_EMBED_CACHE_TTL", "3600"))        # 秒；0 關閉
+RAG_RESULT_CACHE_SIZE = int(os.getenv("RAG_RESULT_CACHE_SIZE", "10000"))     # 檢索結果快取筆數
+RAG_RESULT_CACHE_TTL = float(os.getenv("RAG_RESULT_CACHE_TTL", "600"))       # 秒；0 關閉
+RAG_COMPRESS_TOKENS = int(os.getenv("RAG_COMPRESS_TOKENS", "512"))          # context 壓縮後的 token 預算；0 關閉（也不計算句子向量）
+RAG_COMPRESS_NEIGHBORS = int(os.getenv("RAG_COMPRESS_NEIGHBORS", "1"))       # 保留句子時一併保留前後各幾句
+
+# ---- Tracing / profiling ----
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.05"))   # 隨機取樣比例
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "2000"))           # 超過此耗時的 request 一律保留
+TRACE_FILE = os.getenv("TRACE_FILE", "logs/traces.jsonl")
+TRACE_MAX_MB = float(os.getenv("TRACE_MAX_MB", "50"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "120"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")                          # /admin/* 需帶 X-Admin-Token；未設定時管理端點停用
+
+# ---- Retrieval prefetch ----
+RAG_PREFETCH_DEBOUNCE_MS = float(os.getenv("RAG_PREFETCH_DEBOUNCE_MS", "300"))
+RAG_PREFETCH_TTL = float(os.getenv("RAG_PREFETCH_TTL", "120"))
+RAG_PREFETCH_MATCH = float(os.getenv("RAG_PREFETCH_MATCH", "0.9"))   # 最終問題與預取問題的相似度下限
+
+# ---- Streaming ----
+STREAM_DISCONNECT_POLL_MS = float(os.getenv("STREAM_DISCONNECT_POLL_MS", "250"))  # 檢查 client 是否已斷線的間隔
+WS_MAX_STREAMS = int(os.getenv("WS_MAX_STREAMS", "8"))              # 每條 WebSocket 同時進行的 chat stream 上限
+WS_STREAM_WINDOW = int(os.getenv("WS_STREAM_WINDOW", "65536"))      # 每個 stream 未確認（credit）的字元上限
+WS_FLUSH_MS = float(os.getenv("WS_FLUSH_MS", "20"))                 # 合併事件成一個 WebSocket 訊息的時間窗
+CHAT_SINGLE_FLIGHT = os.getenv("CHAT_SINGLE_FLIGHT", "1") != "0"   # 相同的進行中 chat 請求共用一個上游串流
+
+# ---- Readiness / warmup ----
+WARMUP_QUERIES = int(os.getenv("WARMUP_QUERIES", "3"))              # 啟動暖機時每個已載入知識庫的合成查詢數
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "20"))           # 秒；每個 LLM 提供者暖機連線的逾時
+READY_PROBE_TTL = float(os.getenv("READY_PROBE_TTL", "5"))          # 秒；/health/ready 重用 embedding 服務檢查結果的時間
+
+# ---- Ingestion (/ingest) ----
+# 上傳檔與發佈的文件不可放在 cache/ 下：cache/ 以 /cache 公開提供（StaticFiles，不需驗證）
+INGEST_DIR = os.getenv("INGEST_DIR", "data/ingest")                   # 上傳檔、checkpoint 與工作佇列（sqlite）
+INGEST_PUBLISHED_DIR = os.getenv("INGEST_PUBLISHED_DIR", "data/published")  # 已發佈到知識庫的文件批次（每個知識庫一個目錄）
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))                # 轉換 / embedding worker 行程數（同時處理的工作數）
+INGEST_EMBED_BATCH = int(os.getenv("INGEST_EMBED_BATCH", "64"))       # 每批 embedding 的 chunk 數（每批一個 checkpoint）
+INGEST_MAX_MB = int(os.getenv("INGEST_MAX_MB", "200"))                # 單一上傳檔大小上限
+INGEST_PROGRESS_MS = float(os.getenv("INGEST_PROGRESS_MS", "500"))    # SSE 進度串流檢查工作狀態的間隔
+INGEST_LEASE_SECONDS = float(os.getenv("INGEST_LEASE_SECONDS", "60"))  # 工作租約；領取者停止 heartbeat 超過此時間才會被接手
@@ -0,0 +1,227 @@
+"""
+On-demand sampling profiler
+
+管理端呼叫 POST /admin/profiler/arm 後，下一個符合路徑的 request 會被剖析：
+
+- 背景執行緒每 PROFILE_INTERVAL_MS 讀取 sys._current_frames()
+- event loop 執行緒只在「目前執行中的 task 屬於該 request」時記錄，其他 request 的 task 不會混進來；
+  request 用到的其他執行緒（threadpool）則全部記錄
+- 結果為 collapsed stacks（flamegraph.pl / speedscope 可讀），也可直接輸出 SVG flame graph
+"""
+import asyncio
+import html
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from .config import PROFILE_INTERVAL_MS, PROFILE_MAX_SECONDS
+from .metrics import registry
+
+_profiles_total = registry.counter("profiler_sessions_total", "Profiled requests")
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class ProfileSession:
+    def __init__(self, profile_id: str, path_prefix: str, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.profile_id = profile_id
+        self.path_prefix = path_prefix
+        self.interval = interval
+        self.path = ""
+        self.trace_id = ""
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self.started_at = 0.0
+        self.duration = 0.0
+        self.done = False
+        self._tasks: Set[asyncio.Task] = set()
+        self._threads: Set[int] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # Trace listener：span / middleware 進入時登記目前的 task 或 thread
+    def register_current(self) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._threads.add(threading.get_ident())
+            return
+        if self._loop is None:
+            self._loop, self._loop_thread = loop, threading.get_ident()
+        task = asyncio.current_task()
+        if task is not None:
+            self._tasks.add(task)
+
+    def start(self) -> None:
+        self.register_current()
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{self.profile_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+        self.duration = time.time() - self.started_at
+        self.done = True
+        self._tasks.clear()
+        _profiles_total.inc()
+
+    def _run(self) -> None:
+        deadline = time.monotonic() + PROFILE_MAX_SECONDS
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            for tid, frame in frames.items():
+                if tid == own:
+                    continue
+                if tid == self._loop_thread:
+                    try:
+                        task = asyncio.current_task(self._loop)
+                    except Exception:
+                        task = None
+                    if task not in self._tasks:
+                        continue
+                elif tid not in self._threads:
+                    continue
+                stack: List[str] = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+                self.sample_count += 1
+
+    # ---------- output ----------
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+    def svg(self) -> str:
+        title = f"{self.path} · {self.sample_count} samples · {self.duration * 1000:.0f} ms · trace {self.trace_id}"
+        return render_flamegraph(self.samples, title)
+
+    def summary(self) -> Dict:
+        return {
+            "profile_id": self.profile_id,
+            "path_prefix": self.path_prefix,
+            "path": self.path,
+            "trace_id": self.trace_id,
+            "done": self.done,
+            "samples": self.sample_count,
+            "duration_ms": round(self.duration * 1000, 1),
+        }
+
+
+class ProfileStore:
+    """待剖析的設定（armed）與已完成的結果（保留最近 max_results 筆）"""
+
+    def __init__(self, max_results: int = 16):
+        self.max_results = max_results
+        self._armed: List[ProfileSession] = []
+        self._results: "OrderedDict[str, ProfileSession]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def arm(self, path_prefix: str = "/", interval_ms: Optional[float] = None) -> ProfileSession:
+        interval = (interval_ms or PROFILE_INTERVAL_MS) / 1000
+        session = ProfileSession(os.urandom(6).hex(), path_prefix, interval)
+        with self._lock:
+            self._armed.append(session)
+        return session
+
+    def claim(self, path: str, trace) -> Optional[ProfileSession]:
+        """middleware 呼叫：此 request 符合等待中的設定時取出（每個設定只剖析一個 request）"""
+        if not self._armed:
+            return None
+        with self._lock:
+            for i, session in enumerate(self._armed):
+                if path.startswith(session.path_prefix):
+                    del self._armed[i]
+                    break
+            else:
+                return None
+            self._results[session.profile_id] = session
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        session.path = path
+        session.trace_id = trace.trace_id
+        trace.listeners.append(session)
+        return session
+
+    def get(self, profile_id: str) -> Optional[ProfileSession]:
+        return self._results.get(profile_id) or next((s for s in self._armed if s.profile_id == profile_id), None)
+
+    def list(self) -> List[Dict]:
+        with self._lock:
+            armed = [{**s.summary(), "armed": True} for s in self._armed]
+            done = [{**s.summary(), "armed": False} for s in reversed(self._results.values())]
+        return armed + done
+
+
+profiles = ProfileStore()
+
+
+# ==================== Flame graph ====================
+def _build_tree(samples: Dict[str, int]) -> Dict:
+    root = {"name": "all", "value": 0, "children": {}}
+    for stack, count in samples.items():
+        root["value"] += count
+        node = root
+        for frame in stack.split(";"):
+            child = node["children"].get(frame)
+            if child is None:
+                child = node["children"][frame] = {"name": frame, "value": 0, "children": {}}
+            child["value"] += count
+            node = child
+    return root
+
+
+def _color(name: str) -> str:
+    h = zlib.crc32(name.encode("utf-8"))
+    return f"rgb({205 + h % 50},{80 + (h >> 8) % 120},{40 + (h >> 16) % 50})"
+
+
+def render_flamegraph(samples: Dict[str, int], title: str = "", width: int = 1200, row: int = 16) -> str:
+    """collapsed stacks → 獨立的 SVG flame graph（根在下方，寬度與樣本數成正比，滑鼠停留顯示完整名稱）"""
+    tree = _build_tree(samples)
+    total = max(tree["value"], 1)
+    rects: List[Tuple[int, float, float, Dict]] = []
+
+    def layout(node, depth, x):
+        rects.append((depth, x, node["value"] / total * width, node))
+        cx = x
+        for child in sorted(node["children"].values(), key=lambda c: c["name"]):
+            layout(child, depth + 1, cx)
+            cx += child["value"] / total * width
+
+    layout(tree, 0, 0.0)
+    max_depth = max((d for d, *_ in rects), default=0)
+    height = (max_depth + 1) * row + 40
+    out = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'font-family="monospace" font-size="11">',
+        f'<rect width="100%" height="100%" fill="#fafafa"/>',
+        f'<text x="6" y="18" font-size="13">{html.escape(title)}</text>',
+    ]
+    for depth, x, w, node in rects:
+        if w < 0.5:
+            continue
+        y = height - (depth + 1) * row - 4
+        label = node["name"]
+        pct = node["value"] / total * 100
+        chars = int((w - 6) / 6.6)
+        text = label if len(label) <= chars else (label[:chars - 2] + ".." if chars > 3 else "")
+        out.append(
+            f'<g><title>{html.escape(label)} ({node["value"]} samples, {pct:.1f}%)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row - 1}" fill="{_color(label)}" rx="2"/>'
+            f'<text x="{x + 3:.1f}" y="{y + row - 4}">{html.escape(text)}</text></g>'
+        )
+    out.append("</svg>")
+    return "\n".join(out)
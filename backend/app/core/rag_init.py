@@ -1,11 +1,28 @@
-from ..services.rag_core import setup_rag_system
-from .config import logger
+import multiprocessing
+
+from ..services.rag_core import knowledge_bases, setup_rag_system
+from .config import logger, get_knowledge_bases, RAG_DEFAULT_KB, RAG_KB_PINNED
+
+def in_spawned_worker() -> bool:
+    # spawn 出的 worker（shard / 匯入 / bulk 解析）會重新 import 主模組（python -m app.main 時即 app.main，
+    # import 時就建立 app）；這些行程不載入知識庫，也不啟動背景匯入
+    return getattr(multiprocessing.current_process(), "_inheriting", False)
 
 def initialize_rag():
+    # worker 行程若載入知識庫，每個 worker 都會再載入一次並嘗試建立自己的 shard 行程
+    if in_spawned_worker():
+        return False
     try:
         logger.info("🔧 Initializing RAG system...")
-        PDF_PATH = "D:/Build_RAG_Locally/DIADesigner-ST-CODE.pdf"
-        setup_rag_system(PDF_PATH, force_reload=False)
+        kbs = get_knowledge_bases()
+        for name, source in kbs.items():
+            knowledge_bases.register(name, source, pinned=name in RAG_KB_PINNED)
+        logger.info(f"知識庫: {', '.join(kbs)}（預設 {RAG_DEFAULT_KB}）")
+        # 預設與 pinned 的知識庫在啟動時載入，其餘在第一次查詢時才載入
+        setup_rag_system(kbs[RAG_DEFAULT_KB], force_reload=False)
+        for name in RAG_KB_PINNED:
+            if name in kbs and name != RAG_DEFAULT_KB:
+                knowledge_bases.get(name)
         logger.info("✓ RAG system initialized")
         return True
     except Exception as e:
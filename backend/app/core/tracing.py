@@ -0,0 +1,368 @@
+"""
+Request tracing
+
+每個 HTTP request 一個 trace，各階段（檢索、組 prompt、連線 provider、串流 token）為 span：
+
+- span 以 contextvars 傳遞父子關係，async generator / 同步函式都可直接 `with span("name"):`
+- 取樣：request 結束時決定 —— 依 TRACE_SAMPLE_RATE 隨機取樣，超過 TRACE_SLOW_MS 的慢 request 一律保留，
+  request header `X-Trace-Sample: 1` 或被 profiler 選中的 request 也一定保留
+- 取樣到的 trace 由背景執行緒寫入 TRACE_FILE（每行一個 OTLP/JSON `resourceSpans` 物件，
+  可直接交給 OpenTelemetry Collector 的 otlpjsonfile receiver），超過 TRACE_MAX_MB 時輪替
+- response header 帶 `X-Trace-Id`，方便由前端回報對應到 trace
+"""
+import asyncio
+import json
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from .config import TRACE_FILE, TRACE_MAX_MB, TRACE_SAMPLE_RATE, TRACE_SLOW_MS, logger
+from .metrics import registry
+
+SERVICE_NAME = "rag_web_backend"
+
+_traces_total = registry.counter("trace_requests_total", "Traced requests by sampling decision")
+
+
+def _new_id(nbytes: int) -> str:
+    return os.urandom(nbytes).hex()
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start_ns: int
+    end_ns: int = 0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    events: List[Dict[str, Any]] = field(default_factory=list)
+    status: str = "ok"            # ok / error / cancelled / unfinished（trace 匯出時仍在執行）
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def event(self, name: str, **attributes) -> None:
+        self.events.append({"name": name, "time_ns": time.time_ns(), "attributes": attributes})
+
+    def end(self) -> None:
+        if not self.end_ns:
+            self.end_ns = time.time_ns()
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+
+class _NoopSpan:
+    """不在 trace 內（例如啟動時的 setup_rag_system）時使用"""
+
+    def set(self, **attributes) -> None:
+        pass
+
+    def event(self, name: str, **attributes) -> None:
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Trace:
+    def __init__(self, force: bool = False):
+        self.trace_id = _new_id(16)
+        self.spans: List[Span] = []
+        self.force = force
+        self.listeners: List[Any] = []     # 例如 profiler：register_task() 時通知
+        self.finished = False              # 已決定取樣（可能已送出匯出），之後不再加入 span
+
+    def start_span(self, name: str, parent: Optional[Span], attributes: Dict[str, Any]) -> Span:
+        s = Span(
+            name=name,
+            trace_id=self.trace_id,
+            span_id=_new_id(8),
+            parent_id=parent.span_id if parent is not None else None,
+            start_ns=time.time_ns(),
+            attributes=dict(attributes),
+        )
+        self.spans.append(s)
+        return s
+
+    def register_task(self) -> None:
+        """記錄執行此 trace 的 task / thread（供 profiler 只取樣這個 request）"""
+        for listener in self.listeners:
+            listener.register_current()
+
+    @property
+    def root(self) -> Optional[Span]:
+        return self.spans[0] if self.spans else None
+
+    def sampled(self) -> bool:
+        if self.force:
+            return True
+        root = self.root
+        if root is not None and root.duration_ms >= TRACE_SLOW_MS:
+            return True
+        return random.random() < TRACE_SAMPLE_RATE
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def current_span():
+    return _current_span.get() or _NOOP
+
+
+def detach_trace() -> None:
+    """由 request 建立、但會在 request 結束後繼續執行的背景 task 開頭呼叫，避免 span 寫進已匯出的 trace"""
+    _current_trace.set(None)
+    _current_span.set(None)
+
+
+def _reset(var: ContextVar, token) -> None:
+    try:
+        var.reset(token)
+    except ValueError:
+        # async generator 在其他 context 被關閉（例如 GC）時無法 reset，直接略過
+        pass
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Any]:
+    trace = _current_trace.get()
+    if trace is None or trace.finished:
+        # trace 已結束：例如 request 結束後仍為其他 request 繼續執行的 single-flight 生成
+        yield _NOOP
+        return
+    s = trace.start_span(name, _current_span.get(), attributes)
+    token = _current_span.set(s)
+    trace.register_task()
+    try:
+        yield s
+    except (asyncio.CancelledError, GeneratorExit):
+        if not s.end_ns:
+            s.status = "cancelled"
+        raise
+    except BaseException as e:
+        if not s.end_ns:   # trace 已匯出（unfinished）時不再修改
+            s.status = "error"
+            s.attributes["error"] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        s.end()
+        _reset(_current_span, token)
+
+
+async def traced_stream(lines: AsyncIterator[str], name: str = "llm.stream", **attributes) -> AsyncIterator[str]:
+    """包住 SSE 串流：記錄第一個 token 的時間與輸出的事件數"""
+    with span(name, **attributes) as s:
+        events = 0
+        async for line in lines:
+            if events == 0 and line.startswith("data: "):
+                s.event("first_token")
+            if line == "\n":
+                events += 1
+            yield line
+        s.set(events=events)
+
+
+# ==================== Export ====================
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items() if v is not None]
+
+
+_STATUS_CODE = {"ok": 1, "error": 2, "cancelled": 2, "unfinished": 0}   # unfinished 為 UNSET
+
+
+def to_otlp(trace: Trace) -> Dict[str, Any]:
+    spans = []
+    for s in trace.spans:
+        spans.append({
+            "traceId": s.trace_id,
+            "spanId": s.span_id,
+            "parentSpanId": s.parent_id or "",
+            "name": s.name,
+            "kind": 2 if s.parent_id is None else 1,   # SERVER / INTERNAL
+            "startTimeUnixNano": str(s.start_ns),
+            "endTimeUnixNano": str(s.end_ns or s.start_ns),
+            "attributes": _otlp_attributes(s.attributes),
+            "events": [
+                {"name": e["name"], "timeUnixNano": str(e["time_ns"]), "attributes": _otlp_attributes(e["attributes"])}
+                for e in s.events
+            ],
+            "status": {"code": _STATUS_CODE[s.status], "message": s.status if s.status != "ok" else ""},
+        })
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME, "process.pid": os.getpid()})},
+            "scopeSpans": [{"scope": {"name": "app.core.tracing"}, "spans": spans}],
+        }]
+    }
+
+
+class FileExporter:
+    """背景執行緒寫檔，request 端只做 queue.put（不阻塞 event loop）"""
+
+    def __init__(self, path: str = TRACE_FILE, max_bytes: int = int(TRACE_MAX_MB * 1024 * 1024), max_queue: int = 1000):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self._queue: "queue.Queue[Trace]" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def submit(self, trace: Trace) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            _traces_total.inc(decision="queue_full")
+
+    def _run(self) -> None:
+        while True:
+            trace = self._queue.get()
+            try:
+                self._write(json.dumps(to_otlp(trace), ensure_ascii=False))
+            except Exception as e:
+                logger.warning(f"trace 寫入失敗: {e}")
+
+    def _write(self, line: str) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.exists() and self.path.stat().st_size >= self.max_bytes:
+            os.replace(self.path, self.path.with_name(self.path.name + ".1"))
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+exporter = FileExporter()
+
+
+def _finish(trace: Trace) -> None:
+    """root span 結束後決定是否取樣並送出匯出"""
+    trace.finished = True
+    # 仍在執行的 span（例如 leader 離開後繼續為 follower 生成的 single-flight）以 root 的結束時間截斷並標記，
+    # 不會以 end_ns=0 匯出成 0 ms 的 ok span；之後 span 結束時不再修改（已送出匯出）
+    root = trace.root
+    unfinished = [s for s in trace.spans if not s.end_ns]
+    for s in unfinished:
+        s.status = "unfinished"
+        s.end_ns = root.end_ns or time.time_ns()
+    if unfinished:
+        root.set(unfinished_spans=len(unfinished))
+    sampled = trace.sampled()
+    _traces_total.inc(decision="sampled" if sampled else "dropped")
+    if sampled:
+        exporter.submit(trace)
+
+
+@contextmanager
+def trace_root(name: str, force: bool = False, **attributes) -> Iterator[Span]:
+    """HTTP middleware 以外的進入點（例如 WebSocket 上的每個 chat stream）建立獨立的 trace"""
+    trace = Trace(force=force)
+    root = trace.start_span(name, None, attributes)
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(root)
+    try:
+        yield root
+    except (asyncio.CancelledError, GeneratorExit):
+        root.status = "cancelled"
+        raise
+    except BaseException as e:
+        root.status = "error"
+        root.set(error=f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        root.end()
+        _reset(_current_span, span_token)
+        _reset(_current_trace, trace_token)
+        _finish(trace)
+
+
+# ==================== ASGI middleware ====================
+class TracingMiddleware:
+    """
+    每個 HTTP request 建立 root span；StreamingResponse 的 body 串流完畢（或 client 中斷）才結束
+
+    profiler：被 admin 指定要剖析的 request 會在 trace 期間啟動取樣 profiler，結果以 X-Profile-Id 查詢
+    """
+
+    def __init__(self, app, exclude_paths=("/metrics", "/health", "/admin")):
+        self.app = app
+        self.exclude_paths = tuple(exclude_paths)
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or path.startswith(self.exclude_paths):
+            await self.app(scope, receive, send)
+            return
+
+        from .profiler import profiles  # 避免循環 import
+
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        trace = Trace(force=headers.get("x-trace-sample") == "1")
+        session = profiles.claim(path, trace)
+        if session is not None:
+            trace.force = True
+
+        root = trace.start_span(f"{scope.get('method', 'GET')} {path}", None, {
+            "http.method": scope.get("method", ""),
+            "http.target": path,
+            "http.query": scope.get("query_string", b"").decode("latin-1")[:500],
+        })
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span.set(root)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                root.set(**{"http.status_code": message["status"]})
+                extra = [(b"x-trace-id", trace.trace_id.encode())]
+                if session is not None:
+                    extra.append((b"x-profile-id", session.profile_id.encode()))
+                message = {**message, "headers": list(message.get("headers", [])) + extra}
+            elif message["type"] == "http.response.body":
+                trace.register_task()   # 串流 body 的 task
+            await send(message)
+
+        try:
+            if session is not None:
+                session.start()
+            trace.register_task()
+            await self.app(scope, receive, send_wrapper)
+        except asyncio.CancelledError:
+            root.status = "cancelled"
+            raise
+        except BaseException as e:
+            root.status = "error"
+            root.set(error=f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            root.end()
+            if session is not None:
+                session.stop()
+            _reset(_current_span, span_token)
+            _reset(_current_trace, trace_token)
+            _finish(trace)
@@ -1,3 +1,5 @@
+import asyncio
+from contextlib import asynccontextmanager
 from pathlib import Path
 import os
 from dotenv import load_dotenv
@@ -5,14 +7,30 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
-from .core.config import logger
-from .core.rag_init import initialize_rag
+from .core.config import logger, RAG_DEFAULT_KB
+from .core.rag_init import in_spawned_worker, initialize_rag
+from .core.tracing import TracingMiddleware
+from .api.routes_admin import router as admin_router
 from .api.routes_chat import router as chat_router
 from .api.routes_health import router as health_router
+from .api.routes_ingest import router as ingest_router
+from .api.routes_ws import router as ws_router
+from .services.ingestion import ingestion
+from .services.rag_core import knowledge_bases
+from .services.readiness import readiness
+from .services import st_bulk
 from .services.st_code_parser_backend import add_st_parser_routes
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 暖機在背景執行，/health/live 立即可用；/health/ready 等暖機完成才會 ready
+    app.state.warmup = asyncio.create_task(readiness.warmup(app.state.RAG_ENABLED))
+    yield
+    app.state.warmup.cancel()
+    st_bulk.shutdown()
+
 def create_app() -> FastAPI:
-    app = FastAPI(title="LLM Chatbot Web")
+    app = FastAPI(title="LLM Chatbot Web", lifespan=lifespan)
 
     # CORS
     app.add_middleware(
@@ -21,7 +39,10 @@ def create_app() -> FastAPI:
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=["X-Trace-Id", "X-Profile-Id"],
     )
+    # 每個 request 的 span / 取樣匯出（最外層，涵蓋 StreamingResponse 的完整串流時間）
+    app.add_middleware(TracingMiddleware)
 
     BASE_DIR = Path(__file__).resolve().parent.parent  # backend/
     CACHE_DIR = (BASE_DIR / "cache").resolve()
@@ -34,10 +55,22 @@ def create_app() -> FastAPI:
     # Routers
     app.include_router(chat_router)
     app.include_router(health_router)
+    app.include_router(admin_router)
+    app.include_router(ws_router)
+    app.include_router(ingest_router)
     add_st_parser_routes(app)
 
-    # Optional: init RAG
-    initialize_rag()
+    # Optional: init RAG（失敗時 RAG 端點退回不檢索）
+    app.state.RAG_ENABLED = initialize_rag()
+    # 背景匯入：接續上次中斷的工作；RAG 初始化失敗（例如新部署還沒有來源文件）時也啟動，
+    # 第一批文件發佈、預設知識庫載入後啟用 RAG
+    def on_published(kb: str) -> None:
+        if not app.state.RAG_ENABLED and knowledge_bases.peek(RAG_DEFAULT_KB) is not None:
+            app.state.RAG_ENABLED = True
+            logger.info(f"✓ 知識庫 {kb} 已發佈文件，啟用 RAG")
+
+    if not in_spawned_worker():
+        ingestion.start(on_published=on_published)
 
     return app
 
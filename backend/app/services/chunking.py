@@ -0,0 +1,259 @@
+"""
+Chunking stage between markdown header splitting and embedding
+
+- split_by_size(): 以 token 上限切割過大的 header 區段（含 overlap），保留 header metadata，
+  ``` 程式碼區塊（ST code）不會被切開
+- dedup_near_duplicates(): MinHash / LSH 移除近似重複的 chunk（頁首、重複表格等樣板內容）
+- sentence_spans(): chunk 內的句子位置（context 壓縮以句子為單位挑選）
+"""
+import re
+import zlib
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+_CJK_RE = re.compile(r"[　-〿㐀-䶿一-鿿가-힯＀-￯]")
+_FENCE_RE = re.compile(r"^```.*?^```[^\n]*$", re.MULTILINE | re.DOTALL)
+_SENTENCE_RE = re.compile(r"(?<=[.!?。！？；;])\s+|\n")
+_BOUNDARY_RE = re.compile(r"(?<=[.!?;])\s+|(?<=[。！？；])\s*|\n")  # 全形標點後通常不接空白
+
+
+def estimate_tokens(text: str) -> int:
+    """不依賴 tokenizer 的 token 估算：CJK 每字約 1 token，其他字元約 4 字元 1 token"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def sentence_spans(text: str, min_tokens: int = 4) -> List[Tuple[int, int]]:
+    """
+    句子的 (start, end) 字元位置，不含前後空白；``` 程式碼區塊整塊為一句，
+    過短的片段（清單編號、單字行）併入前一句
+    """
+    spans: List[Tuple[int, int]] = []
+    fences = set()  # 程式碼區塊在 spans 中的位置，不與其他片段合併
+
+    def add(start: int, end: int, fence: bool = False) -> None:
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start >= end:
+            return
+        if not fence and spans and len(spans) - 1 not in fences and estimate_tokens(text[start:end]) < min_tokens:
+            spans[-1] = (spans[-1][0], end)
+            return
+        if fence:
+            fences.add(len(spans))
+        spans.append((start, end))
+
+    def add_prose(start: int, end: int) -> None:
+        for m in _BOUNDARY_RE.finditer(text, start, end):
+            add(start, m.start())
+            start = m.end()
+        add(start, end)
+
+    pos = 0
+    for m in _FENCE_RE.finditer(text):
+        add_prose(pos, m.start())
+        add(m.start(), m.end(), fence=True)
+        pos = m.end()
+    add_prose(pos, len(text))
+    return spans
+
+
+# ==================== Size-bounded splitting ====================
+def _blocks(text: str) -> List[Tuple[str, bool]]:
+    """切成 (文字, 是否為程式碼區塊)：程式碼區塊整塊保留，其他依段落切開"""
+    blocks: List[Tuple[str, bool]] = []
+    pos = 0
+    for m in _FENCE_RE.finditer(text):
+        blocks.extend((p, False) for p in re.split(r"\n\s*\n", text[pos:m.start()]) if p.strip())
+        blocks.append((m.group(), True))
+        pos = m.end()
+    blocks.extend((p, False) for p in re.split(r"\n\s*\n", text[pos:]) if p.strip())
+    return blocks
+
+
+def _split_paragraph(text: str, max_tokens: int) -> List[str]:
+    """過長的段落依句子切開；單一句子仍過長時以字元視窗硬切"""
+    pieces: List[str] = []
+    current = ""
+    for sentence in _SENTENCE_RE.split(text):
+        if not sentence.strip():
+            continue
+        candidate = f"{current} {sentence}" if current else sentence
+        if estimate_tokens(candidate) <= max_tokens:
+            current = candidate
+            continue
+        if current:
+            pieces.append(current)
+        if estimate_tokens(sentence) <= max_tokens:
+            current = sentence
+        else:
+            # 以保守的字元數（每 token 1 字元）切割，確保每段都在上限內
+            pieces.extend(sentence[i:i + max_tokens] for i in range(0, len(sentence), max_tokens))
+            current = ""
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def _overlap_tail(units: List[Tuple[str, int, bool]], overlap_tokens: int, room: int) -> List[Tuple[str, int, bool]]:
+    """下一個 chunk 開頭要重複的內容：尾端完整段落，不足時取最後一段的結尾句子（程式碼區塊不重複）"""
+    budget = min(overlap_tokens, room)
+    carried: List[Tuple[str, int, bool]] = []
+    used = 0
+    for unit in reversed(units):
+        if unit[2] or used + unit[1] > budget:
+            break
+        carried.insert(0, unit)
+        used += unit[1]
+    if carried or budget <= 0 or not units or units[-1][2]:
+        return carried
+
+    tail = ""
+    for sentence in reversed([s for s in _SENTENCE_RE.split(units[-1][0]) if s.strip()]):
+        candidate = f"{sentence} {tail}" if tail else sentence
+        if estimate_tokens(candidate) > budget:
+            break
+        tail = candidate
+    return [(tail, estimate_tokens(tail), False)] if tail else []
+
+
+def split_by_size(docs: Iterable[Document], max_tokens: int = 512, overlap_tokens: int = 64) -> List[Document]:
+    """
+    將每個 header 區段切成不超過 max_tokens 的 chunk
+
+    - 以段落為單位打包，相鄰 chunk 之間重複前一個 chunk 結尾約 overlap_tokens 的內容
+    - ``` 程式碼區塊視為不可分割；單一程式碼區塊超過上限時獨立成一個 chunk
+    - metadata（Header 1/2/3）完整保留，另加上 chunk_index / chunk_count
+    """
+    out: List[Document] = []
+    for doc in docs:
+        text = doc.page_content or ""
+        if estimate_tokens(text) <= max_tokens:
+            out.append(Document(page_content=text, metadata={**doc.metadata, "chunk_index": 0, "chunk_count": 1}))
+            continue
+
+        units: List[Tuple[str, int, bool]] = []
+        for block, is_code in _blocks(text):
+            if is_code or estimate_tokens(block) <= max_tokens:
+                units.append((block, estimate_tokens(block), is_code))
+            else:
+                units.extend((p, estimate_tokens(p), False) for p in _split_paragraph(block, max_tokens))
+
+        chunks: List[str] = []
+        current: List[Tuple[str, int, bool]] = []
+        size = 0
+        for unit in units:
+            if current and size + unit[1] > max_tokens:
+                chunks.append("\n\n".join(u[0] for u in current))
+                # overlap：從尾端保留不超過 overlap_tokens 的文字段落（程式碼區塊不重複）
+                current = _overlap_tail(current, overlap_tokens, max_tokens - unit[1])
+                size = sum(u[1] for u in current)
+            current.append(unit)
+            size += unit[1]
+        if current:
+            chunks.append("\n\n".join(u[0] for u in current))
+
+        for i, chunk in enumerate(chunks):
+            out.append(Document(page_content=chunk, metadata={**doc.metadata, "chunk_index": i, "chunk_count": len(chunks)}))
+    return out
+
+
+# ==================== MinHash / LSH near-duplicate elimination ====================
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def _shingles(text: str, size: int) -> np.ndarray:
+    normalized = " ".join(text.lower().split())
+    if len(normalized) <= size:
+        return np.array([zlib.crc32(normalized.encode("utf-8"))], dtype=np.uint64)
+    grams = {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+
+
+class MinHasher:
+    """固定種子的 MinHash（numpy 向量化計算所有排列）"""
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self._a = rng.randint(1, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+        self._b = rng.randint(0, np.iinfo(np.int64).max, size=num_perm, dtype=np.int64).astype(np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = _shingles(text, self.shingle_size)
+        # (num_perm, n_shingles)；uint64 乘法溢位等同 mod 2^64，再 mod prime 取 32 bits
+        permuted = ((np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME) & _MAX_HASH
+        return permuted.min(axis=1)
+
+
+def dedup_near_duplicates(
+    docs: Sequence[Document],
+    threshold: float = 0.85,
+    num_perm: int = 128,
+    bands: int = 16,
+) -> Tuple[List[Document], int]:
+    """
+    移除近似重複的 chunk，保留第一次出現者
+
+    LSH 以 bands × rows 分桶取得候選，再以 MinHash 估計的 Jaccard 相似度確認。
+
+    Returns:
+        (保留的 chunk, 移除數量)
+    """
+    if threshold >= 1.0 or len(docs) < 2:
+        return list(docs), 0
+
+    rows = max(num_perm // bands, 1)
+    hasher = MinHasher(num_perm=bands * rows)
+    buckets: Dict[Tuple[int, bytes], List[int]] = {}
+    kept_sigs: List[np.ndarray] = []
+    kept: List[Document] = []
+    removed = 0
+
+    for doc in docs:
+        sig = hasher.signature(doc.page_content or "")
+        keys = [(b, sig[b * rows:(b + 1) * rows].tobytes()) for b in range(bands)]
+
+        duplicate_of: Optional[int] = None
+        seen = set()
+        for key in keys:
+            for cand in buckets.get(key, ()):
+                if cand in seen:
+                    continue
+                seen.add(cand)
+                if float(np.mean(kept_sigs[cand] == sig)) >= threshold:
+                    duplicate_of = cand
+                    break
+            if duplicate_of is not None:
+                break
+
+        if duplicate_of is not None:
+            removed += 1
+            continue
+
+        idx = len(kept)
+        kept.append(doc)
+        kept_sigs.append(sig)
+        for key in keys:
+            buckets.setdefault(key, []).append(idx)
+
+    return kept, removed
+
+
+def build_chunks(
+    header_splits: Iterable[Document],
+    max_tokens: int = 512,
+    overlap_tokens: int = 64,
+    dedup_threshold: float = 0.85,
+) -> List[Document]:
+    """header 切割結果 → 限制大小 → 去除近似重複"""
+    sized = split_by_size(header_splits, max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+    chunks, removed = dedup_near_duplicates(sized, threshold=dedup_threshold)
+    print(f"chunking ...... {len(sized)} chunks（≤{max_tokens} tokens），移除 {removed} 個近似重複，剩 {len(chunks)}")
+    return chunks
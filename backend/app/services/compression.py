@@ -0,0 +1,186 @@
+"""
+Query-aware context compression
+
+檢索回來的 chunk 常是整段手冊章節，真正回答問題的只有幾句；送給 LLM 前以句子為單位壓縮：
+
+- 句子位置與向量在建立索引 / 匯入文件時就算好（SentenceIndex，以 faiss id 對齊 chunk），查詢時不呼叫 embedding 模型
+- 查詢向量對所有候選句子做一次矩陣乘法（向量已正規化，即 cosine），依分數由高到低挑選，
+  每句連同前後 neighbors 句一起保留，直到 token 預算用完
+- 每個 chunk 至少保留最相關的一句，[S#] 編號與來源清單不變；保留的句子依原文順序輸出，不連續處以 … 隔開
+- 沒有句子資料的 chunk（例如未附句子向量的舊匯入批次）原文保留
+"""
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from . import vector_storage
+from .chunking import estimate_tokens, sentence_spans
+
+FORMAT_VERSION = 1
+GAP = "\n…\n"
+
+
+def _normalize(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim != 2:
+        vectors = vectors.reshape(len(vectors), -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def split_sentences(texts: Sequence[str]) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """chunk 文字 → (每個 chunk 的句子數, 句子字元位置 (n, 2), 句子文字)"""
+    counts, spans, sentences = [], [], []
+    for text in texts:
+        text = text or ""
+        chunk_spans = sentence_spans(text)
+        counts.append(len(chunk_spans))
+        spans.extend(chunk_spans)
+        sentences.extend(text[a:b] for a, b in chunk_spans)
+    return (
+        np.asarray(counts, dtype=np.int64),
+        np.asarray(spans, dtype=np.int32).reshape(-1, 2),
+        sentences,
+    )
+
+
+class SentenceIndex:
+    """faiss id → 該 chunk 的句子位置與正規化後的句子向量"""
+
+    def __init__(self, offsets: np.ndarray, spans: np.ndarray, vectors):
+        self.offsets = offsets   # (chunks + 1,)：第 i 個 chunk 的句子為 [offsets[i], offsets[i + 1])
+        self.spans = spans       # (sentences, 2)：句子在 chunk 文字中的字元位置
+        self.vectors = vectors   # (sentences, d)：磁碟 memmap（+ 之後匯入的句子，留在記憶體）
+
+    @property
+    def size(self) -> int:
+        return len(self.offsets) - 1
+
+    @classmethod
+    def build(cls, texts: Sequence[str], embed: Callable[[List[str]], Sequence]) -> "SentenceIndex":
+        counts, spans, sentences = split_sentences(texts)
+        vectors = _normalize(embed(sentences)) if sentences else np.empty((0, 0), dtype=np.float32)
+        return cls(np.concatenate([[0], np.cumsum(counts)]).astype(np.int64), spans, vectors)
+
+    # ---------- persistence ----------
+    def save(self, prefix) -> None:
+        prefix = Path(prefix)
+        vector_storage.save_full_vectors(np.asarray(self.vectors), prefix.with_suffix(".npy"))
+        np.savez(prefix.with_suffix(".npz"), version=FORMAT_VERSION, offsets=self.offsets, spans=self.spans)
+
+    @classmethod
+    def load(cls, prefix) -> Optional["SentenceIndex"]:
+        """句子向量以 memmap 開啟；檔案不存在、格式不同或不一致時回傳 None"""
+        prefix = Path(prefix)
+        meta_path = prefix.with_suffix(".npz")
+        if not meta_path.exists():
+            return None
+        try:
+            with np.load(meta_path, allow_pickle=False) as data:
+                if int(data["version"]) != FORMAT_VERSION:
+                    return None
+                offsets, spans = data["offsets"], data["spans"]
+        except Exception as e:
+            print(f"✗ 句子索引讀取失敗 ({meta_path}): {e}")
+            return None
+        vectors = vector_storage.load_full_vectors(prefix.with_suffix(".npy"))
+        if vectors is None or len(vectors) != len(spans) or int(offsets[-1]) != len(spans):
+            return None
+        return cls(offsets, spans, vectors)
+
+    # ---------- updates ----------
+    def append(self, texts: Sequence[str], vectors=None) -> None:
+        """
+        加入新 chunk 的句子（呼叫端持有知識庫的 write_lock）；vectors 為 split_sentences 順序的句子向量，
+        未提供或數量不符時這些 chunk 不壓縮。offsets 最後更新，查詢中的讀取者看到的是一致的前綴
+        """
+        counts, spans, sentences = split_sentences(texts)
+        if vectors is None or len(vectors) != len(sentences) or not len(sentences):
+            counts, spans = np.zeros(len(texts), dtype=np.int64), np.empty((0, 2), dtype=np.int32)
+        else:
+            vectors = _normalize(vectors)
+            if not isinstance(self.vectors, vector_storage.AppendableVectors):
+                self.vectors = vector_storage.AppendableVectors(self.vectors)
+            self.vectors.append(vectors)
+        self.spans = np.concatenate([self.spans, spans])
+        self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(counts)])
+
+    def memory_bytes(self) -> int:
+        extra = getattr(self.vectors, "extra", None)
+        return self.offsets.nbytes + self.spans.nbytes + (extra.nbytes if extra is not None else 0)
+
+    # ---------- query time ----------
+    def compress(
+        self, query, ids: Sequence[int], texts: Sequence[str], budget_tokens: int, neighbors: int = 1,
+    ) -> List[str]:
+        """
+        依查詢向量挑選句子，回傳與 texts 對應的壓縮後文字
+
+        ids 為各 chunk 的 faiss id，texts 為原始 chunk 文字（句子位置以它為準）
+        """
+        offsets, spans = self.offsets, self.spans
+        query = _normalize(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+
+        # 每個候選句子：所屬 chunk、chunk 內位置、全域列號
+        owners, positions, rows = [], [], []
+        whole = []  # 沒有句子資料（或位置與文字不符）的 chunk，整段保留
+        for j, (i, text) in enumerate(zip(ids, texts)):
+            if not 0 <= i < len(offsets) - 1 or offsets[i] == offsets[i + 1] or spans[offsets[i + 1] - 1, 1] > len(text):
+                whole.append(j)
+                continue
+            n = int(offsets[i + 1] - offsets[i])
+            owners.extend([j] * n)
+            positions.extend(range(n))
+            rows.extend(range(int(offsets[i]), int(offsets[i + 1])))
+        if not rows:
+            return list(texts)
+
+        rows = np.asarray(rows)
+        scores = self.vectors[rows] @ query
+        costs = [estimate_tokens(texts[j][spans[r, 0]:spans[r, 1]]) for j, r in zip(owners, rows)]
+        first = {}   # chunk → 第一個句子在候選中的位置
+        for k, j in enumerate(owners):
+            first.setdefault(j, k)
+        counts = {j: int(offsets[ids[j] + 1] - offsets[ids[j]]) for j in first}
+        selected = {j: set() for j in first}
+        used = sum(estimate_tokens(texts[j]) for j in whole)
+
+        def take(k: int, force: bool = False) -> bool:
+            nonlocal used
+            j, p = owners[k], positions[k]
+            group = [q for q in range(max(0, p - neighbors), min(counts[j], p + neighbors + 1)) if q not in selected[j]]
+            cost = sum(costs[first[j] + q] for q in group)
+            if not force and used + cost > budget_tokens:
+                return False
+            selected[j].update(group)
+            used += cost
+            return True
+
+        order = np.argsort(-scores, kind="stable")
+        # 每個 chunk 先保留最相關的一句（[S#] 不會變成空白）
+        best = {}
+        for k in order:
+            best.setdefault(owners[k], int(k))
+        for k in best.values():
+            take(k, force=True)
+        for k in order:
+            if used >= budget_tokens:
+                break
+            take(int(k))
+
+        out = list(texts)
+        for j, chosen in selected.items():
+            text, base = texts[j], int(offsets[ids[j]])
+            runs: List[List[int]] = []
+            for p in sorted(chosen):
+                if runs and p == runs[-1][-1] + 1:
+                    runs[-1].append(p)
+                else:
+                    runs.append([p])
+            # 連續的句子取原文（保留換行與格式）
+            parts = [text[spans[base + r[0], 0]:spans[base + r[-1], 1]] for r in runs]
+            prefix = GAP.lstrip("\n") if runs[0][0] > 0 else ""
+            suffix = GAP.rstrip("\n") if runs[-1][-1] < counts[j] - 1 else ""
+            out[j] = prefix + GAP.join(parts) + suffix
+        return out
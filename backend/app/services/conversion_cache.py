@@ -0,0 +1,150 @@
+"""
+Docling conversion cache
+
+docling 的版面分析是建立索引最慢的階段，且與 chunking / embedding 參數無關；轉換結果獨立於向量快取保存：
+
+- key = 來源內容雜湊 + docling 版本 + 轉換選項 + 頁面範圍；任何一項改變才重新轉換
+- 保存 DoclingDocument 的結構化 JSON（gzip），不是 markdown：之後改變匯出方式也不需要重新轉換
+- 來源雜湊以 stat（size / mtime）快取，重複使用時不需要讀取整個來源檔
+- DOCLING_PAGE_BATCH > 0 時 PDF 依頁面範圍分批轉換、各自快取：中斷後從未完成的範圍繼續
+
+只調整 chunking / embedding 參數時，重建索引直接由快取取得文件，不再執行 docling。
+"""
+import gzip
+import hashlib
+import json
+import os
+import time
+from importlib import metadata
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from docling.document_converter import DocumentConverter
+
+from .index_manifest import hash_file
+
+CACHE_VERSION = 1
+PageRange = Tuple[int, int]
+
+_converter: Optional[DocumentConverter] = None
+
+
+def _docling_version() -> str:
+    try:
+        return metadata.version("docling")
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def converter_options() -> Dict[str, Any]:
+    """影響轉換結果的選項（DocumentConverter 預設的 PDF pipeline 選項；硬體 / 路徑相關的欄位不列入）"""
+    try:
+        from docling.datamodel.pipeline_options import PdfPipelineOptions
+        return PdfPipelineOptions().model_dump(
+            mode="json", exclude={"accelerator_options", "artifacts_path", "document_timeout"},
+        )
+    except Exception:
+        return {}
+
+
+def _get_converter() -> DocumentConverter:
+    # 模型載入很慢，同一個行程共用一個 converter
+    global _converter
+    if _converter is None:
+        _converter = DocumentConverter()
+    return _converter
+
+
+class ConversionCache:
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self) -> str:
+        """docling 版本 + 轉換選項"""
+        if self._fingerprint is None:
+            payload = json.dumps(
+                {"docling": _docling_version(), "options": converter_options(), "cache_version": CACHE_VERSION},
+                sort_keys=True, default=str,
+            )
+            self._fingerprint = hashlib.sha1(payload.encode()).hexdigest()[:12]
+        return self._fingerprint
+
+    # ---------- source hash ----------
+    def source_hash(self, file_path) -> str:
+        """來源內容雜湊；size 與 mtime 沒變時沿用上次的結果"""
+        path = Path(file_path).resolve()
+        st = os.stat(path)
+        key = hashlib.blake2b(str(path).encode(), digest_size=8).hexdigest()
+        stat_path = self.directory / "sources" / f"{key}.json"
+        try:
+            cached = json.loads(stat_path.read_text(encoding="utf-8"))
+            if cached["size"] == st.st_size and cached["mtime_ns"] == st.st_mtime_ns:
+                return cached["hash"]
+        except (OSError, ValueError, KeyError):
+            pass
+        digest = hash_file(path)
+        self._write(stat_path, json.dumps({"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": digest}).encode())
+        return digest
+
+    # ---------- entries ----------
+    def path_for(self, source_hash: str, page_range: Optional[PageRange]) -> Path:
+        pages = "all" if page_range is None else f"p{page_range[0]}-{page_range[1]}"
+        return self.directory / f"{source_hash[:32]}_{self.fingerprint}_{pages}.json.gz"
+
+    def _write(self, path: Path, data: bytes) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")   # 多個 worker 行程可能同時轉換同一份文件
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def _load(self, path: Path):
+        from docling_core.types.doc import DoclingDocument
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                return DoclingDocument.model_validate(json.load(f)["document"])
+        except Exception as e:
+            print(f"✗ 轉換快取讀取失敗，重新轉換 ({path.name}): {e}")
+            return None
+
+    def convert(self, file_path, page_range: Optional[PageRange] = None):
+        """回傳 DoclingDocument；有快取時不執行 docling"""
+        path = self.path_for(self.source_hash(file_path), page_range)
+        if path.exists():
+            document = self._load(path)
+            if document is not None:
+                print(f"轉換快取命中: {Path(file_path).name} {path.name}")
+                return document
+        start = time.perf_counter()
+        kwargs = {"page_range": page_range} if page_range is not None else {}
+        document = _get_converter().convert(str(file_path), **kwargs).document
+        seconds = time.perf_counter() - start
+        payload = {
+            "source": str(Path(file_path).resolve()),
+            "page_range": page_range,
+            "docling": _docling_version(),
+            "seconds": round(seconds, 3),
+            "document": document.export_to_dict(),
+        }
+        self._write(path, gzip.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"), compresslevel=6))
+        print(f"docling 轉換 {Path(file_path).name}（{page_range or '全部頁面'}）：{seconds:.1f} 秒，已快取")
+        return document
+
+    def page_ranges(self, file_path, batch: int) -> List[Optional[PageRange]]:
+        """PDF 依 batch 頁分段；其他格式或 batch <= 0 時整份轉換"""
+        if batch <= 0 or Path(file_path).suffix.lower() != ".pdf":
+            return [None]
+        import pypdfium2
+        pdf = pypdfium2.PdfDocument(str(file_path))
+        try:
+            n_pages = len(pdf)
+        finally:
+            pdf.close()
+        return [(start, min(start + batch - 1, n_pages)) for start in range(1, n_pages + 1, batch)] or [None]
+
+    def to_markdown(self, file_path, batch: int = 0) -> str:
+        return "\n\n".join(
+            self.convert(file_path, page_range).export_to_markdown()
+            for page_range in self.page_ranges(file_path, batch)
+        )
@@ -0,0 +1,146 @@
+"""
+Index manifest
+
+記錄向量索引是由哪個來源檔、哪些參數建立的，啟動時只需 stat 來源檔即可判斷快取是否有效：
+
+- size 與 mtime 都沒變 → 直接使用快取（不讀取來源檔）
+- size 或 mtime 改變 → 以串流方式重新計算雜湊；內容相同時只更新 manifest 的 mtime
+- embedding model / chunking 參數 / index type 不同 → 需要重建
+- 來源檔不存在（只部署索引快照的節點，見 snapshot.py）→ 沿用 manifest 記錄的索引
+"""
+import hashlib
+import json
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+MANIFEST_VERSION = 1
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def hash_file(path, block_size: int = HASH_BLOCK_SIZE) -> str:
+    """串流計算 blake2b，不會一次把整個檔案讀進記憶體"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _normalize(params: Dict[str, Any]) -> Dict[str, Any]:
+    return json.loads(json.dumps(params, sort_keys=True))
+
+
+def params_digest(params: Dict[str, Any]) -> str:
+    return hashlib.sha1(json.dumps(_normalize(params), sort_keys=True).encode()).hexdigest()[:8]
+
+
+@dataclass
+class IndexManifest:
+    source_path: str
+    source_size: int
+    source_mtime_ns: int
+    source_hash: str
+    params: Dict[str, Any] = field(default_factory=dict)   # embedding_model / chunking / index_type ...
+    dimension: int = 0
+    vector_count: int = 0
+    created_at: float = 0.0
+    manifest_version: int = MANIFEST_VERSION
+
+    @property
+    def params_digest(self) -> str:
+        return params_digest(self.params)
+
+    @property
+    def index_key(self) -> str:
+        """快取檔名前綴：來源內容 + 建立參數"""
+        return f"{self.source_hash[:32]}_{self.params_digest}"
+
+    @property
+    def version(self) -> str:
+        """索引版本；每次重建都會不同，供下游快取判斷失效"""
+        return f"{self.index_key}@{int(self.created_at)}"
+
+
+def manifest_path(source_path, cache_dir="cache") -> Path:
+    """manifest 以來源檔的絕對路徑命名（不需讀取來源內容）"""
+    key = hashlib.blake2b(str(Path(source_path).resolve()).encode(), digest_size=8).hexdigest()
+    return Path(cache_dir) / f"manifest_{key}.json"
+
+
+def load_manifest(source_path, cache_dir="cache") -> Optional[IndexManifest]:
+    path = manifest_path(source_path, cache_dir)
+    if not path.exists():
+        return None
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+        manifest = IndexManifest(**data)
+    except Exception as e:
+        print(f"✗ manifest 讀取失敗 ({path}): {e}")
+        return None
+    if manifest.manifest_version != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(manifest: IndexManifest, cache_dir="cache") -> Path:
+    path = manifest_path(manifest.source_path, cache_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(asdict(manifest), ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+    return path
+
+
+def source_unchanged(manifest: IndexManifest, source_path, cache_dir="cache") -> bool:
+    """stat 優先；只有 size / mtime 改變時才重新計算雜湊"""
+    if not os.path.exists(source_path):
+        print(f"ℹ️ 來源文件不存在，沿用已匯入的索引: {source_path}")
+        return True
+    st = os.stat(source_path)
+    if st.st_size == manifest.source_size and st.st_mtime_ns == manifest.source_mtime_ns:
+        return True
+    if st.st_size != manifest.source_size:
+        return False
+    if hash_file(source_path) != manifest.source_hash:
+        return False
+    # 內容相同只是被 touch：更新 mtime，下次啟動又可以只做 stat
+    manifest.source_mtime_ns = st.st_mtime_ns
+    save_manifest(manifest, cache_dir)
+    return True
+
+
+def validate_manifest(source_path, params: Dict[str, Any], cache_dir="cache") -> Optional[IndexManifest]:
+    """回傳仍然有效的 manifest；來源或參數改變時回傳 None"""
+    manifest = load_manifest(source_path, cache_dir)
+    if manifest is None:
+        return None
+    if manifest.params != _normalize(params):
+        print(f"ℹ️ 索引參數已改變，需要重建: {manifest.params} → {_normalize(params)}")
+        return None
+    if not source_unchanged(manifest, source_path, cache_dir):
+        print("ℹ️ 來源文件已改變，需要重建索引")
+        return None
+    return manifest
+
+
+def new_manifest(
+    source_path,
+    params: Dict[str, Any],
+    dimension: int = 0,
+    vector_count: int = 0,
+    source_hash: Optional[str] = None,
+) -> IndexManifest:
+    st = os.stat(source_path)
+    return IndexManifest(
+        source_path=str(Path(source_path).resolve()),
+        source_size=st.st_size,
+        source_mtime_ns=st.st_mtime_ns,
+        source_hash=source_hash or hash_file(source_path),
+        params=_normalize(params),
+        dimension=dimension,
+        vector_count=vector_count,
+        created_at=time.time(),
+    )
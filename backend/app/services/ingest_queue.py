@@ -0,0 +1,173 @@
+"""
+Ingestion job queue
+
+匯入工作保存在 sqlite（INGEST_DIR/jobs.sqlite3），服務重新啟動後仍在：
+
+- queued → running → done / failed；領取工作以 BEGIN IMMEDIATE 保證同一個工作只有一個執行緒處理
+- running 的工作記錄領取者（owner）與租約到期時間（lease_until），領取者定期 heartbeat 延長租約；
+  多個服務行程共用同一個佇列時，只有租約過期（領取者已停止）的工作會被放回 queued 或被其他行程接手，
+  由 ingestion 從最後的 checkpoint 繼續
+- 租約過期的領取者不再能更新工作（已被接手的工作不會被舊的結果覆蓋）
+- stage / done / total 記錄目前階段與進度，給 GET /ingest/{job_id} 與 SSE 進度串流
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          TEXT PRIMARY KEY,
+    kb          TEXT NOT NULL,
+    filename    TEXT NOT NULL,
+    path        TEXT NOT NULL,
+    size        INTEGER NOT NULL DEFAULT 0,
+    status      TEXT NOT NULL DEFAULT 'queued',
+    stage       TEXT,
+    done        INTEGER NOT NULL DEFAULT 0,
+    total       INTEGER NOT NULL DEFAULT 0,
+    chunks      INTEGER NOT NULL DEFAULT 0,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    error       TEXT,
+    created_at  REAL NOT NULL,
+    updated_at  REAL NOT NULL,
+    finished_at REAL,
+    owner       TEXT,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+"""
+# 舊版本建立的資料庫沒有租約欄位
+MIGRATIONS = {"owner": "ALTER TABLE jobs ADD COLUMN owner TEXT",
+              "lease_until": "ALTER TABLE jobs ADD COLUMN lease_until REAL"}
+
+UPDATABLE = {"status", "stage", "done", "total", "chunks", "error", "finished_at"}
+
+
+class JobStore:
+    def __init__(self, path, lease_seconds: float = 60.0, owner: Optional[str] = None):
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # autocommit；交易由 claim 明確開始
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for column, sql in MIGRATIONS.items():
+                if column not in columns:
+                    self._conn.execute(sql)
+
+    def _one(self, sql: str, args=()) -> Optional[Dict[str, Any]]:
+        row = self._conn.execute(sql, args).fetchone()
+        return dict(row) if row is not None else None
+
+    def create(self, job_id: str, kb: str, filename: str, path: str, size: int) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, kb, filename, path, size, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kb, filename, path, size, now, now),
+            )
+            return self._one("SELECT * FROM jobs WHERE id = ?", (job_id,))
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._one("SELECT * FROM jobs WHERE id = ?", (job_id,))
+
+    def list(self, limit: int = 50, kb: Optional[str] = None) -> List[Dict[str, Any]]:
+        sql, args = "SELECT * FROM jobs", []
+        if kb is not None:
+            sql, args = sql + " WHERE kb = ?", [kb]
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY created_at DESC LIMIT ?", (*args, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+    def count(self, status: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+    def update(self, job_id: str, **fields) -> bool:
+        """更新自己領取的工作；租約已過期、工作被其他行程接手時不更新並回傳 False"""
+        unknown = set(fields) - UPDATABLE
+        if unknown:
+            raise ValueError(f"不可更新的欄位: {', '.join(sorted(unknown))}")
+        fields["updated_at"] = time.time()
+        if fields.get("status") in ("done", "failed"):
+            fields.update(owner=None, lease_until=None)
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ? AND owner = ?", (*fields.values(), job_id, self.owner)
+            )
+            return cursor.rowcount > 0
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """
+        領取最早排入的工作並標記為 running（租約 lease_seconds 秒）；沒有工作時回傳 None
+
+        租約已過期的 running 工作（領取者停止 heartbeat）也可以被領取
+        """
+        with self._lock:
+            now = time.time()
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                job = self._one(
+                    "SELECT * FROM jobs WHERE status = 'queued' "
+                    "OR (status = 'running' AND (lease_until IS NULL OR lease_until < ?)) "
+                    "ORDER BY created_at LIMIT 1",
+                    (now,),
+                )
+                if job is not None:
+                    lease_until = now + self.lease_seconds
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', error = NULL, attempts = attempts + 1, "
+                        "owner = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+                        (self.owner, lease_until, now, job["id"]),
+                    )
+                    job.update(
+                        status="running", error=None, attempts=job["attempts"] + 1,
+                        owner=self.owner, lease_until=lease_until,
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return job
+
+    def heartbeat(self) -> int:
+        """延長自己領取的所有 running 工作的租約；回傳延長的工作數"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, self.owner),
+            )
+            return cursor.rowcount
+
+    def requeue_interrupted(self) -> int:
+        """租約已過期（領取的行程已停止）的 running 工作放回佇列；其他行程仍在處理的工作不受影響"""
+        with self._lock:
+            now = time.time()
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL, lease_until = NULL, updated_at = ? "
+                "WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?)",
+                (now, now),
+            )
+            return cursor.rowcount
+
+    def retry(self, job_id: str) -> bool:
+        """失敗的工作重新排入佇列（保留 checkpoint，從失敗的階段繼續）"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? WHERE id = ? AND status = 'failed'",
+                (time.time(), job_id),
+            )
+            return cursor.rowcount > 0
@@ -0,0 +1,229 @@
+"""
+Background ingestion
+
+POST /ingest 上傳的文件由背景工作處理，聊天服務的 event loop 不參與任何重運算：
+
+- 工作保存在 sqlite 佇列（ingest_queue），INGEST_WORKERS 個協調執行緒依序領取；
+  heartbeat 執行緒定期延長領取中工作的租約，共用佇列的其他服務行程不會接手仍在處理的工作
+- docling 轉換、切塊、embedding 都在獨立的 worker 行程（ProcessPoolExecutor，spawn）執行
+- 每個階段完成後在 INGEST_DIR/<job_id>/ 留下 checkpoint（document.md、chunks.json、embed_*.npy），
+  工作中斷（服務重新啟動、失敗後重試）時從最後的 checkpoint 繼續
+- embedding 階段同時計算 chunk 內各句的向量（context 壓縮用），查詢時不再呼叫 embedding 模型
+- 完成後發佈到知識庫的即時索引（rag_core.publish_documents），不需重新啟動
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from ..core.config import (
+    INGEST_DIR, INGEST_EMBED_BATCH, INGEST_LEASE_SECONDS, INGEST_WORKERS, RAG_COMPRESS_TOKENS, logger,
+)
+from ..core.metrics import registry
+from ..core.tracing import span, trace_root
+from . import rag_core
+from .compression import split_sentences
+from .ingest_queue import JobStore
+
+STAGES = ("convert", "chunk", "embed", "publish")
+
+_jobs = registry.counter("ingest_jobs_total", "Ingestion jobs finished, by outcome (done / failed)")
+_stage_seconds = registry.counter("ingest_stage_seconds_total", "Time spent in each ingestion stage")
+_queued = registry.gauge("ingest_jobs_queued", "Ingestion jobs waiting in the queue")
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+# ==================== Worker process ====================
+def _convert(source: str, target: str) -> int:
+    markdown = rag_core.load_and_convert_document(source)
+    if not markdown or not markdown.strip():
+        raise ValueError("文件轉換後沒有內容")
+    _write_atomic(Path(target), markdown.encode("utf-8"))
+    return len(markdown)
+
+
+def _chunk(markdown_path: str, filename: str, target: str) -> int:
+    chunks = rag_core.split_document(Path(markdown_path).read_text(encoding="utf-8"), filename)
+    payload = [{"text": c.page_content, "metadata": c.metadata} for c in chunks]
+    _write_atomic(Path(target), json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+    return len(chunks)
+
+
+def _embed(texts: List[str]) -> np.ndarray:
+    return np.asarray(rag_core.get_embeddings().embed_documents(texts), dtype=np.float32)
+
+
+# ==================== Coordinator (main process) ====================
+class IngestionService:
+    def __init__(self, directory: str, workers: int = 2, embed_batch: int = 64, lease_seconds: float = 60.0):
+        self.directory = Path(directory)
+        self.workers = max(1, workers)
+        self.embed_batch = max(1, embed_batch)
+        self.lease_seconds = lease_seconds
+        self.store: Optional[JobStore] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._wake = threading.Event()
+        self._on_published: Optional[Callable[[str], None]] = None
+
+    @property
+    def running(self) -> bool:
+        return self.store is not None
+
+    def start(self, on_published: Optional[Callable[[str], None]] = None) -> None:
+        """
+        開啟佇列、接續中斷的工作並啟動協調執行緒（只在服務行程中呼叫）
+
+        on_published(kb) 在每批文件發佈到知識庫後呼叫（RAG 尚未啟用時由此啟用）
+        """
+        if self.store is not None:
+            return
+        self._on_published = on_published
+        legacy = Path("cache/ingest")   # 舊版本的預設位置在公開的 cache/ 下：移到 INGEST_DIR
+        if legacy.is_dir() and not self.directory.exists() and legacy.resolve() != self.directory.resolve():
+            self.directory.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(legacy), str(self.directory))
+            logger.info(f"匯入工作目錄已由 {legacy} 移到 {self.directory}")
+        self.store = JobStore(self.directory / "jobs.sqlite3", lease_seconds=self.lease_seconds)
+        resumed = self.store.requeue_interrupted()
+        if resumed:
+            logger.info(f"接續 {resumed} 個中斷的匯入工作")
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        _queued.set_function(lambda: self.store.count("queued"))
+        threading.Thread(target=self._heartbeat, name="ingest-heartbeat", daemon=True).start()
+        for i in range(self.workers):
+            threading.Thread(target=self._loop, name=f"ingest-{i}", daemon=True).start()
+
+    # ---------- jobs ----------
+    def job_dir(self, job_id: str) -> Path:
+        return self.directory / job_id
+
+    def upload_path(self, job_id: str, filename: str) -> Path:
+        directory = self.job_dir(job_id)
+        directory.mkdir(parents=True, exist_ok=True)
+        return directory / f"source{Path(filename).suffix.lower()}"
+
+    def discard(self, job_id: str) -> None:
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+    def submit(self, job_id: str, kb: str, filename: str, path: Path) -> Dict[str, Any]:
+        job = self.store.create(job_id, kb, filename, str(path), path.stat().st_size)
+        self._wake.set()
+        return job
+
+    def retry(self, job_id: str) -> bool:
+        if not self.store.retry(job_id):
+            return False
+        self._wake.set()
+        return True
+
+    # ---------- processing ----------
+    def _loop(self) -> None:
+        while True:
+            job = self.store.claim()
+            if job is None:
+                self._wake.wait(timeout=1.0)
+                self._wake.clear()
+                continue
+            self._run(job)
+
+    def _heartbeat(self) -> None:
+        # 租約期間內至少延長兩次，單次 sqlite 忙碌不會讓租約過期
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            try:
+                self.store.heartbeat()
+            except Exception as e:
+                logger.warning(f"匯入工作租約延長失敗: {e}")
+
+    def _stage(self, job_id: str, stage: str, **fields) -> None:
+        self.store.update(job_id, stage=stage, **fields)
+
+    def _in_pool(self, job_id: str, stage: str, fn, *args):
+        self._stage(job_id, stage)
+        start = time.perf_counter()
+        with span(f"ingest.{stage}"):
+            result = self._pool.submit(fn, *args).result()
+        _stage_seconds.inc(time.perf_counter() - start, stage=stage)
+        return result
+
+    def _run(self, job: Dict[str, Any]) -> None:
+        job_id = job["id"]
+        directory = self.job_dir(job_id)
+        logger.info(f"匯入工作 {job_id}：{job['filename']} → 知識庫 {job['kb']}（第 {job['attempts']} 次）")
+        try:
+            with trace_root("ingest", job_id=job_id, kb=job["kb"], attempt=job["attempts"]):
+                markdown = directory / "document.md"
+                if not markdown.exists():
+                    self._in_pool(job_id, "convert", _convert, job["path"], str(markdown))
+                chunks_path = directory / "chunks.json"
+                if not chunks_path.exists():
+                    self._in_pool(job_id, "chunk", _chunk, str(markdown), job["filename"], str(chunks_path))
+                chunks = json.loads(chunks_path.read_text(encoding="utf-8"))
+                if not chunks:
+                    raise ValueError("文件沒有可匯入的內容")
+                texts = [c["text"] for c in chunks]
+                # chunk 在前、句子在後一起分批
+                sentences = split_sentences(texts)[2] if RAG_COMPRESS_TOKENS > 0 else []
+                embedded = self._embed(job_id, directory, texts + sentences)
+                vectors, sentence_vectors = embedded[:len(texts)], (embedded[len(texts):] if sentences else None)
+                self._stage(job_id, "publish")
+                start = time.perf_counter()
+                with span("ingest.publish"):
+                    rag_core.publish_documents(
+                        job["kb"], job_id, texts, [c["metadata"] for c in chunks], vectors, sentence_vectors,
+                    )
+                _stage_seconds.inc(time.perf_counter() - start, stage="publish")
+                if self._on_published is not None:
+                    self._on_published(job["kb"])
+            if not self.store.update(job_id, status="done", stage=None, chunks=len(chunks), finished_at=time.time()):
+                logger.warning(f"匯入工作 {job_id} 的租約已過期，已由其他行程接手")
+            _jobs.inc(outcome="done")
+            logger.info(f"✓ 匯入工作 {job_id} 完成：{len(chunks)} 個 chunk")
+        except Exception as e:
+            self.store.update(job_id, status="failed", error=str(e) or type(e).__name__, finished_at=time.time())
+            _jobs.inc(outcome="failed")
+            logger.error(f"✗ 匯入工作 {job_id} 失敗: {e}")
+
+    def _embed(self, job_id: str, directory: Path, texts: List[str]) -> np.ndarray:
+        """每批 embedding 各存一個 checkpoint；已完成的批次不重算，其餘批次在 worker 行程中平行處理"""
+        batches = {start: directory / f"embed_{start:06d}.npy" for start in range(0, len(texts), self.embed_batch)}
+        for s, path in batches.items():
+            # 列數不符的 checkpoint（例如以不同的句子設定計算）重新計算
+            if path.exists() and len(np.load(path, mmap_mode="r")) != min(self.embed_batch, len(texts) - s):
+                path.unlink()
+        done = sum(min(self.embed_batch, len(texts) - s) for s, p in batches.items() if p.exists())
+        self._stage(job_id, "embed", done=done, total=len(texts))
+        start_time = time.perf_counter()
+        with span("ingest.embed", chunks=len(texts), resumed=done):
+            futures = {
+                self._pool.submit(_embed, texts[s:s + self.embed_batch]): path
+                for s, path in batches.items() if not path.exists()
+            }
+            for future in as_completed(futures):
+                vectors = future.result()
+                path = futures[future]
+                tmp = path.with_suffix(".tmp")
+                with open(tmp, "wb") as f:
+                    np.save(f, vectors)
+                os.replace(tmp, path)
+                done += len(vectors)
+                self.store.update(job_id, done=done)
+        _stage_seconds.inc(time.perf_counter() - start_time, stage="embed")
+        return np.concatenate([np.load(batches[s]) for s in sorted(batches)])
+
+
+ingestion = IngestionService(
+    INGEST_DIR, workers=INGEST_WORKERS, embed_batch=INGEST_EMBED_BATCH, lease_seconds=INGEST_LEASE_SECONDS,
+)
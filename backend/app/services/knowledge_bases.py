@@ -0,0 +1,199 @@
+"""
+Knowledge base registry
+
+同一個部署服務多個具名知識庫（各產品線一份文件 / 一個索引）：
+
+- 知識庫在第一次被查詢時才載入（loader 由 rag_core 提供：讀取或重建索引）
+- 常駐記憶體總量超過 RAG_KB_MEMORY_MB 時，依最久未使用（LRU）卸載其他知識庫；
+  預設知識庫與 pinned（熱門）知識庫不會因預算被卸載，pinned 可在設定檔（RAG_KB_PINNED）或 /admin/kb 調整
+- 載入 / 卸載事件、載入耗時與每個知識庫的常駐狀態與記憶體用量都輸出到 /metrics
+"""
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List
+
+from ..core.config import logger
+from ..core.metrics import registry
+
+_loads = registry.counter("rag_kb_loads_total", "Knowledge base loads by outcome (ok / error)")
+_load_seconds = registry.counter("rag_kb_load_seconds_total", "Time spent loading knowledge bases")
+_evictions = registry.counter("rag_kb_evictions_total", "Knowledge bases unloaded, by reason (budget / manual / reload)")
+_resident = registry.gauge("rag_kb_resident", "1 when the knowledge base is loaded in memory")
+_memory = registry.gauge("rag_kb_memory_bytes", "Estimated resident memory of each loaded knowledge base")
+_budget = registry.gauge("rag_kb_memory_budget_bytes", "Memory budget shared by all knowledge bases")
+
+
+class UnknownKnowledgeBaseError(LookupError):
+    pass
+
+
+class KnowledgeBase:
+    def __init__(self, name: str, source: str, pinned: bool = False):
+        self.name = name
+        self.source = source
+        self.pinned = pinned
+        self.index: Any = None           # loader 的回傳值；None 表示未載入
+        self.memory_bytes = 0
+        self.last_used = 0.0
+        self.loaded_at = 0.0
+        self.load_seconds = 0.0
+        self.lock = threading.Lock()     # 同一個知識庫同時只載入一次
+
+    @property
+    def resident(self) -> bool:
+        return self.index is not None
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "source": self.source,
+            "pinned": self.pinned,
+            "resident": self.resident,
+            "memory_bytes": self.memory_bytes,
+            "last_used": self.last_used or None,
+            "load_seconds": round(self.load_seconds, 3),
+        }
+
+
+class KnowledgeBaseRegistry:
+    def __init__(
+        self,
+        loader: Callable[[str, bool], Any],
+        budget_bytes: int,
+        size_of: Callable[[Any], int],
+        default: str = "",
+    ):
+        self.loader = loader             # loader(source, force_reload) -> 已載入的索引（失敗時 None）
+        self.size_of = size_of
+        self.budget_bytes = budget_bytes
+        self.default = default           # 預設知識庫：readiness 依賴它常駐，不因預算卸載
+        self._kbs: "OrderedDict[str, KnowledgeBase]" = OrderedDict()   # 依最近使用排序（LRU 在最前）
+        self._lock = threading.Lock()
+        _budget.set(budget_bytes)
+
+    def register(self, name: str, source: str, pinned: bool = False) -> KnowledgeBase:
+        with self._lock:
+            kb = self._kbs.get(name)
+            if kb is None:
+                kb = self._kbs[name] = KnowledgeBase(name, str(source), pinned)
+                self._kbs.move_to_end(name, last=False)
+                _resident.set_function(lambda kb=kb: int(kb.resident), kb=name)
+                _memory.set_function(lambda kb=kb: kb.memory_bytes, kb=name)
+            elif kb.source != str(source):
+                raise ValueError(f"知識庫 {name} 已對應到 {kb.source}")
+            kb.pinned = kb.pinned or pinned
+            return kb
+
+    def names(self) -> List[str]:
+        return sorted(self._kbs)
+
+    def _entry(self, name: str) -> KnowledgeBase:
+        kb = self._kbs.get(name)
+        if kb is None:
+            raise UnknownKnowledgeBaseError(f"未知的知識庫: {name}")
+        return kb
+
+    def source_of(self, name: str) -> str:
+        return self._entry(name).source
+
+    def peek(self, name: str) -> Any:
+        """已載入時回傳索引，不觸發載入也不影響 LRU 順序"""
+        kb = self._kbs.get(name)
+        return kb.index if kb is not None else None
+
+    def get(self, name: str, reload: bool = False) -> Any:
+        """取得知識庫索引；未載入時同步載入（呼叫端應在執行緒中呼叫）"""
+        kb = self._entry(name)
+        index = kb.index
+        if index is None or reload:
+            with kb.lock:
+                index = kb.index
+                if index is None or reload:
+                    index = self._load(kb, reload)
+        with self._lock:
+            kb.last_used = time.time()
+            self._kbs.move_to_end(name)
+        return index
+
+    def _load(self, kb: KnowledgeBase, reload: bool) -> Any:
+        if reload and kb.index is not None:
+            self._unload(kb, "reload")
+        logger.info(f"載入知識庫 {kb.name}（{kb.source}）")
+        start = time.perf_counter()
+        try:
+            index = self.loader(kb.source, reload)
+        except Exception:
+            _loads.inc(kb=kb.name, outcome="error")
+            raise
+        elapsed = time.perf_counter() - start
+        if index is None:
+            _loads.inc(kb=kb.name, outcome="error")
+            raise RuntimeError(f"知識庫 {kb.name} 載入失敗（{kb.source}）")
+        kb.memory_bytes = self.size_of(index)
+        kb.load_seconds = elapsed
+        kb.loaded_at = time.time()
+        kb.index = index
+        _loads.inc(kb=kb.name, outcome="ok")
+        _load_seconds.inc(elapsed, kb=kb.name)
+        logger.info(f"✓ 知識庫 {kb.name} 已載入：{kb.memory_bytes / 1024 / 1024:.1f} MB，{elapsed:.2f} 秒")
+        self._enforce_budget(keep=kb.name)
+        return index
+
+    def _unload(self, kb: KnowledgeBase, reason: str) -> None:
+        # 進行中的查詢仍持有索引的參照，完成後才會真正釋放；索引的外部資源（shard 行程）
+        # 也等到最後一個參照釋放、索引被回收時才關閉，不會在查詢途中停止
+        index, kb.index = kb.index, None
+        closer = getattr(index, "closer", None)
+        close = closer() if closer is not None else None
+        if close is not None:
+            weakref.finalize(index, close)
+        kb.memory_bytes = 0
+        _evictions.inc(kb=kb.name, reason=reason)
+        logger.info(f"卸載知識庫 {kb.name}（{reason}）")
+
+    def _enforce_budget(self, keep: str) -> None:
+        with self._lock:
+            used = sum(kb.memory_bytes for kb in self._kbs.values())
+            for kb in list(self._kbs.values()):            # 最久未使用的在前
+                if used <= self.budget_bytes:
+                    return
+                if kb.name in (keep, self.default) or kb.pinned or not kb.resident:
+                    continue
+                used -= kb.memory_bytes
+                self._unload(kb, "budget")
+        if used > self.budget_bytes:
+            logger.warning(
+                f"知識庫常駐記憶體 {used / 1024 / 1024:.1f} MB 超過預算 "
+                f"{self.budget_bytes / 1024 / 1024:.1f} MB（其餘皆為預設、pinned 或正在使用）"
+            )
+
+    def resize(self, name: str) -> None:
+        """索引內容改變（發佈新文件）後重新估計記憶體用量"""
+        kb = self._entry(name)
+        index = kb.index
+        if index is not None:
+            kb.memory_bytes = self.size_of(index)
+            self._enforce_budget(keep=name)
+
+    def evict(self, name: str) -> bool:
+        kb = self._entry(name)
+        with kb.lock:
+            if kb.index is None:
+                return False
+            self._unload(kb, "manual")
+            return True
+
+    def pin(self, name: str, pinned: bool = True) -> KnowledgeBase:
+        kb = self._entry(name)
+        kb.pinned = pinned
+        return kb
+
+    def status(self) -> Dict[str, Any]:
+        kbs = [kb.status() for kb in self._kbs.values()]
+        return {
+            "budget_bytes": self.budget_bytes,
+            "used_bytes": sum(kb["memory_bytes"] for kb in kbs),
+            "knowledge_bases": sorted(kbs, key=lambda kb: kb["name"]),
+        }
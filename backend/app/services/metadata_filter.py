@@ -0,0 +1,161 @@
+"""
+Metadata filter bitmaps
+
+建立索引時，為每個 metadata 欄位值建立一張 faiss id bitmap：
+
+- source      ：來源檔名
+- header_path ：Header 1 > Header 2 > Header 3；每一層前綴都有一張 bitmap，篩選章節即包含其下所有小節
+- doc_type    ：副檔名（pdf / md ...）
+- ingested_at ：匯入日期（YYYY-MM-DD），以日期區間篩選
+
+查詢時把條件合成一張 bitmap（同欄位 OR、不同欄位 AND），以 faiss.IDSelectorBitmap 在索引掃描時
+直接略過範圍外的向量，不需要加大 k 再於 Python 端過濾。bitmap 以 .npz 存在索引旁（不使用 pickle）。
+"""
+import json
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+FILTER_FIELDS = ("source", "header_path", "doc_type", "ingested_at")
+HEADER_KEYS = ("Header 1", "Header 2", "Header 3")
+HEADER_SEP = " > "
+
+
+def _norm(value) -> str:
+    return " ".join(str(value).split()).lower()
+
+
+def header_path(metadata: Dict) -> List[str]:
+    """metadata 的 header 階層；Header 1 > Header 2 > Header 3"""
+    return [str(metadata[k]).strip() for k in HEADER_KEYS if metadata.get(k)]
+
+
+def _field_values(metadata: Dict) -> Iterable[Tuple[str, str]]:
+    for name in ("source", "doc_type", "ingested_at"):
+        value = metadata.get(name)
+        if value:
+            yield name, _norm(value)
+    headers = header_path(metadata)
+    for depth in range(1, len(headers) + 1):
+        yield "header_path", _norm(HEADER_SEP.join(headers[:depth]))
+
+
+@dataclass
+class SearchFilters:
+    """檢索範圍；空的條件代表不限制"""
+    source: List[str] = field(default_factory=list)
+    header_path: List[str] = field(default_factory=list)   # 章節前綴，例如 "第 3 章 > 3.2 計時器"
+    doc_type: List[str] = field(default_factory=list)
+    ingested_from: Optional[str] = None                     # YYYY-MM-DD（含）
+    ingested_to: Optional[str] = None
+
+    def is_empty(self) -> bool:
+        return not (self.source or self.header_path or self.doc_type or self.ingested_from or self.ingested_to)
+
+    def cache_key(self) -> Tuple:
+        """正規化後可雜湊的表示，作為快取 key 的一部分"""
+        return (
+            tuple(sorted(_norm(v) for v in self.source)),
+            tuple(sorted(_norm(v) for v in self.header_path)),
+            tuple(sorted(_norm(v) for v in self.doc_type)),
+            self.ingested_from or "",
+            self.ingested_to or "",
+        )
+
+
+class MetadataIndex:
+    """(欄位, 值) → packed bitmap（bit i 對應 faiss id i，little-endian bit order，與 IDSelectorBitmap 相同）"""
+
+    def __init__(self, size: int = 0):
+        self.size = size
+        self._bitmaps: Dict[Tuple[str, str], np.ndarray] = {}
+
+    @property
+    def nbytes(self) -> int:
+        return (self.size + 7) // 8
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(b.nbytes for b in self._bitmaps.values())
+
+    @classmethod
+    def build(cls, metadatas: Sequence[Dict]) -> "MetadataIndex":
+        """metadatas 依 faiss id 排序"""
+        ids: Dict[Tuple[str, str], List[int]] = {}
+        for i, md in enumerate(metadatas):
+            for key in _field_values(md or {}):
+                ids.setdefault(key, []).append(i)
+        index = cls(len(metadatas))
+        for key, members in ids.items():
+            bits = np.zeros(index.size, dtype=bool)
+            bits[members] = True
+            index._bitmaps[key] = np.packbits(bits, bitorder="little")
+        return index
+
+    def add(self, faiss_id: int, metadata: Dict) -> None:
+        """之後新增到索引的向量（id 必須接續現有範圍）"""
+        if faiss_id >= self.size:
+            self.size = faiss_id + 1
+            for key, bitmap in self._bitmaps.items():
+                if len(bitmap) < self.nbytes:
+                    self._bitmaps[key] = np.concatenate([bitmap, np.zeros(self.nbytes - len(bitmap), np.uint8)])
+        for key in _field_values(metadata or {}):
+            bitmap = self._bitmaps.get(key)
+            if bitmap is None:
+                bitmap = self._bitmaps[key] = np.zeros(self.nbytes, dtype=np.uint8)
+            bitmap[faiss_id >> 3] |= np.uint8(1 << (faiss_id & 7))
+
+    def values(self, name: str) -> List[str]:
+        """某欄位所有可用的值（給 UI 產生篩選選項）"""
+        return sorted(v for f, v in self._bitmaps if f == name)
+
+    def _any_of(self, name: str, values: Iterable[str]) -> np.ndarray:
+        found = [self._bitmaps[(name, _norm(v))] for v in values if (name, _norm(v)) in self._bitmaps]
+        if not found:
+            return np.zeros(self.nbytes, dtype=np.uint8)
+        return np.bitwise_or.reduce(found) if len(found) > 1 else found[0]
+
+    def select(self, filters: Optional[SearchFilters]) -> Optional[np.ndarray]:
+        """合成查詢用的 bitmap；沒有條件時回傳 None（不套用 selector）"""
+        if filters is None or filters.is_empty():
+            return None
+        parts: List[np.ndarray] = []
+        if filters.source:
+            parts.append(self._any_of("source", filters.source))
+        if filters.header_path:
+            parts.append(self._any_of("header_path", filters.header_path))
+        if filters.doc_type:
+            parts.append(self._any_of("doc_type", filters.doc_type))
+        if filters.ingested_from or filters.ingested_to:
+            lo, hi = filters.ingested_from or "", filters.ingested_to or "9999-12-31"
+            parts.append(self._any_of("ingested_at", [d for d in self.values("ingested_at") if lo <= d <= hi]))
+        return np.bitwise_and.reduce(parts) if len(parts) > 1 else parts[0].copy()
+
+    # ---------- persistence ----------
+    def save(self, path) -> Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        keys = list(self._bitmaps)
+        bitmaps = np.stack([self._bitmaps[k] for k in keys]) if keys else np.zeros((0, self.nbytes), np.uint8)
+        tmp = path.with_name(path.stem + ".tmp.npz")
+        np.savez(tmp, size=np.int64(self.size), keys=np.array(json.dumps(keys, ensure_ascii=False)), bitmaps=bitmaps)
+        tmp.replace(path)
+        return path
+
+    @classmethod
+    def load(cls, path) -> Optional["MetadataIndex"]:
+        path = Path(path)
+        if not path.exists():
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                index = cls(int(data["size"]))
+                keys = json.loads(str(data["keys"]))
+                for key, bitmap in zip(keys, data["bitmaps"]):
+                    index._bitmaps[tuple(key)] = bitmap.copy()
+        except Exception as e:
+            print(f"✗ metadata bitmap 讀取失敗 ({path}): {e}")
+            return None
+        return index
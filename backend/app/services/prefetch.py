@@ -0,0 +1,145 @@
+"""
+Retrieval prefetch
+
+前端在使用者輸入時送出未完成的問題（POST /prefetch），後端以 prefetch_id 為單位：
+
+- debounce：同一個 prefetch_id 在 RAG_PREFETCH_DEBOUNCE_MS 內的新輸入會取消前一次排程，只檢索最後的版本
+- 檢索在背景執行緒執行，同時寫入 retrieval_cache 的 embedding / 結果快取
+- 結果以 prefetch_id 保存（LRU + TTL）；送出問題時若最終問題與預取的問題足夠相似
+  （正規化後 SequenceMatcher ratio ≥ RAG_PREFETCH_MATCH）、知識庫、篩選條件與索引版本相同，直接沿用預取的 context；
+  預取已開始檢索時等待它完成（而不是再檢索一次）；還在 debounce 等待中則取消，由呼叫端立即檢索
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from difflib import SequenceMatcher
+from typing import Callable, Hashable, List, Optional, Tuple
+
+from ..core.config import logger
+from ..core.metrics import registry
+from ..core.tracing import detach_trace
+from .retrieval_cache import normalize_query
+
+_prefetch_total = registry.counter("rag_prefetch_total", "Prefetch requests by outcome")
+_prefetch_reuse = registry.counter("rag_prefetch_reuse_total", "Chat retrievals served from a prefetch (hit / miss)")
+
+Retrieved = Tuple[str, List[str]]   # (ctx, sources)
+
+
+@dataclass
+class _Entry:
+    question: str
+    normalized: str
+    filters_key: Hashable
+    version: Optional[str]
+    kb: Optional[str] = None
+    created: float = field(default_factory=time.monotonic)
+    task: Optional[asyncio.Task] = None
+    started: bool = False
+    result: Optional[Retrieved] = None
+
+
+def similarity(a: str, b: str) -> float:
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+
+class Prefetcher:
+    def __init__(
+        self,
+        retrieve: Callable[..., Retrieved],
+        debounce_ms: float = 300,
+        ttl: float = 120.0,
+        max_entries: int = 1000,
+        match_threshold: float = 0.9,
+        min_chars: int = 4,
+    ):
+        self.retrieve = retrieve            # retrieve_context(question, filters=..., kb=...)
+        self.debounce = debounce_ms / 1000
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.match_threshold = match_threshold
+        self.min_chars = min_chars
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+
+    def submit(
+        self, prefetch_id: str, question: str, filters=None, version: Optional[str] = None, kb: Optional[str] = None,
+    ) -> str:
+        """排程（或重新排程）預取；回傳 scheduled / unchanged / too_short"""
+        normalized = normalize_query(question)
+        if len(normalized) < self.min_chars:
+            _prefetch_total.inc(outcome="too_short")
+            return "too_short"
+        filters_key = filters.cache_key() if filters is not None else None
+
+        prev = self._entries.get(prefetch_id)
+        if prev is not None and (prev.normalized, prev.filters_key, prev.version, prev.kb) == (normalized, filters_key, version, kb):
+            _prefetch_total.inc(outcome="unchanged")
+            return "unchanged"
+        if prev is not None and prev.task is not None and not prev.task.done():
+            prev.task.cancel()  # 只有還在 debounce 等待中的會真的停止；已開始的檢索仍會完成並寫入快取
+
+        entry = _Entry(question, normalized, filters_key, version, kb)
+        entry.task = asyncio.create_task(self._run(entry, filters))
+        self._entries[prefetch_id] = entry
+        self._entries.move_to_end(prefetch_id)
+        self._evict()
+        _prefetch_total.inc(outcome="scheduled")
+        return "scheduled"
+
+    async def _run(self, entry: _Entry, filters) -> Optional[Retrieved]:
+        detach_trace()  # 背景工作不屬於送出 /prefetch 的那個 request trace
+        await asyncio.sleep(self.debounce)
+        entry.started = True
+        try:
+            entry.result = await asyncio.to_thread(self.retrieve, entry.question, filters=filters, kb=entry.kb)
+        except Exception as e:
+            logger.warning(f"預取檢索失敗: {e}")
+            _prefetch_total.inc(outcome="error")
+        return entry.result
+
+    async def take(
+        self, prefetch_id: str, question: str, filters=None, version: Optional[str] = None, kb: Optional[str] = None,
+    ) -> Optional[Retrieved]:
+        """
+        送出問題時呼叫：預取結果可用時回傳 (ctx, sources)，否則回傳 None（由呼叫端正常檢索）
+
+        每個 prefetch_id 只使用一次。
+        """
+        entry = self._entries.pop(prefetch_id, None)
+        if entry is None or time.monotonic() - entry.created > self.ttl:
+            _prefetch_reuse.inc(result="miss")
+            return None
+        filters_key = filters.cache_key() if filters is not None else None
+        if (entry.filters_key, entry.version, entry.kb) != (filters_key, version, kb) \
+                or similarity(entry.normalized, normalize_query(question)) < self.match_threshold:
+            _prefetch_reuse.inc(result="miss")
+            return None
+
+        result = entry.result
+        if result is None and entry.task is not None:
+            if not entry.started:
+                entry.task.cancel()
+            else:
+                try:
+                    result = await asyncio.shield(entry.task)
+                except asyncio.CancelledError:
+                    if not entry.task.cancelled():
+                        raise  # 是呼叫端自己被取消
+                    result = None
+                except Exception:
+                    result = None
+        _prefetch_reuse.inc(result="hit" if result is not None else "miss")
+        return result
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._entries:
+            key, oldest = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and now - oldest.created <= self.ttl:
+                break
+            self._entries.pop(key)
+            if oldest.task is not None and not oldest.task.done():
+                oldest.task.cancel()
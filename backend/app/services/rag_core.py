@@ -4,13 +4,13 @@ from pathlib import Path
 from langchain_community.vectorstores import FAISS
 from langchain_ollama import OllamaEmbeddings, ChatOllama
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.documents import Document
 import warnings
 warnings.filterwarnings("ignore")
 
 from dotenv import load_dotenv
-from docling.document_converter import DocumentConverter
 from langchain_text_splitters import MarkdownHeaderTextSplitter
 from langchain_ollama import OllamaEmbeddings
 import faiss
@@ -18,27 +18,128 @@ from langchain_community.docstore.in_memory import InMemoryDocstore
 # from langchain import hub
 
 import sys
+import copy
 import hashlib
+import shutil
+import json
+import threading
+import time
+import uuid
 import openai
-from typing import List, Tuple
-
-# 全局變量存儲 RAG 鏈
-rag_chain = None
-retriever = None
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Any, Callable, List, Optional, Tuple
+
+import numpy as np
+
+from ..core.metrics import registry
+from ..core.tracing import current_span, span
+from ..core.config import (
+    RAG_CHUNK_MAX_TOKENS, RAG_CHUNK_OVERLAP_TOKENS, RAG_DEDUP_THRESHOLD, RAG_EMBED_MODEL, OLLAMA_BASE_URL,
+    RAG_VECTOR_STORAGE, RAG_PQ_M, RAG_PQ_NBITS, RAG_RERANK_CANDIDATES, RAG_SHARDS, RAG_SHARD_THREADS,
+    RAG_EMBED_CACHE_MB, RAG_EMBED_CACHE_TTL, RAG_RESULT_CACHE_SIZE, RAG_RESULT_CACHE_TTL,
+    RAG_DEFAULT_KB, RAG_KB_MEMORY_MB, RAG_COMPRESS_TOKENS, RAG_COMPRESS_NEIGHBORS,
+    DOCLING_CACHE_DIR, DOCLING_PAGE_BATCH, INGEST_PUBLISHED_DIR,
+)
+from . import vector_storage
+from .chunking import build_chunks, estimate_tokens
+from .compression import SentenceIndex
+from .conversion_cache import ConversionCache
+from .index_manifest import IndexManifest, new_manifest, params_digest, save_manifest, validate_manifest
+from .knowledge_bases import KnowledgeBaseRegistry
+from .metadata_filter import FILTER_FIELDS, MetadataIndex, SearchFilters
+from .retrieval_cache import RetrievalCache
+from .sharding import ShardedIndex
+from .snapshot import ArrowDocstore, read_vector_store, write_vector_store
+
+
+@dataclass
+class KnowledgeIndex:
+    """一個知識庫載入後的狀態"""
+    vector_store: FAISS
+    manifest: IndexManifest               # 索引的 IndexManifest（version 供快取判斷）
+    full_vectors: Optional[np.ndarray]    # 壓縮模式下的 float32 原始向量（磁碟 memmap，供精確重排）
+    metadata_index: MetadataIndex         # metadata 欄位值 → faiss id bitmap（篩選檢索範圍）
+    retriever: Any
+    rag_chain: Any
+    shards: Optional[ShardedIndex] = None  # RAG_SHARDS > 1 時向量在 shard 行程中，主行程的 faiss 索引為空
+    sentences: Optional[SentenceIndex] = None  # 句子位置與向量（context 壓縮）；RAG_COMPRESS_TOKENS=0 時為 None
+    revision: int = 0                      # 建立後發佈（/ingest）進來的批次數
+    write_lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def version(self) -> str:
+        """索引版本（重建或發佈新文件後都會不同），供檢索快取判斷失效"""
+        return self.manifest.version if not self.revision else f"{self.manifest.version}+{self.revision}"
+
+    @property
+    def ntotal(self) -> int:
+        """向量數（分片時為各 shard 的總和）"""
+        return self.shards.ntotal if self.shards is not None else self.vector_store.index.ntotal
+
+    def memory_bytes(self) -> int:
+        """常駐記憶體估計：faiss 索引（含 shard 行程）+ docstore 文字 + metadata bitmap（memmap 的原始向量不計）"""
+        docstore = self.vector_store.docstore
+        text_bytes = sum(sys.getsizeof(d.page_content) + sys.getsizeof(d.metadata) + 512 for d in docstore._dict.values())
+        if isinstance(docstore, ArrowDocstore):
+            text_bytes += docstore.nbytes
+        index_bytes = vector_storage.resident_bytes(self.vector_store.index)
+        if self.shards is not None:
+            index_bytes += self.shards.memory_bytes()
+        if self.sentences is not None:
+            index_bytes += self.sentences.memory_bytes()
+        return index_bytes + text_bytes + self.metadata_index.memory_bytes
+
+    def close(self) -> None:
+        """停止 shard 行程"""
+        if self.shards is not None:
+            self.shards.close()
+
+    def closer(self) -> Optional[Callable[[], None]]:
+        """不持有索引本身的 close（知識庫卸載時以 weakref.finalize 延後到索引被回收才執行）"""
+        return self.shards.close if self.shards is not None else None
+
+
+retrieval_cache = RetrievalCache(  # 查詢向量 / 檢索結果兩層快取，結果以索引版本區分
+    embedding_max_bytes=RAG_EMBED_CACHE_MB << 20,
+    embedding_ttl=RAG_EMBED_CACHE_TTL,
+    result_max_entries=RAG_RESULT_CACHE_SIZE,
+    result_ttl=RAG_RESULT_CACHE_TTL,
+)
+_cache_keys = {}        # 來源文件 → 緩存檔名前綴（由 index manifest 決定）
+conversion_cache = ConversionCache(DOCLING_CACHE_DIR)  # docling 轉換結果，與向量快取分開（改 chunking / embedding 不需重新轉換）
+_context_tokens = registry.counter(
+    "rag_context_tokens_total", "Estimated context tokens before (retrieved) and after (compressed) compression",
+)
 
 # Environment setup
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'True' # 允許重複加載相同的庫文件
 warnings.filterwarnings("ignore") # 忽略所有 Python 警告訊息
 load_dotenv() # 從 .env 文件加載環境變數到系統環境中
 
+def get_embeddings():
+    return OllamaEmbeddings(model=RAG_EMBED_MODEL, base_url=OLLAMA_BASE_URL)
+
+def get_index_params():
+    """會影響索引內容的參數；任何一項改變都需要重建（記錄在 index manifest 中）"""
+    return {
+        "embedding_model": RAG_EMBED_MODEL,
+        "chunk_max_tokens": RAG_CHUNK_MAX_TOKENS,
+        "chunk_overlap_tokens": RAG_CHUNK_OVERLAP_TOKENS,
+        "dedup_threshold": RAG_DEDUP_THRESHOLD,
+        "index_type": vector_storage.index_type(RAG_VECTOR_STORAGE, RAG_PQ_M, RAG_PQ_NBITS),
+        "metadata_fields": list(FILTER_FIELDS),
+    }
+
 # Terry .....................
 def get_cache_path(file_path, suffix):
-    print("get_cache_path ...... 生成基於文件內容的緩存路徑")
-    # 使用文件路徑和內容生成唯一哈希值
-    # file_hash = hashlib.md5(Path(file_path).read_bytes()).hexdigest()
-    file_path_1 = "D:/Build_RAG_Locally/DIADesigner-ST-CODE.pdf"
-    file_hash = hashlib.md5(Path(file_path_1).read_bytes()).hexdigest()
-    return f"cache/{file_hash}_{suffix}.pkl"
+    print("get_cache_path ...... 由 index manifest 取得緩存路徑")
+    # 同一個來源只解析一次；有 manifest 時只需 stat，不再每次讀取整個 PDF 計算雜湊
+    key = _cache_keys.get(str(file_path))
+    if key is None:
+        manifest = validate_manifest(file_path, get_index_params()) or new_manifest(file_path, get_index_params())
+        key = _cache_keys[str(file_path)] = manifest.index_key
+    return f"cache/{key}_{suffix}.pkl"
 
 def save_vector_store(vector_store, file_path):
     print("save_vector_store ...... 保存向量庫到文件")
@@ -49,9 +150,9 @@ def save_vector_store(vector_store, file_path):
         pickle.dump(vector_store, f)
     print(f"向量庫已保存到: {cache_path}")
     """
+    # faiss 原生格式 + chunks.parquet，不使用 pickle（格式見 snapshot.py）
     cache_path = get_cache_path(file_path, "vector_store").replace('.pkl', '')
-    Path("cache").mkdir(exist_ok=True)
-    vector_store.save_local(cache_path)
+    write_vector_store(vector_store, cache_path)
     print(f"向量庫已保存到: {cache_path}")
 
 def load_vector_store(file_path):
@@ -63,20 +164,253 @@ def load_vector_store(file_path):
             return pickle.load(f)
     return None
     """
-    from langchain_community.vectorstores import FAISS
-    from langchain_ollama import OllamaEmbeddings
-   
     cache_path = get_cache_path(file_path, "vector_store").replace('.pkl', '')
+    try:
+        vector_store = read_vector_store(cache_path, get_embeddings())
+    except Exception as e:
+        print(f"加載向量庫錯誤: {e}")
+        return None
+    if vector_store is not None:
+        return vector_store
    
-    if Path(f"{cache_path}/index.faiss").exists():
+    if Path(f"{cache_path}/index.pkl").exists():
+        # 舊的 pickle docstore：最後一次以 load_local 讀取，轉存成 chunks.parquet 後不再需要 pickle
         try:
-            embeddings = OllamaEmbeddings(model='nomic-embed-text', base_url="http://localhost:11434")
-            return FAISS.load_local(cache_path, embeddings, allow_dangerous_deserialization=True)
+            vector_store = FAISS.load_local(cache_path, get_embeddings(), allow_dangerous_deserialization=True)
         except Exception as e:
             print(f"加載向量庫錯誤: {e}")
             return None
+        write_vector_store(vector_store, cache_path)
+        Path(f"{cache_path}/index.pkl").unlink()
+        print(f"向量庫已轉存為 chunks.parquet: {cache_path}")
+        return vector_store
     return None
 
+def save_full_vectors(vectors, file_path):
+    print("save_full_vectors ...... 保存原始向量（精確重排用）")
+    cache_path = get_cache_path(file_path, "vectors").replace('.pkl', '.npy')
+    vector_storage.save_full_vectors(vectors, cache_path)
+    print(f"原始向量已保存到: {cache_path}")
+
+def load_full_vectors(file_path):
+    print("load_full_vectors ...... 以 memmap 開啟原始向量")
+    cache_path = get_cache_path(file_path, "vectors").replace('.pkl', '.npy')
+    return vector_storage.load_full_vectors(cache_path)
+
+def setup_sentences(index: KnowledgeIndex, file_path) -> KnowledgeIndex:
+    """
+    載入句子索引（context 壓縮用）；沒有句子索引的舊快取在此補算一次並保存，
+    embedding 服務無法使用時這個知識庫不壓縮
+    """
+    if RAG_COMPRESS_TOKENS <= 0:
+        return index
+    prefix = get_cache_path(file_path, "sentences").replace('.pkl', '')
+    vector_store = index.vector_store
+    n = vector_store.index.ntotal
+    sentences = SentenceIndex.load(prefix)
+    if sentences is None or sentences.size != n:
+        print("setup_sentences ...... 計算句子向量（context 壓縮）")
+        texts = [vector_store.docstore.search(vector_store.index_to_docstore_id[i]).page_content for i in range(n)]
+        try:
+            SentenceIndex.build(texts, vector_store.embedding_function.embed_documents).save(prefix)
+            sentences = SentenceIndex.load(prefix)
+        except Exception as e:
+            print(f"✗ 句子向量計算失敗，此知識庫不壓縮 context: {e}")
+            sentences = None
+    index.sentences = sentences
+    return index
+
+def setup_shards(index: KnowledgeIndex, file_path) -> KnowledgeIndex:
+    """
+    RAG_SHARDS > 1 時把向量分散到 worker 行程（scatter-gather 檢索），主行程只保留 docstore 與空的 faiss 索引
+
+    分片檔與索引版本一致時直接載入；索引重建或 shard 數改變時以完整向量重新分片
+    """
+    vector_store = index.vector_store
+    n_shards = min(RAG_SHARDS, vector_store.index.ntotal)
+    if n_shards <= 1:
+        return index
+    print(f"setup_shards ...... 分散到 {n_shards} 個 shard 行程")
+    prefix = get_cache_path(file_path, "shards").replace('.pkl', '')
+    vectors_path = get_cache_path(file_path, "vectors").replace('.pkl', '.npy') if index.full_vectors is not None else None
+    shards = ShardedIndex.open(prefix, index.manifest.version, vectors_path, RAG_SHARD_THREADS)
+    if shards is not None and shards.n_shards != n_shards:
+        print(f"shard 數由 {shards.n_shards} 改為 {n_shards}，重新分片")
+        shards = None
+    if shards is None:
+        # 壓縮模式以磁碟上的原始向量分片；flat 模式由索引還原（與原始向量相同）
+        vectors = index.full_vectors
+        if vectors is None:
+            vectors = vector_store.index.reconstruct_n(0, vector_store.index.ntotal)
+        shards = ShardedIndex.build(
+            prefix, vectors, n_shards, index.manifest.version,
+            RAG_VECTOR_STORAGE, RAG_PQ_M, RAG_PQ_NBITS, vectors_path, RAG_SHARD_THREADS,
+        )
+    index.shards = shards.start()
+    vector_store.index = faiss.IndexFlatL2(vector_store.index.d)
+    # LangChain retriever 依賴主行程的索引；RAG 鏈改用 scatter-gather 檢索
+    index.rag_chain = create_rag_chain(
+        RunnableLambda(lambda question: search_index(index, question, k=index.retriever.search_kwargs.get("k", 3))),
+        streaming=True,
+    )
+    return index
+
+# ==================== Published documents (/ingest) ====================
+def published_dir(file_path) -> Path:
+    """發佈到此知識庫的文件（每批一個 .npz）；索引重建或重新載入後依序重新套用"""
+    key = hashlib.blake2b(str(Path(file_path).resolve()).encode(), digest_size=8).hexdigest()
+    directory = Path(INGEST_PUBLISHED_DIR) / key
+    legacy = Path("cache") / f"published_{key}"   # 舊版本放在公開的 cache/ 下：移到 INGEST_PUBLISHED_DIR
+    if legacy.is_dir() and not directory.exists():
+        directory.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(str(legacy), str(directory))
+    return directory
+
+def add_documents(index: KnowledgeIndex, texts, metadatas, vectors, sentence_vectors=None) -> None:
+    """
+    把已 embedding 的 chunk 加入載入中的知識庫（copy-on-write：進行中的查詢繼續使用舊的索引）
+
+    docstore 與句子索引先加入，新的 faiss id 可被搜尋到時對應的文件已存在；
+    sentence_vectors 為 compression.split_sentences 順序的句子向量，未提供時這些 chunk 不壓縮
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    with index.write_lock:
+        vector_store = index.vector_store
+        start = len(vector_store.index_to_docstore_id)
+        ids = list(range(start, start + len(texts)))
+        doc_ids = [str(uuid.uuid4()) for _ in texts]
+        vector_store.docstore.add({
+            doc_id: Document(page_content=text, metadata=metadata)
+            for doc_id, text, metadata in zip(doc_ids, texts, metadatas)
+        })
+        vector_store.index_to_docstore_id.update(zip(ids, doc_ids))
+        if index.sentences is not None:
+            index.sentences.append(texts, sentence_vectors)
+        if index.full_vectors is not None:
+            if not isinstance(index.full_vectors, vector_storage.AppendableVectors):
+                index.full_vectors = vector_storage.AppendableVectors(index.full_vectors)
+            index.full_vectors.append(vectors)
+        metadata_index = copy.deepcopy(index.metadata_index)
+        for i, metadata in zip(ids, metadatas):
+            metadata_index.add(i, metadata)
+        if index.shards is not None:
+            index.shards.add(vectors, ids)
+        else:
+            faiss_index = vector_storage.owned_copy(vector_store.index)
+            faiss_index.add(vectors)
+            vector_store.index = faiss_index
+        index.metadata_index = metadata_index
+        index.revision += 1
+
+def _read_published(path):
+    with np.load(path, allow_pickle=False) as data:
+        header = json.loads(str(data["header"]))
+        sentence_vectors = data["sentence_vectors"] if "sentence_vectors" in data.files else None
+        return header, data["vectors"], sentence_vectors
+
+def replay_documents(index: KnowledgeIndex, file_path) -> KnowledgeIndex:
+    """重新套用已發佈的文件；embedding 參數不同（需重新匯入）的批次略過"""
+    digest = index.manifest.params_digest
+    for path in sorted(published_dir(file_path).glob("*.npz")):
+        try:
+            header, vectors, sentence_vectors = _read_published(path)
+        except Exception as e:
+            print(f"✗ 已發佈文件讀取失敗 ({path}): {e}")
+            continue
+        if header["params_digest"] != digest or vectors.shape[1] != index.vector_store.index.d:
+            print(f"ℹ️ {path.name} 以不同的索引參數建立，需重新匯入")
+            continue
+        add_documents(index, header["texts"], header["metadatas"], vectors, sentence_vectors)
+    if index.revision:
+        print(f"重新套用 {index.revision} 批已發佈的文件")
+    return index
+
+def _write_published(directory: Path, batch_id: str, digest: str, texts, metadatas, vectors, sentence_vectors) -> None:
+    directory.mkdir(parents=True, exist_ok=True)
+    header = {"params_digest": digest, "texts": list(texts), "metadatas": list(metadatas)}
+    path = directory / f"{time.time_ns()}_{batch_id}.npz"
+    tmp = path.with_suffix(".tmp")   # 不符合 *.npz，中斷時不會被重新套用
+    arrays = {"vectors": np.asarray(vectors, np.float32)}
+    if sentence_vectors is not None:
+        arrays["sentence_vectors"] = np.asarray(sentence_vectors, np.float32)
+    with open(tmp, "wb") as f:
+        np.savez(f, header=np.array(json.dumps(header, ensure_ascii=False)), **arrays)
+    tmp.replace(path)
+
+def publish_documents(kb: Optional[str], batch_id: str, texts, metadatas, vectors, sentence_vectors=None) -> int:
+    """
+    發佈一批文件到知識庫：先寫入 published 目錄（重新載入時重新套用），再加入目前的索引
+
+    同一個 batch_id 只會發佈一次（匯入工作中斷後重跑不會重複加入）；回傳加入的 chunk 數
+    """
+    name = kb or RAG_DEFAULT_KB
+    source = knowledge_bases.source_of(name)
+    directory = published_dir(source)
+    if any(directory.glob(f"*_{batch_id}.npz")):
+        return 0
+    if knowledge_bases.peek(name) is None and not os.path.exists(source):
+        # 來源文件還不存在（新部署）：先寫入這一批，再由已發佈的文件建立索引並載入
+        _write_published(directory, batch_id, params_digest(get_index_params()), texts, metadatas, vectors, sentence_vectors)
+        get_knowledge_index(name)
+        return len(texts)
+    index = get_knowledge_index(name)   # 先載入：載入時重新套用的批次不包含這一批
+    _write_published(directory, batch_id, index.manifest.params_digest, texts, metadatas, vectors, sentence_vectors)
+    add_documents(index, texts, metadatas, vectors, sentence_vectors)
+    knowledge_bases.resize(name)
+    return len(texts)
+
+def load_published_index(file_path, params) -> Optional[KnowledgeIndex]:
+    """
+    來源文件不存在（新部署，只有 /ingest 匯入的文件）時，由已發佈的批次建立索引
+
+    索引只在記憶體中（flat、不分片），每次載入時由 published 目錄重新套用
+    """
+    batches = sorted(published_dir(file_path).glob("*.npz"))
+    if not batches:
+        print(f"ℹ️ 來源文件不存在且尚未匯入任何文件: {file_path}")
+        return None
+    with np.load(batches[0], allow_pickle=False) as data:
+        dimension = data["vectors"].shape[1]
+    manifest = IndexManifest(
+        source_path=str(Path(file_path).resolve()), source_size=0, source_mtime_ns=0, source_hash="published",
+        params=json.loads(json.dumps(params, sort_keys=True)), dimension=dimension, created_at=time.time(),
+    )
+    vector_store = FAISS(
+        embedding_function=get_embeddings(),
+        index=faiss.IndexFlatL2(dimension),
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+    )
+    retriever = vector_store.as_retriever(search_type="mmr", search_kwargs={'k': 3})
+    rag_chain = create_rag_chain(retriever, streaming=True)
+    index = KnowledgeIndex(vector_store, manifest, None, MetadataIndex.build([]), retriever, rag_chain)
+    if RAG_COMPRESS_TOKENS > 0:
+        index.sentences = SentenceIndex(
+            np.zeros(1, dtype=np.int64), np.empty((0, 2), dtype=np.int32), np.empty((0, dimension), dtype=np.float32),
+        )
+    print("由已匯入的文件建立索引（來源文件不存在）")
+    return replay_documents(index, file_path)
+
+def save_metadata_index(index, file_path):
+    print("save_metadata_index ...... 保存 metadata bitmap")
+    cache_path = get_cache_path(file_path, "filters").replace('.pkl', '.npz')
+    index.save(cache_path)
+    print(f"metadata bitmap 已保存到: {cache_path}")
+
+def load_metadata_index(vector_store, file_path):
+    print("load_metadata_index ...... 加載 metadata bitmap")
+    cache_path = get_cache_path(file_path, "filters").replace('.pkl', '.npz')
+    index = MetadataIndex.load(cache_path)
+    if index is None or index.size != vector_store.index.ntotal:
+        # 沒有 bitmap 檔（或與索引不一致）時由 docstore 重建
+        metadatas = [
+            vector_store.docstore.search(vector_store.index_to_docstore_id[i]).metadata
+            for i in range(vector_store.index.ntotal)
+        ]
+        index = MetadataIndex.build(metadatas)
+        index.save(cache_path)
+    return index
+
 def save_retriever(retriever, file_path):
     print("save_retriever ...... 保存檢索器到文件")
     """
@@ -209,12 +543,16 @@ def load_rag_chain(file_path):
             return pickle.load(f)
     return None
 
-def setup_rag_system(file_path, force_reload=False):  # force_reload=False
+def setup_rag_system(file_path, force_reload=False, name=None):  # force_reload=False
     print("setup_rag_system ...... 設置或加載RAG系統")
-    global rag_chain
-    global retriever
+    # 登記為知識庫（name 省略時為預設知識庫）並載入
+    kb = knowledge_bases.register(name or RAG_DEFAULT_KB, file_path)
+    return knowledge_bases.get(kb.name, reload=force_reload).rag_chain
 
+def load_knowledge_index(file_path, force_reload=False) -> Optional[KnowledgeIndex]:
+    print("load_knowledge_index ...... 加載或建立單一知識庫的索引")
     Path("cache").mkdir(exist_ok=True) # 創建緩存目錄（如果不存在）
+    params = get_index_params()
 
     """
     # 嘗試加載現有的RAG鏈
@@ -224,10 +562,18 @@ def setup_rag_system(file_path, force_reload=False):  # force_reload=False
             print("加載現有的RAG系統...")
             return rag_chain
     """
-    # 嘗試加載向量庫
-    if not force_reload:
-        vector_store = load_vector_store(file_path)
-        if vector_store:
+    # 嘗試加載向量庫（manifest 只做 stat 檢查，來源文件大小不影響冷啟動時間）
+    manifest = None if force_reload else validate_manifest(file_path, params)
+    if manifest:
+        _cache_keys[str(file_path)] = manifest.index_key
+        loaded = load_vector_store(file_path)
+        if loaded and loaded.index.d != manifest.dimension:
+            print(f"✗ 向量維度不符（manifest {manifest.dimension}，索引 {loaded.index.d}），重新建立")
+            loaded = None
+        if loaded:
+            vector_store = loaded
+            full_vectors = load_full_vectors(file_path) if RAG_VECTOR_STORAGE != "flat" else None
+            metadata_index = load_metadata_index(vector_store, file_path)
             print("加載現有的向量庫...")
             # 直接創建檢索器和RAG鏈
             retriever = vector_store.as_retriever(search_type="mmr", search_kwargs={'k': 3})
@@ -237,28 +583,48 @@ def setup_rag_system(file_path, force_reload=False):  # force_reload=False
             # 創建RAG鏈
             rag_chain = create_rag_chain(retriever, streaming=True)
             print("RAG系統加載完成！")
-            return rag_chain
+            index = KnowledgeIndex(vector_store, manifest, full_vectors, metadata_index, retriever, rag_chain)
+            return replay_documents(setup_shards(setup_sentences(index, file_path), file_path), file_path)
+
+    if not os.path.exists(file_path):
+        return load_published_index(file_path, params)
 
     print("創建新的RAG系統...")
    
-    # 加載和轉換文檔
-    sourcePDF = "D:/Build_RAG_Locally/DIADesigner-ST-CODE.pdf"
-    # markdown_content = load_and_convert_document(file_path)
-    markdown_content = load_and_convert_document(sourcePDF)
+    # 加載和轉換文檔（來源雜湊與轉換快取共用，size / mtime 沒變時不需重新讀取來源檔）
+    source_hash = conversion_cache.source_hash(file_path)
+    markdown_content = load_and_convert_document(file_path)
     if not markdown_content:
         return None
    
-    # 分割文檔
-    chunks = get_markdown_splits(markdown_content)
+    chunks = split_document(markdown_content, file_path)
    
     # 創建向量庫
-    vector_store = setup_vector_store(chunks)
+    vector_store, vectors = setup_vector_store(chunks)
+    manifest = new_manifest(
+        file_path, params,
+        dimension=vector_store.index.d,
+        vector_count=vector_store.index.ntotal,
+        source_hash=source_hash,
+    )
+    _cache_keys[str(file_path)] = manifest.index_key
     save_vector_store(vector_store, file_path)
+    full_vectors = None
+    if RAG_VECTOR_STORAGE != "flat":
+        # 原始向量只留在磁碟上，查詢時以 memmap 讀取候選
+        save_full_vectors(vectors, file_path)
+        full_vectors = load_full_vectors(file_path)
+    del vectors
+    # chunk 依序加入索引，faiss id 即為 chunks 的位置
+    metadata_index = MetadataIndex.build([c.metadata for c in chunks])
+    save_metadata_index(metadata_index, file_path)
+    save_manifest(manifest)  # 索引寫入完成後才寫 manifest，中斷時不會留下指向不完整索引的 manifest
    
    
     # 設置檢索器
     retriever = vector_store.as_retriever(search_type="mmr", search_kwargs={'k': 3})
-    save_retriever(retriever, file_path)
+    # 檢索器設定固定（mmr, k=3），載入時直接重建，不再寫入 retriever_config.pkl
+    # save_retriever(retriever, file_path)
 
     if retriever is None:
         print("retriever is None ...")
@@ -274,18 +640,46 @@ def setup_rag_system(file_path, force_reload=False):  # force_reload=False
     # save_rag_chain(rag_chain, file_path)  # Terry 20250828
    
     print("RAG系統創建並保存完成！")
-    return rag_chain
+    index = KnowledgeIndex(vector_store, manifest, full_vectors, metadata_index, retriever, rag_chain)
+    return replay_documents(setup_shards(setup_sentences(index, file_path), file_path), file_path)
+
+
+# 具名知識庫：第一次查詢時載入，超過記憶體預算時依 LRU 卸載
+knowledge_bases = KnowledgeBaseRegistry(
+    load_knowledge_index,
+    budget_bytes=RAG_KB_MEMORY_MB << 20,
+    size_of=lambda index: index.memory_bytes(),
+    default=RAG_DEFAULT_KB,
+)
+
+def get_knowledge_index(kb: Optional[str] = None) -> KnowledgeIndex:
+    """取得（必要時載入）知識庫；kb 省略時為預設知識庫"""
+    return knowledge_bases.get(kb or RAG_DEFAULT_KB)
 # Terry .....................
 
 
 # Document conversion
 def load_and_convert_document(file_path):
     print("load_and_convert_document ......")
-    converter = DocumentConverter()
-    sourcePDFfile = "D:/Build_RAG_Locally/DIADesigner-ST-CODE.pdf"
-    # result = converter.convert(file_path)
-    result = converter.convert(sourcePDFfile)
-    return result.document.export_to_markdown()
+    return conversion_cache.to_markdown(file_path, DOCLING_PAGE_BATCH)
+
+def split_document(markdown_content, file_path):
+    """分割文檔（header 切割 → 限制大小 + overlap → 去除近似重複）並加上篩選用的 metadata"""
+    chunks = build_chunks(
+        get_markdown_splits(markdown_content),
+        max_tokens=RAG_CHUNK_MAX_TOKENS,
+        overlap_tokens=RAG_CHUNK_OVERLAP_TOKENS,
+        dedup_threshold=RAG_DEDUP_THRESHOLD,
+    )
+    # header 階層已由 MarkdownHeaderTextSplitter 加上
+    source_meta = {
+        "source": Path(file_path).name,
+        "doc_type": Path(file_path).suffix.lstrip(".").lower(),
+        "ingested_at": date.today().isoformat(),
+    }
+    for c in chunks:
+        c.metadata.update(source_meta)
+    return chunks
 
 # Splitting markdown content into chunks
 def get_markdown_splits(markdown_content):
@@ -297,17 +691,26 @@ def get_markdown_splits(markdown_content):
 # Embedding and vector store setup
 def setup_vector_store(chunks):
     print("setup_vector_store ......")
-    embeddings = OllamaEmbeddings(model='nomic-embed-text', base_url="http://localhost:11434")
-    single_vector = embeddings.embed_query("this is some text data")
-    index = faiss.IndexFlatL2(len(single_vector))
+    if not chunks:
+        raise ValueError("沒有可嵌入的 chunk")
+    embeddings = get_embeddings()
+    texts = [c.page_content for c in chunks]
+    # 維度直接取自第一個向量，不需要額外 embed 一段文字探測
+    vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    index = vector_storage.create_index(vectors, RAG_VECTOR_STORAGE, RAG_PQ_M, RAG_PQ_NBITS)
+    print(f"向量儲存模式: {RAG_VECTOR_STORAGE}（{type(index).__name__}）")
     vector_store = FAISS(
         embedding_function=embeddings,
         index=index,
         docstore=InMemoryDocstore(),
         index_to_docstore_id={}
     )
-    vector_store.add_documents(documents=chunks)
-    return vector_store
+    vector_store.add_embeddings(
+        text_embeddings=list(zip(texts, vectors)),
+        metadatas=[c.metadata for c in chunks],
+    )
+    print(f"索引大小: {vector_storage.memory_bytes(index) / 1024 / 1024:.2f} MB（{index.ntotal} 個向量）")
+    return vector_store, vectors
 
 # Formatting documents for RAG
 def format_docs(docs):
@@ -352,13 +755,13 @@ def create_rag_chain(retriever, streaming=False):
         | StrOutputParser()
     )
 
-def get_rag_chain():
+def get_rag_chain(kb: Optional[str] = None):
     print("get_rag_chain ......")
-    return rag_chain
+    return get_knowledge_index(kb).rag_chain
 
-def stream_answer(question: str):
+def stream_answer(question: str, kb: Optional[str] = None):
     print("stream_answer ......")
-    for chunk in rag_chain.stream(question):
+    for chunk in get_rag_chain(kb).stream(question):
         yield chunk
 
 def DMS_stream_answer(question: str):
@@ -401,9 +804,9 @@ def build_prompt(question: str, ctx: str, sources_label: str) -> str:
         "【開始回答】\n"
     )
 
-def get_retriever():
+def get_retriever(kb: Optional[str] = None):
     print("get_retriever ......")
-    return retriever
+    return get_knowledge_index(kb).retriever
 
 def _set_retriever(r):
     print("_set_retriever ......")
@@ -420,22 +823,129 @@ def _source_of(doc) -> str:
         or "unknown"
     )
 
-def retrieve_context(question: str, k: int = 6, max_chars: int = 12000) -> Tuple[str, List[str]]:
+def get_index_version(kb: Optional[str] = None):
+    """知識庫目前載入索引的版本（每次重建都不同）；尚未載入時為 None（不會觸發載入）"""
+    index = knowledge_bases.peek(kb or RAG_DEFAULT_KB)
+    return index.version if index is not None else None
+
+def get_filter_values(kb: Optional[str] = None):
+    """各篩選欄位目前可用的值"""
+    metadata_index = get_knowledge_index(kb).metadata_index
+    return {name: metadata_index.values(name) for name in FILTER_FIELDS}
+
+def search_documents(
+    question: str, k: int = 3, fetch_k: int = 20, filters: Optional[SearchFilters] = None, kb: Optional[str] = None,
+):
+    """
+    MMR 檢索；壓縮模式下以磁碟上的原始向量精確重排候選，filters 以 bitmap 在索引內篩選
+
+    重複的問題直接由 retrieval_cache 取得排序後的 faiss id（不需 embedding 與索引搜尋）
+    """
+    current_span().set(kb=kb or RAG_DEFAULT_KB)
+    return search_index(get_knowledge_index(kb), question, k, fetch_k, filters)
+
+def search_index(
+    index: KnowledgeIndex, question: str, k: int = 3, fetch_k: int = 20, filters: Optional[SearchFilters] = None,
+):
+    """在已載入的知識庫上檢索；分片時 scatter 到各 shard 行程，合併後做全域 MMR"""
+    vector_store = index.vector_store
+    ids = search_ids(index, question, k, fetch_k, filters)
+    return [vector_store.docstore.search(vector_store.index_to_docstore_id[i]) for i in ids]
+
+def search_ids(
+    index: KnowledgeIndex, question: str, k: int = 3, fetch_k: int = 20, filters: Optional[SearchFilters] = None,
+) -> Tuple[int, ...]:
+    """search_index 的 faiss id 版本（依相關度排序）"""
+    vector_store = index.vector_store
+    key = retrieval_cache.result_key(
+        question, k, fetch_k, filters.cache_key() if filters else None, version=index.version,
+    )
+    ids = retrieval_cache.results.get(key)
+    current_span().set(result_cache_hit=ids is not None)
+    if ids is None:
+        bitmap = index.metadata_index.select(filters)
+        with span("rag.embed"):
+            query = retrieval_cache.embedding(question, vector_store.embedding_function.embed_query)
+        shards = index.shards
+        with span(
+            "rag.search", storage=RAG_VECTOR_STORAGE, k=k, fetch_k=fetch_k, filtered=bitmap is not None,
+            shards=shards.n_shards if shards is not None else 1,
+        ) as s:
+            if shards is not None:
+                hits = shards.search(
+                    query, k=k, fetch_k=fetch_k,
+                    full_vectors=index.full_vectors, rerank=RAG_RERANK_CANDIDATES, bitmap=bitmap,
+                )
+            else:
+                hits = vector_storage.search(
+                    vector_store.index, query, k=k, fetch_k=fetch_k,
+                    full_vectors=index.full_vectors, rerank=RAG_RERANK_CANDIDATES, bitmap=bitmap,
+                )
+            s.set(hits=len(hits))
+        ids = tuple(i for i, _ in hits)
+        retrieval_cache.results.put(key, ids)
+    return ids
+
+def warm_index(index: KnowledgeIndex, n_queries: int = 3) -> dict:
+    """
+    暖機：以知識庫自己的 chunk 當合成查詢跑完整檢索，讓 embedding 模型載入、索引與 shard 行程的搜尋路徑
+    實際執行一次，並把磁碟上的原始向量讀進 page cache，第一個真正的查詢不必承擔冷啟動
+    """
+    print("warm_index ...... 知識庫暖機")
+    start = time.perf_counter()
+    paged = vector_storage.touch(index.full_vectors) if index.full_vectors is not None else 0
+    vector_store = index.vector_store
+    ids = sorted(vector_store.index_to_docstore_id)
+    step = max(1, len(ids) // max(1, n_queries))
+    docs = [vector_store.docstore.search(vector_store.index_to_docstore_id[i]) for i in ids[::step][:n_queries]]
+    queries = [(d.page_content or "")[:200] for d in docs]
+    for q in queries:
+        if q.strip():
+            search_index(index, q)
+    return {
+        "queries": len(queries),
+        "paged_bytes": paged,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+def retrieve_context(
+    question: str, k: int = 6, max_chars: int = 12000, filters: Optional[SearchFilters] = None,
+    kb: Optional[str] = None,
+) -> Tuple[str, List[str]]:
     print("retrieve_context ......")
     """
     回傳 (ctx, sources)
     - ctx：Top-K 文件組合後的上下文文字（含 [S#] 前綴），並做字元級裁切
     - sources：來源清單（僅來源字串，給 UI 顯示或提示尾註）
+    - filters：限制檢索範圍（來源 / 章節 / 文件類型 / 匯入日期）
+    - kb：知識庫名稱，省略時為預設知識庫（未載入時在此載入）
     """  
-    r = get_retriever()
+    r = get_retriever(kb)
     if r is None:
         raise RuntimeError("Retriever 尚未初始化（請在 setup_rag_system 中建立 retriever 並指派）")
-    docs = r.get_relevant_documents(question)
+    # 與 retriever 相同的 MMR 參數，但改由 vector_storage.search 執行（支援壓縮索引 + 精確重排）
+    index = get_knowledge_index(kb)
+    current_span().set(kb=kb or RAG_DEFAULT_KB)
+    ids = search_ids(index, question, k=min(k, r.search_kwargs.get("k", k)), filters=filters)[:k]
+    vector_store = index.vector_store
+    docs = [vector_store.docstore.search(vector_store.index_to_docstore_id[i]) for i in ids]
+    texts = [d.page_content or "" for d in docs]
+    sentences = index.sentences
+    if sentences is not None and RAG_COMPRESS_TOKENS > 0 and texts:
+        # 依查詢挑選句子（查詢向量來自 embedding 快取，句子向量已預先算好）
+        with span("rag.compress", budget=RAG_COMPRESS_TOKENS) as s:
+            query = retrieval_cache.embedding(question, vector_store.embedding_function.embed_query)
+            before = sum(estimate_tokens(t) for t in texts)
+            texts = sentences.compress(query, ids, texts, RAG_COMPRESS_TOKENS, RAG_COMPRESS_NEIGHBORS)
+            after = sum(estimate_tokens(t) for t in texts)
+            s.set(tokens_before=before, tokens_after=after)
+            _context_tokens.inc(before, stage="retrieved")
+            _context_tokens.inc(after, stage="compressed")
     blocks = []
     srcs = []
-    for i, d in enumerate(docs[:k], start=1):
+    for i, (d, txt) in enumerate(zip(docs, texts), start=1):
         src = _source_of(d)
-        txt = (d.page_content or "").strip().replace("\x00", "")
+        txt = txt.strip().replace("\x00", "")
         blocks.append(f"[S{i}] {src}\n{txt}")
         srcs.append(src)
 
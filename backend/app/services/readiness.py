@@ -0,0 +1,163 @@
+"""
+Readiness / warmup
+
+/health（/health/live）只表示行程還活著；/health/ready 才表示可以接流量，條件為：
+
+- 暖機完成：每個已載入的知識庫跑過 WARMUP_QUERIES 次合成查詢（載入 embedding 模型、把索引與原始向量讀進記憶體），
+  每個已設定的 LLM 提供者各呼叫一次輕量 API，讓連線池建立好 TLS 連線
+- RAG 初始化成功、預設知識庫已載入（回報各知識庫的索引版本與向量數）
+- embedding 服務（Ollama）連得到；檢查結果快取 READY_PROBE_TTL 秒，不會每次 probe 都打一次
+- 至少一個提供者暖機成功（沒有設定任何提供者時不檢查）；個別提供者失敗只回報，不讓整個 worker 下線，
+  全部失敗時 probe 會在背景重新暖機（每 READY_PROBE_TTL 秒最多一次）
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from ..core.clients import dms_client, gemini_client, openrouter_client
+from ..core.config import OLLAMA_BASE_URL, RAG_DEFAULT_KB, READY_PROBE_TTL, WARMUP_QUERIES, WARMUP_TIMEOUT, logger
+from ..core.metrics import registry
+from . import rag_core
+from .rag_core import knowledge_bases
+
+_ready = registry.gauge("ready", "1 when the worker passes its readiness check")
+_warmup_seconds = registry.gauge("warmup_seconds", "Duration of the startup warmup")
+
+
+def _provider_probes() -> Dict[str, Callable[[], Awaitable[Any]]]:
+    """已設定的提供者 → 輕量 API 呼叫（列出模型），只為了建立連線"""
+    probes = {}
+    if gemini_client is not None:
+        probes["gemini"] = lambda: gemini_client.aio.models.list()
+    if openrouter_client is not None:
+        probes["openrouter"] = lambda: openrouter_client.models.list()
+    if dms_client is not None:
+        probes["dms"] = lambda: dms_client.models.list()
+    return probes
+
+
+class Readiness:
+    def __init__(self, probe_ttl: float = 5.0):
+        self.probe_ttl = probe_ttl
+        self.rag_enabled = False
+        self.status = "pending"            # pending → running → done
+        self.warmup_seconds: Optional[float] = None
+        self.knowledge_bases: Dict[str, Dict[str, Any]] = {}
+        self.providers: Dict[str, Dict[str, Any]] = {
+            name: {"warm": False, "latency_ms": None, "error": None} for name in _provider_probes()
+        }
+        self._embeddings: Optional[Dict[str, Any]] = None
+        self._embeddings_checked = 0.0
+        self._last_ready = False
+        self._rewarm: Optional[asyncio.Task] = None
+        self._rewarm_at = 0.0
+        _ready.set_function(lambda: int(self._last_ready))
+
+    # ---------- warmup ----------
+    async def warmup(self, rag_enabled: bool) -> None:
+        """啟動後在背景執行一次；完成前 readiness 不會變成 ready"""
+        self.rag_enabled = rag_enabled
+        self.status = "running"
+        start = time.perf_counter()
+        logger.info("🔥 Warming up...")
+        await asyncio.gather(self._warm_knowledge_bases(), self._warm_providers())
+        self.warmup_seconds = round(time.perf_counter() - start, 3)
+        _warmup_seconds.set(self.warmup_seconds)
+        self.status = "done"
+        logger.info(f"✓ Warmup finished in {self.warmup_seconds}s")
+
+    async def _warm_knowledge_bases(self) -> None:
+        if not self.rag_enabled:
+            return
+        for name in knowledge_bases.names():
+            index = knowledge_bases.peek(name)
+            if index is None:  # 未常駐的知識庫第一次查詢時才載入，不在暖機時載入
+                continue
+            try:
+                self.knowledge_bases[name] = await asyncio.to_thread(rag_core.warm_index, index, WARMUP_QUERIES)
+            except Exception as e:
+                self.knowledge_bases[name] = {"error": str(e)}
+                logger.error(f"✗ 知識庫 {name} 暖機失敗: {e}")
+
+    async def _warm_providers(self) -> None:
+        async def warm(name: str, probe: Callable[[], Awaitable[Any]]) -> None:
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(probe(), timeout=WARMUP_TIMEOUT)
+                self.providers[name] = {
+                    "warm": True, "latency_ms": round((time.perf_counter() - start) * 1000, 1), "error": None,
+                }
+            except Exception as e:
+                self.providers[name] = {"warm": False, "latency_ms": None, "error": str(e) or type(e).__name__}
+                logger.warning(f"⚠ {name} 連線暖機失敗: {self.providers[name]['error']}")
+
+        await asyncio.gather(*(warm(name, probe) for name, probe in _provider_probes().items()))
+
+    def _retry_providers(self) -> None:
+        if self.status != "done" or (self._rewarm is not None and not self._rewarm.done()):
+            return
+        now = time.monotonic()
+        if now - self._rewarm_at >= self.probe_ttl:
+            self._rewarm_at = now
+            self._rewarm = asyncio.create_task(self._warm_providers())
+
+    # ---------- checks ----------
+    async def embeddings(self) -> Dict[str, Any]:
+        """Ollama 是否連得到（結果快取 probe_ttl 秒）"""
+        now = time.monotonic()
+        if self._embeddings is not None and now - self._embeddings_checked < self.probe_ttl:
+            return self._embeddings
+        start = time.perf_counter()
+        try:
+            async with httpx.AsyncClient(trust_env=False, timeout=2.0) as client:
+                response = await client.get(f"{OLLAMA_BASE_URL.rstrip('/')}/api/version")
+                response.raise_for_status()
+            result = {"reachable": True, "latency_ms": round((time.perf_counter() - start) * 1000, 1), "error": None}
+        except Exception as e:
+            result = {"reachable": False, "latency_ms": None, "error": str(e) or type(e).__name__}
+        self._embeddings, self._embeddings_checked = result, now
+        return result
+
+    def _index_status(self) -> Dict[str, Dict[str, Any]]:
+        status = {}
+        for name in knowledge_bases.names():
+            index = knowledge_bases.peek(name)
+            status[name] = {
+                "loaded": index is not None,
+                "version": index.version if index is not None else None,
+                "vectors": index.ntotal if index is not None else None,
+                "warmup": self.knowledge_bases.get(name),
+            }
+        return status
+
+    async def check(self, rag_enabled: bool) -> Dict[str, Any]:
+        reasons: List[str] = []
+        if self.status != "done":
+            reasons.append(f"warmup {self.status}")
+        indexes = self._index_status() if rag_enabled else {}
+        embeddings = None
+        if not rag_enabled:
+            reasons.append("RAG initialization failed")
+        else:
+            if not indexes.get(RAG_DEFAULT_KB, {}).get("loaded"):
+                reasons.append(f"default knowledge base '{RAG_DEFAULT_KB}' not loaded")
+            embeddings = await self.embeddings()
+            if not embeddings["reachable"]:
+                reasons.append("embedding server unreachable")
+        if self.providers and not any(p["warm"] for p in self.providers.values()):
+            reasons.append("no LLM provider warm")
+            self._retry_providers()
+        self._last_ready = not reasons
+        return {
+            "ready": self._last_ready,
+            "reasons": reasons,
+            "warmup": {"status": self.status, "seconds": self.warmup_seconds},
+            "rag": {"enabled": rag_enabled, "knowledge_bases": indexes},
+            "embeddings": embeddings,
+            "providers": self.providers,
+        }
+
+
+readiness = Readiness(probe_ttl=READY_PROBE_TTL)
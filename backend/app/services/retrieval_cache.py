@@ -0,0 +1,159 @@
+"""
+Retrieval cache
+
+retrieve_context 前的兩層快取：
+
+- L1 embedding：問題文字 → 查詢向量（省下 Ollama embedding 往返）
+- L2 results  ：(正規化問題, k, fetch_k, 篩選條件, 索引版本) → 排序後的 faiss id（省下 embedding + 索引搜尋 + MMR）
+
+兩層都是 LRU + TTL，各自有筆數 / bytes 上限。結果的 key 含索引版本（index manifest version），
+多個知識庫共用同一份快取，索引重建後舊版本的項目自然不再命中並被淘汰。
+命中率等統計值註冊在 core.metrics，由 GET /metrics 輸出。
+"""
+import sys
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+import numpy as np
+
+from ..core.metrics import registry
+
+_requests = registry.counter("rag_cache_requests_total", "Retrieval cache lookups by result (hit / miss)")
+_evictions = registry.counter("rag_cache_evictions_total", "Retrieval cache removals by reason (size / ttl / invalidate)")
+_entries = registry.gauge("rag_cache_entries", "Retrieval cache entries")
+_bytes = registry.gauge("rag_cache_bytes", "Retrieval cache estimated size in bytes")
+_hit_ratio = registry.gauge("rag_cache_hit_ratio", "Retrieval cache hits / lookups since start")
+
+
+def _sizeof(value: Any) -> int:
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, tuple):
+        return sys.getsizeof(value) + 8 * len(value)
+    return sys.getsizeof(value)
+
+
+class TTLCache:
+    """執行緒安全的 LRU 快取；超過 ttl 秒的項目視為未命中，超過 max_entries / max_bytes 時淘汰最舊的項目"""
+
+    def __init__(self, name: str, max_entries: int = 10000, max_bytes: int = 0, ttl: float = 600.0):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes        # 0 表示只以筆數限制
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, int, Any]]" = OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+        _entries.set_function(lambda: len(self._data), cache=name)
+        _bytes.set_function(lambda: self._size, cache=name)
+        _hit_ratio.set_function(self.hit_ratio, cache=name)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.ttl > 0
+
+    def hit_ratio(self) -> float:
+        total = self._hits + self._misses
+        return self._hits / total if total else 0.0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and time.monotonic() - item[0] > self.ttl:
+                self._remove(key, "ttl")
+                item = None
+            if item is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._data.move_to_end(key)
+        _requests.inc(cache=self.name, result="miss" if item is None else "hit")
+        return None if item is None else item[2]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if not self.enabled:
+            return
+        size = _sizeof(value)
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._size -= self._data.pop(key)[1]
+            self._data[key] = (time.monotonic(), size, value)
+            self._size += size
+            while self._data and (
+                len(self._data) > self.max_entries or (self.max_bytes and self._size > self.max_bytes)
+            ):
+                self._remove(next(iter(self._data)), "size")
+
+    def clear(self) -> int:
+        with self._lock:
+            n = len(self._data)
+            self._data.clear()
+            self._size = 0
+        if n:
+            _evictions.inc(n, cache=self.name, reason="invalidate")
+        return n
+
+    def _remove(self, key: Hashable, reason: str) -> None:
+        self._size -= self._data.pop(key)[1]
+        _evictions.inc(cache=self.name, reason=reason)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._data),
+            "bytes": self._size,
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_ratio": round(self.hit_ratio(), 4),
+        }
+
+
+def normalize_query(question: str) -> str:
+    """全形 / 半形、大小寫與空白差異視為同一個問題"""
+    return " ".join(unicodedata.normalize("NFKC", question).casefold().split())
+
+
+class RetrievalCache:
+    def __init__(
+        self,
+        embedding_max_bytes: int = 32 << 20,
+        embedding_ttl: float = 3600.0,
+        result_max_entries: int = 10000,
+        result_ttl: float = 600.0,
+    ):
+        self.embeddings = TTLCache("embedding", max_entries=1 << 20, max_bytes=embedding_max_bytes, ttl=embedding_ttl)
+        self.results = TTLCache("results", max_entries=result_max_entries, ttl=result_ttl)
+        self.version: Optional[str] = None
+
+    def invalidate(self, version: Optional[str] = None) -> None:
+        """索引重建 / 重新載入時呼叫；版本相同（同一份索引）時保留快取"""
+        if version is not None and version == self.version:
+            return
+        self.embeddings.clear()
+        self.results.clear()
+        self.version = version
+
+    def embedding(self, question: str, compute: Callable[[str], Any]) -> np.ndarray:
+        key = question.strip()
+        vector = self.embeddings.get(key)
+        if vector is None:
+            vector = np.asarray(compute(question), dtype=np.float32)
+            vector.setflags(write=False)
+            self.embeddings.put(key, vector)
+        return vector
+
+    def result_key(
+        self, question: str, k: int, fetch_k: int, filters_key: Hashable = None, version: Optional[str] = None,
+    ) -> Tuple:
+        return normalize_query(question), k, fetch_k, filters_key, version or self.version
+
+    def stats(self) -> dict:
+        return {"version": self.version, "embedding": self.embeddings.stats(), "results": self.results.stats()}
@@ -0,0 +1,282 @@
+"""
+Sharded vector search
+
+向量依 faiss id 分散到 RAG_SHARDS 個 shard，每個 shard 由獨立的 worker 行程載入並搜尋：
+
+- 分片：id 輪流分配（round-robin），同一份文件的 chunk 平均分散，篩選後各 shard 的負載仍相近
+- 查詢：scatter 到所有 shard 平行搜尋，各自回傳前 max(k, fetch_k) 個候選（有原始向量時已精確重排），
+  主行程合併後再做全域 MMR，結果與單一索引相同（在各 shard 的近似誤差內）
+- metadata 篩選：主行程的全域 bitmap 傳給各 shard，由 shard 依自己的 id 對照表轉成本地 bitmap
+- 新增向量（匯入）時分配到目前最小的 shard，各 shard 筆數差距維持在 1 以內；只加在 worker 記憶體中，
+  shard 檔維持索引建立時的內容（匯入的文件由 rag_core 在載入時重新套用）；
+  RAG_SHARDS 改變時由 rag_core 以完整向量重新分片（rebalance）
+- shard 檔案：<prefix>_shard{i}.faiss（本地 id 0..m-1）+ <prefix>_shard{i}_ids.npy（本地 → 全域 id），
+  <prefix>_shards.json 記錄分片配置與對應的索引版本
+"""
+import heapq
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+from . import vector_storage
+
+LAYOUT_VERSION = 1
+
+
+def partition(n_vectors: int, n_shards: int) -> List[np.ndarray]:
+    """round-robin：shard i 取得 id i, i+n, i+2n, ...（各 shard 內 id 遞增）"""
+    ids = np.arange(n_vectors, dtype=np.int64)
+    return [ids[i::n_shards] for i in range(n_shards)]
+
+
+def assign(sizes: Sequence[int], n_new: int) -> List[int]:
+    """新增的向量依序分配到目前最小的 shard，回傳每個向量的 shard 編號"""
+    heap = [(size, i) for i, size in enumerate(sizes)]
+    heapq.heapify(heap)
+    out = []
+    for _ in range(n_new):
+        size, i = heapq.heappop(heap)
+        out.append(i)
+        heapq.heappush(heap, (size + 1, i))
+    return out
+
+
+# ==================== Worker process ====================
+_worker: Dict = {}
+
+
+class _ShardRows:
+    """以本地 id 讀取全域原始向量 memmap 的對應列（給 vector_storage.search 的 full_vectors）；匯入的向量接在後面"""
+
+    def __init__(self, vectors: np.ndarray, ids: np.ndarray):
+        self.vectors = vectors
+        self.ids = ids                # 建立 shard 時的本地 → 全域 id
+        self.extra = np.empty((0, vectors.shape[1]), dtype=np.float32)
+
+    def append(self, vectors: np.ndarray) -> None:
+        self.extra = np.concatenate([self.extra, vectors])
+
+    def __getitem__(self, local_ids):
+        local_ids = np.asarray(local_ids)
+        n, extra = len(self.ids), self.extra
+        if local_ids.size == 0 or local_ids.max() < n:
+            return self.vectors[self.ids[local_ids]]
+        out = np.empty((len(local_ids), self.vectors.shape[1]), dtype=np.float32)
+        in_base = local_ids < n
+        out[in_base] = self.vectors[self.ids[local_ids[in_base]]]
+        out[~in_base] = extra[local_ids[~in_base] - n]
+        return out
+
+
+def _init_worker(index_path: str, ids_path: str, vectors_path: Optional[str], threads: int) -> None:
+    faiss.omp_set_num_threads(threads)
+    _worker["index"] = faiss.read_index(index_path)
+    _worker["ids"] = np.load(ids_path)
+    vectors = vector_storage.load_full_vectors(vectors_path) if vectors_path else None
+    _worker["rows"] = _ShardRows(vectors, _worker["ids"]) if vectors is not None else None
+
+
+def _search_worker(
+    query: np.ndarray, n_fetch: int, rerank: int, bitmap: Optional[np.ndarray], with_vectors: bool,
+) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    index, ids, rows = _worker["index"], _worker["ids"], _worker["rows"]
+    local_bitmap = None
+    if bitmap is not None:
+        bits = np.unpackbits(bitmap, count=len(bitmap) * 8, bitorder="little")
+        local = np.zeros(len(ids), dtype=bool)
+        inside = ids < len(bits)
+        local[inside] = bits[ids[inside]].astype(bool)
+        local_bitmap = np.packbits(local, bitorder="little")
+    hits = vector_storage.search(
+        index, query, k=n_fetch, fetch_k=n_fetch, full_vectors=rows, rerank=rerank, mmr=False, bitmap=local_bitmap,
+    )
+    if not hits:
+        return np.empty(0, np.int64), np.empty(0, np.float32), None
+    local_ids = np.array([i for i, _ in hits], dtype=np.int64)
+    distances = np.array([d for _, d in hits], dtype=np.float32)
+    vectors = index.reconstruct_batch(local_ids) if with_vectors else None
+    return ids[local_ids], distances, vectors
+
+
+def _add_worker(vectors: np.ndarray, global_ids: np.ndarray) -> Tuple[int, int]:
+    # 與查詢在同一個 worker 依序執行，不需加鎖
+    index = _worker["index"]
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if _worker["rows"] is not None:
+        _worker["rows"].append(vectors)   # 先補上原始向量，新 id 可被搜尋到時即可精確重排
+    index.add(vectors)
+    _worker["ids"] = np.concatenate([_worker["ids"], global_ids.astype(np.int64)])
+    return index.ntotal, vector_storage.resident_bytes(index)
+
+
+
+# ==================== Coordinator (main process) ====================
+class ShardedIndex:
+    def __init__(self, prefix: str, layout: Dict, vectors_path: Optional[str] = None, threads: int = 1):
+        self.prefix = prefix
+        self.layout = layout
+        self.vectors_path = vectors_path
+        self.threads = threads
+        self._pools: List[ProcessPoolExecutor] = []
+
+    # ---------- files ----------
+    @staticmethod
+    def layout_path(prefix: str) -> Path:
+        return Path(f"{prefix}_shards.json")
+
+    @staticmethod
+    def _shard_paths(prefix: str, i: int) -> Tuple[str, str]:
+        return f"{prefix}_shard{i}.faiss", f"{prefix}_shard{i}_ids.npy"
+
+    def _save_layout(self) -> None:
+        path = self.layout_path(self.prefix)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.layout, indent=2), encoding="utf-8")
+        tmp.replace(path)
+
+    @property
+    def n_shards(self) -> int:
+        return len(self.layout["shards"])
+
+    @property
+    def ntotal(self) -> int:
+        return sum(s["count"] for s in self.layout["shards"])
+
+    def memory_bytes(self) -> int:
+        """所有 shard 行程的索引常駐記憶體（建立 / 更新時記錄）"""
+        return sum(s["bytes"] for s in self.layout["shards"])
+
+    # ---------- build / open ----------
+    @classmethod
+    def build(
+        cls,
+        prefix: str,
+        vectors: np.ndarray,
+        n_shards: int,
+        index_version: str,
+        storage: str = "flat",
+        pq_m: int = 64,
+        pq_nbits: int = 8,
+        vectors_path: Optional[str] = None,
+        threads: int = 1,
+    ) -> "ShardedIndex":
+        """依 round-robin 分片並寫出各 shard 的索引（不啟動 worker）"""
+        n_shards = max(1, min(n_shards, len(vectors)))
+        shards = []
+        for i, ids in enumerate(partition(len(vectors), n_shards)):
+            part = np.ascontiguousarray(vectors[ids], dtype=np.float32)
+            index = vector_storage.create_index(part, storage, pq_m, pq_nbits)
+            index.add(part)
+            index_path, ids_path = cls._shard_paths(prefix, i)
+            faiss.write_index(index, index_path)
+            np.save(ids_path, ids)
+            shards.append({"index": index_path, "ids": ids_path, "count": int(len(ids)),
+                           "bytes": vector_storage.resident_bytes(index)})
+        layout = {
+            "layout_version": LAYOUT_VERSION,
+            "index_version": index_version,
+            "storage": storage,
+            "shards": shards,
+        }
+        sharded = cls(prefix, layout, vectors_path, threads)
+        sharded._save_layout()
+        return sharded
+
+    @classmethod
+    def open(
+        cls, prefix: str, index_version: str, vectors_path: Optional[str] = None, threads: int = 1,
+    ) -> Optional["ShardedIndex"]:
+        """讀取分片配置；與索引版本不符或檔案不完整時回傳 None（需重新 build）"""
+        path = cls.layout_path(prefix)
+        if not path.exists():
+            return None
+        try:
+            layout = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        if layout.get("layout_version") != LAYOUT_VERSION or layout.get("index_version") != index_version:
+            return None
+        if not all(os.path.exists(s["index"]) and os.path.exists(s["ids"]) for s in layout["shards"]):
+            return None
+        return cls(prefix, layout, vectors_path, threads)
+
+    # ---------- workers ----------
+    def start(self) -> "ShardedIndex":
+        """每個 shard 一個 worker 行程（spawn：不複製主行程的執行緒與大型物件）"""
+        ctx = multiprocessing.get_context("spawn")
+        self._pools = [
+            ProcessPoolExecutor(
+                max_workers=1, mp_context=ctx, initializer=_init_worker,
+                initargs=(s["index"], s["ids"], self.vectors_path, self.threads),
+            )
+            for s in self.layout["shards"]
+        ]
+        return self
+
+    def close(self) -> None:
+        # 進行中的查詢會先完成，worker 才結束
+        for pool in self._pools:
+            pool.shutdown(wait=False)
+        self._pools = []
+
+    # ---------- search ----------
+    def search(
+        self,
+        query: Sequence[float],
+        k: int = 3,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        full_vectors: Optional[np.ndarray] = None,
+        rerank: int = 0,
+        mmr: bool = True,
+        bitmap: Optional[np.ndarray] = None,
+    ) -> List[Tuple[int, float]]:
+        """與 vector_storage.search 相同的參數與回傳值（faiss id 為全域 id）"""
+        q = np.asarray(query, dtype=np.float32).reshape(1, -1)
+        if bitmap is not None:
+            bitmap = np.ascontiguousarray(bitmap, dtype=np.uint8)
+            if not bitmap.any():
+                return []
+        n_fetch = max(k, fetch_k if mmr else k)
+        use_exact = full_vectors is not None and rerank > 0
+        with_vectors = mmr and full_vectors is None
+        futures = [
+            pool.submit(_search_worker, q, n_fetch, rerank if use_exact else 0, bitmap, with_vectors)
+            for pool in self._pools
+        ]
+        results = [f.result() for f in futures]
+        ids = np.concatenate([r[0] for r in results])
+        if ids.size == 0:
+            return []
+        distances = np.concatenate([r[1] for r in results])
+        order = np.argsort(distances, kind="stable")[:n_fetch]
+        ids, distances = ids[order], distances[order]
+        if not mmr:
+            return [(int(i), float(d)) for i, d in zip(ids[:k], distances[:k])]
+        if full_vectors is not None:
+            candidates = np.asarray(full_vectors[ids], dtype=np.float32)
+        else:
+            candidates = np.concatenate([r[2] for r in results if r[2] is not None])[order]
+        picked = maximal_marginal_relevance(q, list(candidates), lambda_mult=lambda_mult, k=k)
+        return [(int(ids[i]), float(distances[i])) for i in picked]
+
+    # ---------- ingestion ----------
+    def add(self, vectors: np.ndarray, global_ids: Sequence[int]) -> None:
+        """新增向量（只在 worker 記憶體中）：每個向量分配到目前最小的 shard，shard 之間的筆數差距維持在 1 以內"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        global_ids = np.asarray(global_ids, dtype=np.int64)
+        targets = np.array(assign([s["count"] for s in self.layout["shards"]], len(global_ids)))
+        futures = {}
+        for i in np.unique(targets):
+            mask = targets == i
+            futures[int(i)] = self._pools[i].submit(_add_worker, vectors[mask], global_ids[mask])
+        for i, future in futures.items():
+            shard = self.layout["shards"][i]
+            shard["count"], shard["bytes"] = future.result()
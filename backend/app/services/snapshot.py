@@ -0,0 +1,300 @@
+"""
+Index snapshots
+
+向量庫在磁碟上的格式（cache/<key>_vector_store/）不使用 pickle：
+
+- index.faiss      faiss 原生格式（write_index / read_index）；載入時以 IO_FLAG_MMAP_IFC 直接 mmap 向量編碼
+- chunks.parquet   faiss_id / doc_id / text / metadata（JSON 字串）四個欄位；載入後保留 Arrow 欄位，
+                   Document 在檢索命中時才建立（ArrowDocstore）
+
+可攜的快照（export / import）把一個知識庫的所有索引檔放在同一個目錄：
+
+- index.faiss / chunks.parquet   同上
+- vectors.npy                    float32 原始向量 (n, d)
+- filters.npz、sentences.*       metadata bitmap、句子索引（有建立時）
+- published/*.npz                之後匯入（/ingest）的文件批次
+- manifest.json                  快照格式版本、index manifest、每個檔案的 bytes 與 sha256
+
+新節點 import 快照後，啟動時只需 stat 檢查 manifest，載入為 faiss 讀檔 + Parquet 讀取，不需轉換或 embedding：
+
+    python -m app.services.snapshot export <kb> <目錄>
+    python -m app.services.snapshot import <目錄> [--kb 名稱] [--source 來源文件]
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import faiss
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+SNAPSHOT_FORMAT = "rag-index-snapshot"
+SNAPSHOT_VERSION = 1
+COPY_BLOCK_SIZE = 1 << 20
+
+INDEX_FILE = "index.faiss"
+CHUNKS_FILE = "chunks.parquet"
+
+
+# ==================== Vector store (pickle-free) ====================
+class ArrowDocstore(InMemoryDocstore):
+    """
+    以 chunks.parquet 的 Arrow 欄位作為 docstore：不為每個 chunk 建立常駐的 Document，search 時才由該列建立
+
+    之後加入的文件（/ingest 發佈）沿用 InMemoryDocstore 的 _dict
+    """
+
+    def __init__(self, table: pa.Table, doc_ids: List[str]):
+        super().__init__()
+        self._text = table.column("text").combine_chunks()
+        self._metadata = table.column("metadata").combine_chunks()
+        self._rows = {doc_id: row for row, doc_id in enumerate(doc_ids)}
+
+    def __len__(self) -> int:
+        return len(self._rows) + len(self._dict)
+
+    @property
+    def nbytes(self) -> int:
+        """Arrow 欄位 + doc_id → 列號對照（_dict 中的文件另計）"""
+        return self._text.nbytes + self._metadata.nbytes + len(self._rows) * 120
+
+    def add(self, texts: Dict[str, Document]) -> None:
+        overlapping = set(texts).intersection(self._rows)
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        super().add(texts)
+
+    def delete(self, ids: List) -> None:
+        rows = set(ids).intersection(self._rows)
+        for doc_id in rows:
+            del self._rows[doc_id]
+        rest = [doc_id for doc_id in ids if doc_id not in rows]
+        if rest or not rows:
+            super().delete(rest)
+
+    def search(self, search: str) -> Union[str, Document]:
+        row = self._rows.get(search)
+        if row is None:
+            return super().search(search)
+        return Document(page_content=self._text[row].as_py(), metadata=json.loads(self._metadata[row].as_py()))
+
+
+def write_vector_store(vector_store: FAISS, directory) -> None:
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    ids = sorted(vector_store.index_to_docstore_id)
+    doc_ids = [vector_store.index_to_docstore_id[i] for i in ids]
+    docs = [vector_store.docstore.search(d) for d in doc_ids]
+    table = pa.table({
+        "faiss_id": pa.array(ids, type=pa.int64()),
+        "doc_id": pa.array(doc_ids, type=pa.string()),
+        "text": pa.array([d.page_content for d in docs], type=pa.string()),
+        "metadata": pa.array([json.dumps(d.metadata, ensure_ascii=False) for d in docs], type=pa.string()),
+    })
+    # 先寫 index，chunks.parquet 最後寫入：存在 chunks.parquet 即表示整個目錄完整；
+    # 兩者都寫到暫存檔再改名，已 mmap 舊檔的行程不受影響
+    tmp = directory / (INDEX_FILE + ".tmp")
+    faiss.write_index(vector_store.index, str(tmp))
+    os.replace(tmp, directory / INDEX_FILE)
+    tmp = directory / (CHUNKS_FILE + ".tmp")
+    pq.write_table(table, tmp)
+    os.replace(tmp, directory / CHUNKS_FILE)
+
+
+def read_vector_store(directory, embeddings) -> Optional[FAISS]:
+    """
+    沒有 chunks.parquet（尚未建立或舊的 pickle 格式）時回傳 None
+
+    向量編碼直接 mmap（不複製進記憶體，也不能就地 add：加入文件時以 vector_storage.owned_copy 複製）；
+    chunk 的文字與 metadata 留在 Arrow 欄位，只把 faiss_id / doc_id 轉成 Python 物件
+    """
+    directory = Path(directory)
+    if not (directory / CHUNKS_FILE).exists() or not (directory / INDEX_FILE).exists():
+        return None
+    index = faiss.read_index(str(directory / INDEX_FILE), faiss.IO_FLAG_MMAP_IFC)
+    table = pq.read_table(directory / CHUNKS_FILE, memory_map=True)
+    doc_ids = table.column("doc_id").to_pylist()
+    docstore = ArrowDocstore(table, doc_ids)
+    if len(docstore) != index.ntotal:
+        print(f"✗ chunks.parquet 筆數 ({len(docstore)}) 與索引 ({index.ntotal}) 不符")
+        return None
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=dict(zip(table.column("faiss_id").to_pylist(), doc_ids)),
+    )
+
+
+# ==================== Export / import ====================
+def _copy(source: Path, target: Path) -> Dict[str, Any]:
+    """串流複製並同時計算 sha256"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    h = hashlib.sha256()
+    size = 0
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        for block in iter(lambda: src.read(COPY_BLOCK_SIZE), b""):
+            h.update(block)
+            dst.write(block)
+            size += len(block)
+    return {"bytes": size, "sha256": h.hexdigest()}
+
+
+def _sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _index_files(key: str) -> Dict[str, Path]:
+    """快照內的檔名 → cache 中對應的檔案"""
+    cache = Path("cache")
+    return {
+        INDEX_FILE: cache / f"{key}_vector_store" / INDEX_FILE,
+        CHUNKS_FILE: cache / f"{key}_vector_store" / CHUNKS_FILE,
+        "vectors.npy": cache / f"{key}_vectors.npy",
+        "filters.npz": cache / f"{key}_filters.npz",
+        "sentences.npy": cache / f"{key}_sentences.npy",
+        "sentences.npz": cache / f"{key}_sentences.npz",
+    }
+
+
+def export_snapshot(kb: str, target) -> Dict[str, Any]:
+    """把知識庫目前有效的索引匯出成快照目錄（先寫到暫存目錄，完成後才改名）"""
+    # 延遲 import：rag_core 以本模組讀寫向量庫
+    from ..core.config import get_knowledge_bases
+    from . import rag_core
+    from .index_manifest import validate_manifest
+
+    kbs = get_knowledge_bases()
+    if kb not in kbs:
+        raise ValueError(f"找不到知識庫: {kb}（可用: {', '.join(kbs)}）")
+    source = kbs[kb]
+    manifest = validate_manifest(source, rag_core.get_index_params())
+    if manifest is None:
+        raise ValueError(f"知識庫 {kb} 沒有有效的索引，請先啟動服務建立索引")
+    if rag_core.load_vector_store(source) is None:   # 舊的 pickle 格式在此轉成 chunks.parquet
+        raise ValueError(f"知識庫 {kb} 的向量庫讀取失敗")
+
+    target = Path(target)
+    if target.exists():
+        raise ValueError(f"目標已存在: {target}")
+    tmp = target.with_name(target.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    files: Dict[str, Dict[str, Any]] = {}
+    for name, path in _index_files(manifest.index_key).items():
+        if path.exists():
+            files[name] = _copy(path, tmp / name)
+    if "vectors.npy" not in files:
+        # flat 模式沒有另存原始向量：由索引還原（與原始向量相同）
+        index = faiss.read_index(str(tmp / INDEX_FILE))
+        np.save(tmp / "vectors.npy", index.reconstruct_n(0, index.ntotal))
+        files["vectors.npy"] = {"bytes": (tmp / "vectors.npy").stat().st_size, "sha256": _sha256(tmp / "vectors.npy")}
+    for path in sorted(rag_core.published_dir(source).glob("*.npz")):
+        files[f"published/{path.name}"] = _copy(path, tmp / "published" / path.name)
+
+    meta = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "kb": kb,
+        "created_at": time.time(),
+        "index": asdict(manifest),
+        "files": files,
+    }
+    (tmp / "manifest.json").write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp.rename(target)
+    return meta
+
+
+def read_snapshot_manifest(directory, verify: bool = True) -> Dict[str, Any]:
+    directory = Path(directory)
+    meta = json.loads((directory / "manifest.json").read_text(encoding="utf-8"))
+    if meta.get("format") != SNAPSHOT_FORMAT or meta.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"不支援的快照格式: {meta.get('format')} v{meta.get('version')}")
+    if verify:
+        for name, info in meta["files"].items():
+            path = directory / name
+            if not path.exists() or path.stat().st_size != info["bytes"] or _sha256(path) != info["sha256"]:
+                raise ValueError(f"快照檔案損毀或不完整: {name}")
+    return meta
+
+
+def import_snapshot(directory, kb: Optional[str] = None, source: Optional[str] = None) -> Tuple[str, str]:
+    """
+    驗證快照並放進 cache，寫入 index manifest；回傳 (知識庫名稱, 來源文件)
+
+    來源文件存在時必須與建立快照時的內容相同；不存在（只部署索引的節點）時沿用快照記錄的來源資訊
+    """
+    from ..core.config import RAG_VECTOR_STORAGE, get_knowledge_bases
+    from . import rag_core
+    from .index_manifest import IndexManifest, hash_file, save_manifest
+
+    directory = Path(directory)
+    meta = read_snapshot_manifest(directory)
+    manifest = IndexManifest(**meta["index"])
+    params = json.loads(json.dumps(rag_core.get_index_params(), sort_keys=True))
+    if manifest.params != params:
+        raise ValueError(f"快照的索引參數與目前設定不同，載入時會重建: {manifest.params} → {params}")
+    kb = kb or meta["kb"]
+    source = source or get_knowledge_bases().get(kb) or manifest.source_path
+    if os.path.exists(source):
+        st = os.stat(source)
+        if st.st_size != manifest.source_size or hash_file(source) != manifest.source_hash:
+            raise ValueError(f"來源文件 {source} 與建立快照時的內容不同")
+        manifest.source_size, manifest.source_mtime_ns = st.st_size, st.st_mtime_ns
+    manifest.source_path = str(Path(source).resolve())
+
+    for name, path in _index_files(manifest.index_key).items():
+        if name not in meta["files"] or (name == "vectors.npy" and RAG_VECTOR_STORAGE == "flat"):
+            continue
+        path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copyfile(directory / name, path)
+    published = rag_core.published_dir(source)
+    for name in meta["files"]:
+        if name.startswith("published/"):
+            published.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(directory / name, published / Path(name).name)
+    save_manifest(manifest)   # 所有檔案就位後才寫 manifest
+    return kb, source
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.services.snapshot", description="索引快照匯出 / 匯入")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_export = sub.add_parser("export", help="匯出知識庫的索引快照")
+    p_export.add_argument("kb")
+    p_export.add_argument("target")
+    p_import = sub.add_parser("import", help="匯入索引快照到 cache")
+    p_import.add_argument("snapshot")
+    p_import.add_argument("--kb", default=None, help="知識庫名稱（預設為匯出時的名稱）")
+    p_import.add_argument("--source", default=None, help="來源文件路徑（預設由知識庫設定取得）")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    try:
+        if args.command == "export":
+            meta = export_snapshot(args.kb, args.target)
+            size = sum(f["bytes"] for f in meta["files"].values())
+            print(f"✓ 已匯出 {args.kb} → {args.target}（{len(meta['files'])} 個檔案，{size / 1024 / 1024:.1f} MB，"
+                  f"{time.perf_counter() - start:.2f} 秒）")
+        else:
+            kb, source = import_snapshot(args.snapshot, args.kb, args.source)
+            print(f"✓ 已匯入快照 → 知識庫 {kb}（{source}），{time.perf_counter() - start:.2f} 秒")
+    except ValueError as e:
+        parser.exit(1, f"✗ {e}\n")
+
+
+if __name__ == "__main__":
+    main()
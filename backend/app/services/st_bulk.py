@@ -0,0 +1,248 @@
+"""
+Bulk ST parsing
+
+整個 PLC 專案（數百個匯出的 POU 檔）一次解析：
+
+- 輸入為 zip（request body 直接是 zip 檔）或 JSON 多檔 {"files": [{"name", "code"}]}
+- 解析在 ProcessPoolExecutor（spawn）執行：regex / tokenizer 是純 Python 的 CPU 工作，放在 worker 行程
+  才不會佔住事件迴圈的 GIL，同一個 worker 上的 chat 串流不受影響
+- 小檔案合併成批次（約 BULK_BATCH_BYTES）再送進 pool，減少行程間往返；同時排隊的批次數有上限
+  （worker 數 × BULK_WINDOW），zip 成員邊讀邊送，不會一次全部解壓
+- 結果依完成順序以 NDJSON 逐檔回傳，最後一行為彙總（全部變數的總表、VAR_GLOBAL 的型別衝突）
+- ST_BULK_WORKERS=0 時不使用 worker 行程，改在執行緒中解析（測試或單核環境）
+"""
+import asyncio
+import io
+import json
+import multiprocessing
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import PurePosixPath
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple
+
+BULK_WORKERS = int(os.getenv("ST_BULK_WORKERS", str(min(4, os.cpu_count() or 1))))
+BULK_MAX_MB = int(os.getenv("ST_BULK_MAX_MB", "50"))          # 上傳大小上限（zip 解壓後的總大小也套用）
+BULK_MAX_FILES = int(os.getenv("ST_BULK_MAX_FILES", "5000"))
+BULK_WINDOW = 2                                                # 每個 worker 同時排隊的批次數
+BULK_BATCH_BYTES = 64 << 10                                    # 每個批次的原始碼大小（超過的檔案單獨一批）
+
+# 專案匯出常見的副檔名；zip 內其他檔案略過
+ST_FILE_SUFFIXES = {".st", ".exp", ".iecst", ".scl", ".txt", ".pou"}
+# 沒有 BOM 時依序嘗試；cp950 為中文 Windows 匯出的預設編碼
+ENCODINGS = ("utf-8", "cp950")
+
+SourceFile = Tuple[str, bytes]
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+# ==================== Worker ====================
+def _init_worker() -> None:
+    # 先載入解析器，第一個檔案不用等 import
+    from . import st_code_parser_backend  # noqa: F401
+
+
+def decode_source(data: bytes) -> Tuple[str, str]:
+    """bytes → (文字, 使用的編碼)"""
+    if data.startswith(b"\xef\xbb\xbf"):
+        return data[3:].decode("utf-8", errors="replace"), "utf-8-sig"
+    if data.startswith((b"\xff\xfe", b"\xfe\xff")):
+        return data.decode("utf-16", errors="replace"), "utf-16"
+    for encoding in ENCODINGS:
+        try:
+            return data.decode(encoding), encoding
+        except UnicodeDecodeError:
+            continue
+    return data.decode("latin-1"), "latin-1"
+
+
+def parse_file(name: str, data: bytes, extract_type: str) -> Dict[str, Any]:
+    """在 worker 行程中解析單一檔案，回傳可直接序列化的 dict"""
+    from .st_code_parser_backend import parse_response
+
+    start = time.perf_counter()
+    code, encoding = decode_source(data)
+    response, pous = parse_response(code, extract_type)
+    return {
+        "type": "file",
+        "file": name,
+        "encoding": encoding,
+        "pous": pous,
+        **response.model_dump(),
+        "ms": round((time.perf_counter() - start) * 1000, 2),
+    }
+
+
+def parse_batch(files: List[SourceFile], extract_type: str) -> List[Tuple[Dict[str, Any], str]]:
+    """解析一個批次；每個檔案回傳 (結果, NDJSON 行)，序列化也在 worker 行程完成"""
+    results = []
+    for name, data in files:
+        try:
+            result = parse_file(name, data, extract_type)
+        except Exception as e:
+            result = {"type": "file", "file": name, "success": False, "message": f"解析失敗: {e}"}
+        results.append((result, json.dumps(result, ensure_ascii=False) + "\n"))
+    return results
+
+
+# ==================== Inputs ====================
+def _accept(name: str) -> bool:
+    path = PurePosixPath(name)
+    if any(part.startswith(".") or part == "__MACOSX" for part in path.parts):
+        return False
+    return path.suffix.lower() in ST_FILE_SUFFIXES
+
+
+def open_zip(data: bytes) -> Tuple[zipfile.ZipFile, List[zipfile.ZipInfo], List[str]]:
+    """檢查 zip 內容（檔案數、解壓後大小）；回傳 (zip, 要解析的成員, 略過的檔名)"""
+    try:
+        archive = zipfile.ZipFile(io.BytesIO(data))
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"不是有效的 zip 檔: {e}")
+    members, skipped = [], []
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        (members if _accept(info.filename) else skipped).append(info)
+    if len(members) > BULK_MAX_FILES:
+        raise ValueError(f"檔案數 {len(members)} 超過上限 {BULK_MAX_FILES}")
+    if sum(info.file_size for info in members) > BULK_MAX_MB << 20:
+        raise ValueError(f"解壓後超過 {BULK_MAX_MB} MB")
+    return archive, members, [info.filename for info in skipped]
+
+
+def iter_zip(archive: zipfile.ZipFile, members: List[zipfile.ZipInfo]) -> Iterator[SourceFile]:
+    for info in members:
+        yield info.filename, archive.read(info)
+
+
+# ==================== Pool ====================
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool
+    if _pool is None and BULK_WORKERS > 0:
+        _pool = ProcessPoolExecutor(
+            max_workers=BULK_WORKERS, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker,
+        )
+    return _pool
+
+
+def shutdown() -> None:
+    """關閉 worker 行程；之後的呼叫會重新建立 pool"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def parse_files(
+    files: Iterator[SourceFile], extract_type: str,
+) -> AsyncIterator[Tuple[Dict[str, Any], str]]:
+    """
+    平行解析多個檔案，依批次完成順序 yield 每個檔案的 (結果, NDJSON 行)
+
+    files 為同步 iterator（zip 成員讀取在執行緒中進行）；呼叫端中斷時尚未開始的檔案會被取消
+    """
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    window = max(1, BULK_WORKERS) * BULK_WINDOW
+    pending = set()
+    exhausted = False
+
+    def next_batch() -> List[SourceFile]:
+        batch, size = [], 0
+        while size < BULK_BATCH_BYTES:
+            item = next(files, None)
+            if item is None:
+                break
+            batch.append(item)
+            size += len(item[1])
+        return batch
+
+    def submit(batch: List[SourceFile]) -> asyncio.Future:
+        if pool is None:
+            return asyncio.ensure_future(asyncio.to_thread(parse_batch, batch, extract_type))
+        return loop.run_in_executor(pool, parse_batch, batch, extract_type)
+
+    try:
+        while pending or not exhausted:
+            while not exhausted and len(pending) < window:
+                batch = await asyncio.to_thread(next_batch)
+                exhausted = len(batch) == 0
+                if batch:
+                    pending.add(submit(batch))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    results = future.result()
+                except BrokenProcessPool:
+                    shutdown()   # worker 行程異常結束後 pool 無法再使用，下次重新建立
+                    raise
+                for item in results:
+                    yield item
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+# ==================== Summary ====================
+class BulkSummary:
+    """累積每個檔案的結果，最後產生彙總（總表依檔名與行號排序）"""
+
+    def __init__(self, with_table: bool = True):
+        self.with_table = with_table
+        self.files = 0
+        self.failed: List[str] = []
+        self.pous = 0
+        self.rows: List[Dict[str, Any]] = []
+        self.variable_count = 0
+        self._globals: Dict[str, Dict[Tuple[str, str], Set[str]]] = {}
+        self._start = time.perf_counter()
+
+    def add(self, result: Dict[str, Any]) -> None:
+        self.files += 1
+        if not result.get("success"):
+            self.failed.append(result["file"])
+            return
+        self.pous += len(result.get("pous") or [])
+        for v in result.get("variables") or []:
+            self.variable_count += 1
+            if self.with_table:
+                self.rows.append({"file": result["file"], **v})
+            if v["class_name"].split(" ", 1)[0] == "VAR_GLOBAL":
+                decls = self._globals.setdefault(v["identifier"].upper(), {})
+                decls.setdefault((v["var_type"], v["address"]), set()).add(result["file"])
+
+    def conflicts(self) -> List[Dict[str, Any]]:
+        """多個檔案宣告同名 VAR_GLOBAL 但型別或位址不同（合併專案時需要處理）"""
+        return [
+            {
+                "identifier": name,
+                "declarations": [
+                    {"var_type": var_type, "address": address, "files": sorted(files)}
+                    for (var_type, address), files in sorted(decls.items())
+                ],
+            }
+            for name, decls in sorted(self._globals.items())
+            if len(decls) > 1
+        ]
+
+    def result(self, skipped: List[str]) -> Dict[str, Any]:
+        summary = {
+            "type": "summary",
+            "files": self.files,
+            "parsed": self.files - len(self.failed),
+            "failed": sorted(self.failed),
+            "skipped": skipped,
+            "pous": self.pous,
+            "variable_count": self.variable_count,
+            "conflicts": self.conflicts(),
+            "seconds": round(time.perf_counter() - self._start, 3),
+        }
+        if self.with_table:
+            summary["variables"] = sorted(self.rows, key=lambda r: (r["file"], r["line"]))
+        return summary
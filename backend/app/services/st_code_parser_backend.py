@@ -1,15 +1,35 @@
-import re
-import pandas as pd
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List, Dict, Optional
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+import os
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
+from typing import Iterable, List, Dict, Optional, Tuple
 import json
 
+from . import st_bulk
+from .st_export import EXPORT_FORMATS, iter_export
+from .st_incremental import IncrementalParser, StaleDocumentError, TextEdit
+from .st_xref import CALL, READ, WRITE, Symbol, SymbolIndex, scan_program
+from .st_tokenizer import STProgram, VarDecl, parse_declarations, parse_program
+
 # ==================== 請求/回應 ====================
 class STCodeRequest(BaseModel):
     code: str
     extract_type: str = "both"  # "variables", "logic", "both"
 
+class STBulkFile(BaseModel):
+    name: str
+    code: str
+
+class STBulkRequest(BaseModel):
+    files: List[STBulkFile]
+
+class STExportRequest(BaseModel):
+    code: str
+    format: str = "csv"  # "csv", "parquet", "arrow"
+
 class Variable(BaseModel):
     class_name: str = "VAR"
     identifier: str
@@ -17,6 +37,8 @@ class Variable(BaseModel):
     var_type: str
     initial_value: str = ""
     comment: str = ""
+    pou: str = ""                 # 所屬 POU 名稱（沒有 PROGRAM 包裹時為空字串；巢狀 METHOD / ACTION 為 FB_A.Init）
+    line: int = 0                 # 宣告所在行號（清除 markdown 後）
 
 class STCodeResponse(BaseModel):
     variables: Optional[List[Variable]] = None
@@ -25,16 +47,65 @@ class STCodeResponse(BaseModel):
     success: bool
     message: str = ""
 
+class STTextEdit(BaseModel):
+    start: int                    # 上一版程式碼的字元位置
+    end: int
+    text: str = ""
+
+class STIncrementalRequest(BaseModel):
+    document_id: str
+    version: int
+    code: Optional[str] = None                  # 整份程式碼（第一次或重新同步時）
+    edits: Optional[List[STTextEdit]] = None    # 相對於 base_version 的修改
+    base_version: Optional[int] = None
+
+class STIncrementalResponse(BaseModel):
+    document_id: str
+    version: int
+    full_reparse: bool
+    reparsed_pous: List[str] = []
+    added: List[Variable] = []
+    removed: List[Variable] = []
+    changed: List[Variable] = []
+    variable_count: int = 0
+    success: bool = True
+    message: str = ""
+
+class STXrefLoadRequest(BaseModel):
+    program_id: str               # 例如檔名；同名會取代
+    code: str
+
+class SymbolReference(BaseModel):
+    program: str
+    pou: str
+    kind: str                     # "read", "write", "call"
+    line: int
+    start: int
+    end: int
+
+class SymbolInfo(BaseModel):
+    program: str
+    variable: Variable
+    reads: int = 0
+    writes: int = 0
+    calls: int = 0
+    references: List[SymbolReference] = []
+
 # ==================== ST Code 解析器類別 ====================
 class STCodeParser:
-    """ST Code 解析器，從 ST Code 中提取變數和邏輯"""
+    """ST Code 解析器，從 ST Code 中提取變數和邏輯（底層為 st_tokenizer 的單次掃描解析）"""
     
-    def __init__(self):
-        # 變數宣告的正則表達式 - 參考爾諾的格式
-        self.var_pattern = re.compile(
-            r'^\s*(\w+(?:\s*,\s*\w+)*)\s*(AT\s+[%\w]+)?\s*:\s*(\w+(?:\s*\[.*\])?(?:\s*OF\s*\w+)?)\s*(:=?\s*(.*?))?\s*;\s*(//.*)?$',
-            re.IGNORECASE | re.MULTILINE
-        )
+    def parse_program(self, st_code: str) -> STProgram:
+        """
+        解析 ST Code 的完整結構（多個 POU、所有 VAR 區塊種類）
+        
+        Args:
+            st_code: 完整的 ST 程式碼字串（可包含 markdown 標記）
+            
+        Returns:
+            STProgram: POU / VAR 區塊 / 宣告與其在原始碼中的位置
+        """
+        return parse_program(self._clean_markdown(st_code))
     
     def parse_st_code(self, st_code: str) -> tuple[str, str, str]:
         """
@@ -46,108 +117,160 @@ class STCodeParser:
         Returns:
             tuple: (清理後的程式碼, VAR 區塊內容, 邏輯區塊內容)
         """
-        # 先清理 markdown 標記（如果有）
-        clean_code = self._clean_markdown(st_code)
-        
-        # 提取 VAR 和邏輯區塊
-        var_section, logic_code = self._extract_sections(clean_code)
-        
-        return clean_code, var_section, logic_code
+        program = self.parse_program(st_code)
+        return program.source, program.var_section_text(), program.logic_code()
     
     def _clean_markdown(self, code: str) -> str:
-        """清除 markdown 程式碼標記"""
-        # 尋找 ```st 或 ```python 或單純 ``` 包裹的程式碼
-        code_blocks = re.findall(
-            r"```(?:st|python|)?\s*(.*?)\s*```", 
-            code, 
-            re.DOTALL | re.IGNORECASE
-        )
-        
-        # 如果找到程式碼區塊，取最後一個
-        if code_blocks:
-            return code_blocks[-1].strip()
-        
-        # 否則返回原始程式碼
-        return code.strip()
-    
-    def _extract_sections(self, code: str) -> tuple[str, str]:
-        """
-        從 ST Code 中提取 VAR 區塊和邏輯區塊
-        
-        Returns:
-            tuple: (VAR 區塊內容, 邏輯區塊內容)
-        """
-        var_start_match = re.search(r'VAR\s*', code, re.IGNORECASE)
-        var_end_match = re.search(r'END_VAR\s*', code, re.IGNORECASE)
+        """清除 markdown 程式碼標記（取最後一個 ``` 區塊）"""
+        fences = []
+        pos = code.find("```")
+        while pos >= 0:
+            fences.append(pos)
+            pos = code.find("```", pos + 3)
         
-        var_section = ""
-        logic_code = code
+        # 沒有成對的 ``` 時返回原始程式碼
+        if len(fences) < 2:
+            return code.strip()
         
-        # 如果找到完整的 VAR...END_VAR 區塊
-        if var_start_match and var_end_match and var_start_match.start() < var_end_match.start():
-            # 提取 VAR 內容（不含 VAR 和 END_VAR 關鍵字）
-            var_section = code[var_start_match.end():var_end_match.start()].strip()
-            # 提取邏輯部分（END_VAR 之後的所有內容）
-            logic_code = code[var_end_match.end():].strip()
-        
-        return var_section, logic_code
+        # ``` 依序成對，取最後一對
+        last_pair = (len(fences) // 2) * 2
+        open_at, close_at = fences[last_pair - 2], fences[last_pair - 1]
+        body = code[open_at + 3:close_at]
+        # 去掉語言標記（```st、```iecst ...）
+        first_line, sep, rest = body.partition("\n")
+        if sep and (not first_line.strip() or first_line.strip().isidentifier()):
+            body = rest
+        return body.strip()
     
     def parse_variables(self, var_section: str) -> List[Variable]:
         """
         解析 VAR 區塊，提取所有變數宣告
         
         Args:
-            var_section: VAR 區塊的內容（不含 VAR/END_VAR）
+            var_section: VAR 區塊的內容（可不含 VAR/END_VAR，也可包含多個 VAR_xxx 區塊）
             
         Returns:
             List[Variable]: 變數列表
         """
         if not var_section:
             return []
-        
-        variables = []
-        
-        # 逐行解析
-        for line in var_section.splitlines():
-            if not line.strip():
-                continue
-            
-            match = self.var_pattern.match(line.strip())
-            if not match:
-                continue
-            
-            groups = match.groups()
-            
-            # 提取各個欄位
-            identifiers_str = groups[0] or ''
-            address = groups[1].strip() if groups[1] else ''
-            var_type = groups[2].strip() if groups[2] else ''
-            initial_value = groups[4].strip() if groups[4] else ''
-            comment = groups[5].strip() if groups[5] else ''
-            
-            # 處理多個變數在同一行的情況（例如：a, b, c : INT）
-            id_list = [i.strip() for i in identifiers_str.split(',') if i.strip()]
-            
-            for i, identifier in enumerate(id_list):
-                # 初始值只套用到單一變數宣告
-                applied_initial_value = initial_value if len(id_list) == 1 else ''
-                # 註解只套用到該行最後一個變數
-                applied_comment = comment if i == len(id_list) - 1 else ''
-                
-                variables.append(Variable(
-                    class_name="VAR",
-                    identifier=identifier,
-                    address=address,
-                    var_type=var_type,
-                    initial_value=applied_initial_value,
-                    comment=applied_comment
-                ))
-        
-        return variables
+        return self.to_variables(parse_declarations(var_section))
+    
+    @staticmethod
+    def to_variables(decls: Iterable[VarDecl]) -> List[Variable]:
+        """將 tokenizer 的宣告轉為 API 回應模型"""
+        return [
+            Variable(
+                class_name=d.section,
+                identifier=d.identifier,
+                address=d.address,
+                var_type=d.var_type,
+                initial_value=d.initial_value,
+                comment=d.comment,
+                pou=d.qualified_pou,
+                line=d.line,
+            )
+            for d in decls
+        ]
 
 # ==================== FastAPI  ====================
 # 初始化
 parser = STCodeParser()
+incremental_parser = IncrementalParser(max_documents=int(os.getenv("ST_INCREMENTAL_MAX_DOCS", "64")))
+symbol_index = SymbolIndex()
+
+
+class _DocumentLocks:
+    """每份文件一個 asyncio.Lock（增量解析在執行緒中進行，同一文件的版本必須依序套用）；沒有等待者時移除"""
+
+    def __init__(self):
+        self._locks: Dict[str, List] = {}   # document_id → [Lock, 使用中的請求數]
+
+    @asynccontextmanager
+    async def hold(self, document_id: str):
+        entry = self._locks.setdefault(document_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[document_id]
+
+
+incremental_locks = _DocumentLocks()
+
+
+def parse_response(code: str, extract_type: str) -> Tuple[STCodeResponse, List[str]]:
+    """解析並依 extract_type 組成回應；另外回傳 POU 名稱（bulk 解析的 worker 行程也使用）"""
+    try:
+        # 解析程式碼（單次掃描，所有 POU 與 VAR 區塊）
+        program = parser.parse_program(code)
+        
+        response = STCodeResponse(success=True)
+        
+        # 根據要求提取內容
+        if extract_type in ["variables", "both"]:
+            response.variables = parser.to_variables(program.declarations)
+            response.raw_var_section = program.var_section_text()
+        
+        if extract_type in ["logic", "both"]:
+            response.logic_code = program.logic_code()
+        
+        response.message = f"成功解析 ST 程式碼"
+        return response, [p.name for p in program.pous if p.kind]
+        
+    except Exception as e:
+        return STCodeResponse(
+            success=False,
+            message=f"解析失敗: {str(e)}"
+        ), []
+
+
+async def _read_body(request: Request, limit: int) -> bytes:
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            raise HTTPException(status_code=413, detail=f"上傳內容超過 {limit >> 20} MB")
+    if not body:
+        raise HTTPException(status_code=400, detail="request body 為空")
+    return bytes(body)
+
+
+def _symbol_info(sym: Symbol, with_references: bool = True) -> SymbolInfo:
+    return SymbolInfo(
+        program=sym.program,
+        variable=parser.to_variables([sym.decl])[0],
+        reads=sym.count(READ),
+        writes=sym.count(WRITE),
+        calls=sym.count(CALL),
+        references=[SymbolReference(**vars(r)) for r in sym.references] if with_references else [],
+    )
+
+
+def _export_response(code: str, fmt: str) -> StreamingResponse:
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支援的匯出格式: {fmt}")
+    
+    decls = parser.parse_program(code).declarations
+    first = next(decls, None)
+    if first is None:
+        raise HTTPException(status_code=400, detail="沒有找到變數宣告")
+    
+    try:
+        body = iter_export(fmt, itertools.chain([first], decls))
+    except RuntimeError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    
+    media_type, ext = EXPORT_FORMATS[fmt]
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="variables.{ext}"'},
+    )
+
 
 def add_st_parser_routes(app: FastAPI):
     """將 ST 解析器路由加入現有的 FastAPI app"""
@@ -162,57 +285,163 @@ def add_st_parser_routes(app: FastAPI):
         - "logic": 只提取邏輯程式碼
         - "both": 提取兩者（預設）
         """
-        try:
-            # 解析程式碼
-            clean_code, var_section, logic_code = parser.parse_st_code(request.code)
-            
-            response = STCodeResponse(success=True)
-            
-            # 根據要求提取內容
-            if request.extract_type in ["variables", "both"]:
-                variables = parser.parse_variables(var_section)
-                response.variables = variables
-                response.raw_var_section = var_section
-            
-            if request.extract_type in ["logic", "both"]:
-                response.logic_code = logic_code
-            
-            response.message = f"成功解析 ST 程式碼"
-            return response
-            
-        except Exception as e:
-            return STCodeResponse(
-                success=False,
-                message=f"解析失敗: {str(e)}"
+        # 解析是 CPU 工作，在執行緒中進行，不阻塞事件迴圈上的其他串流
+        response, _ = await asyncio.to_thread(parse_response, request.code, request.extract_type)
+        return response
+    
+    @app.post("/api/parse_st_code/bulk")
+    async def parse_st_code_bulk(request: Request, extract_type: str = "both", table: bool = True):
+        """
+        一次解析多個 ST 檔案（整個 PLC 專案），以 NDJSON 串流回傳
+        
+        request body 二擇一：
+        - zip 檔（Content-Type: application/zip 或 application/octet-stream），解析其中的 .st / .exp 等檔案
+        - JSON：{"files": [{"name": "...", "code": "..."}]}
+        
+        每個檔案解析完成即回傳一行 {"type": "file", "file", "pous", "variables", ...}（依完成順序），
+        最後一行為 {"type": "summary", ...}：檔案 / POU / 變數數量、失敗與略過的檔案、
+        VAR_GLOBAL 的型別衝突，table=true 時附上所有變數的總表（含 file 欄位）
+        """
+        body = await _read_body(request, st_bulk.BULK_MAX_MB << 20)
+        content_type = request.headers.get("content-type", "").split(";", 1)[0].strip().lower()
+        skipped: List[str] = []
+        if content_type == "application/json":
+            try:
+                payload = STBulkRequest.model_validate_json(body)
+            except ValidationError as e:
+                raise HTTPException(status_code=422, detail=e.errors(include_url=False))
+            if len(payload.files) > st_bulk.BULK_MAX_FILES:
+                raise HTTPException(status_code=400, detail=f"檔案數超過上限 {st_bulk.BULK_MAX_FILES}")
+            count = len(payload.files)
+            files = iter([(f.name, f.code.encode("utf-8")) for f in payload.files])
+        else:
+            try:
+                archive, members, skipped = await asyncio.to_thread(st_bulk.open_zip, body)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            count = len(members)
+            files = st_bulk.iter_zip(archive, members)
+        if count == 0:
+            raise HTTPException(status_code=400, detail="沒有可解析的 ST 檔案")
+        
+        async def lines():
+            summary = st_bulk.BulkSummary(with_table=table)
+            try:
+                async for result, line in st_bulk.parse_files(files, extract_type):
+                    summary.add(result)
+                    yield line
+            except Exception as e:
+                yield json.dumps({"type": "error", "message": f"解析中斷: {e}"}, ensure_ascii=False) + "\n"
+                return
+            # 總表可能很大，排序與序列化放在執行緒
+            yield await asyncio.to_thread(
+                lambda: json.dumps(summary.result(skipped), ensure_ascii=False) + "\n"
             )
+        
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+    
+    @app.post("/api/parse_st_code/incremental", response_model=STIncrementalResponse)
+    async def parse_st_code_incremental(request: STIncrementalRequest):
+        """
+        編輯器用的增量解析，只回傳變數差異
+        
+        - 第一次（或收到 409 後）送出 code；之後只送 edits + base_version
+        - code 為原始 ST（不做 markdown 清理），edits 的位置以 base_version 的程式碼為準
+        """
+        edits = [TextEdit(e.start, e.end, e.text) for e in request.edits] if request.edits else None
+        try:
+            # 第一次送出 code 時為完整解析：在執行緒中進行，不佔住 event loop
+            async with incremental_locks.hold(request.document_id):
+                delta = await asyncio.to_thread(
+                    incremental_parser.update,
+                    request.document_id,
+                    request.version,
+                    code=request.code,
+                    edits=edits,
+                    base_version=request.base_version,
+                )
+        except StaleDocumentError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        return STIncrementalResponse(
+            document_id=delta.document_id,
+            version=delta.version,
+            full_reparse=delta.full_reparse,
+            reparsed_pous=delta.reparsed_pous,
+            added=parser.to_variables(delta.added),
+            removed=parser.to_variables(delta.removed),
+            changed=parser.to_variables(delta.changed),
+            variable_count=delta.variable_count,
+            message=f"重新解析 {len(delta.reparsed_pous)} 個 POU",
+        )
+    
+    @app.delete("/api/parse_st_code/incremental/{document_id}")
+    async def drop_incremental_document(document_id: str):
+        """編輯器關閉文件時釋放快取"""
+        async with incremental_locks.hold(document_id):   # 等進行中的更新完成，避免更新後又存回快取
+            return {"success": incremental_parser.drop(document_id)}
+    
+    @app.post("/api/st_xref/programs")
+    async def load_xref_program(request: STXrefLoadRequest):
+        """解析程式並加入交叉參照索引（同一 program_id 會取代舊內容）"""
+        def prepare():
+            program = parser.parse_program(request.code)
+            return program, scan_program(program)
+
+        # 解析與本體掃描在執行緒中進行（整個專案可能很大），event loop 只做索引更新
+        program, scanned = await asyncio.to_thread(prepare)
+        count = symbol_index.add_program(request.program_id, program, scanned)
+        return {"success": True, "program_id": request.program_id, "symbol_count": count,
+                "programs": symbol_index.programs}
+    
+    @app.delete("/api/st_xref/programs/{program_id}")
+    async def drop_xref_program(program_id: str):
+        return {"success": symbol_index.remove_program(program_id), "programs": symbol_index.programs}
+    
+    @app.get("/api/st_xref/symbols/{name}", response_model=List[SymbolInfo])
+    async def lookup_symbol(name: str, program: Optional[str] = None, pou: Optional[str] = None):
+        """
+        查詢識別字的宣告與所有讀 / 寫 / 呼叫位置
+        
+        pou 可為完整名稱（FB_A.Init）只查詢該 FB 的 METHOD / ACTION，或名稱（Init）查詢所有同名 POU
+        """
+        return [_symbol_info(s) for s in symbol_index.lookup(name, program=program, pou=pou)]
+    
+    @app.get("/api/st_xref/unused", response_model=List[SymbolInfo])
+    async def list_unused_symbols(program: Optional[str] = None, section: Optional[str] = None):
+        """
+        列出沒有任何參照的變數
+        
+        section 可指定只列出某種 VAR 區塊，例如 "VAR"、"VAR_GLOBAL"
+        """
+        symbols = symbol_index.unused(program=program)
+        if section:
+            symbols = [s for s in symbols if s.decl.section.split(" ", 1)[0] == section.upper()]
+        return [_symbol_info(s, with_references=False) for s in symbols]
+    
+    @app.get("/api/st_xref/unresolved")
+    async def list_unresolved_symbols(program: Optional[str] = None):
+        """列出找不到宣告的識別字（函式、列舉值或拼錯的變數）與出現次數"""
+        return {name: len(refs) for name, refs in symbol_index.unresolved(program=program).items()}
+    
+    @app.post("/api/export_variables")
+    async def export_variables(request: STExportRequest):
+        """
+        將變數以串流方式匯出
+        
+        format 可選值：
+        - "csv": UTF-8 CSV（預設）
+        - "parquet": Apache Parquet（需要 pyarrow）
+        - "arrow": Arrow IPC stream（需要 pyarrow）
+        """
+        return _export_response(request.code, request.format.lower())
     
     @app.post("/api/export_variables_csv")
     async def export_variables_csv(request: STCodeRequest):
         """
-        將變數匯出為 CSV 格式
+        將變數匯出為 CSV 格式（串流回傳 text/csv）
         """
-        try:
-            _, var_section, _ = parser.parse_st_code(request.code)
-            variables = parser.parse_variables(var_section)
-            
-            if not variables:
-                raise HTTPException(status_code=400, detail="沒有找到變數宣告")
-            
-            # 轉換為 DataFrame
-            df_data = [v.dict() for v in variables]
-            df = pd.DataFrame(df_data)
-            
-            # 轉換為 CSV（使用 StringIO 在記憶體中處理）
-            from io import StringIO
-            csv_buffer = StringIO()
-            df.to_csv(csv_buffer, index=False, encoding='utf-8')
-            csv_content = csv_buffer.getvalue()
-            
-            return {
-                "success": True,
-                "csv_content": csv_content,
-                "row_count": len(variables)
-            }
-            
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+        return _export_response(request.code, "csv")
+
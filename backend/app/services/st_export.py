@@ -0,0 +1,142 @@
+"""
+ST 變數匯出
+
+直接由 st_tokenizer 的宣告串流輸出 CSV / Parquet / Arrow IPC，
+不經過 Pydantic 物件、dict 與 pandas DataFrame，記憶體用量只與批次大小有關。
+"""
+import csv
+import io
+from typing import Callable, Iterable, Iterator, List, Tuple
+
+from .st_tokenizer import VarDecl
+
+EXPORT_COLUMNS = ["class_name", "identifier", "address", "var_type", "initial_value", "comment", "pou", "line"]
+
+EXPORT_FORMATS = {
+    # format: (media type, 副檔名)
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+BATCH_ROWS = 1000
+
+
+def _row(d: VarDecl) -> Tuple:
+    return (d.section, d.identifier, d.address, d.var_type, d.initial_value, d.comment, d.qualified_pou, d.line)
+
+
+# ==================== CSV ====================
+def iter_csv(decls: Iterable[VarDecl], batch_rows: int = BATCH_ROWS) -> Iterator[bytes]:
+    """每 batch_rows 列輸出一段 UTF-8 CSV"""
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(EXPORT_COLUMNS)
+
+    pending = 0
+    for d in decls:
+        writer.writerow(_row(d))
+        pending += 1
+        if pending >= batch_rows:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+            pending = 0
+
+    tail = buf.getvalue()
+    if tail:
+        yield tail.encode("utf-8")
+
+
+# ==================== Parquet / Arrow（選用 pyarrow） ====================
+def _require_pyarrow():
+    try:
+        import pyarrow as pa
+    except ImportError as e:
+        raise RuntimeError("匯出 parquet / arrow 需要安裝 pyarrow") from e
+    return pa
+
+
+class _ChunkSink(io.RawIOBase):
+    """只寫不讀的 file-like，pyarrow 寫入的位元組可以隨時取出送給 client"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        data = bytes(b)
+        self._chunks.append(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _record_batches(pa, decls: Iterable[VarDecl], batch_rows: int):
+    schema = pa.schema(
+        [(name, pa.string()) for name in EXPORT_COLUMNS[:-1]] + [("line", pa.int32())]
+    )
+    columns: List[list] = [[] for _ in EXPORT_COLUMNS]
+
+    def flush():
+        arrays = [pa.array(col, type=f.type) for col, f in zip(columns, schema)]
+        for col in columns:
+            col.clear()
+        return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+    yield schema
+    for d in decls:
+        for col, value in zip(columns, _row(d)):
+            col.append(value)
+        if len(columns[0]) >= batch_rows:
+            yield flush()
+    if columns[0]:
+        yield flush()
+
+
+def _iter_arrow_writer(pa, open_writer: Callable, decls: Iterable[VarDecl], batch_rows: int) -> Iterator[bytes]:
+    sink = _ChunkSink()
+    batches = _record_batches(pa, decls, batch_rows)
+    writer = open_writer(sink, next(batches))
+    for batch in batches:
+        writer.write_batch(batch)
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def iter_export(fmt: str, decls: Iterable[VarDecl], batch_rows: int = BATCH_ROWS) -> Iterator[bytes]:
+    """
+    依格式建立匯出串流
+
+    選用相依套件（pyarrow）在這裡就檢查，讓呼叫端能在開始串流前回傳錯誤。
+
+    Raises:
+        ValueError: 不支援的格式
+        RuntimeError: 缺少 pyarrow
+    """
+    if fmt == "csv":
+        return iter_csv(decls, batch_rows)
+    if fmt == "parquet":
+        pa = _require_pyarrow()
+        import pyarrow.parquet as pq
+        return _iter_arrow_writer(pa, pq.ParquetWriter, decls, batch_rows)
+    if fmt == "arrow":
+        pa = _require_pyarrow()
+        return _iter_arrow_writer(pa, pa.ipc.new_stream, decls, batch_rows)
+    raise ValueError(f"不支援的匯出格式: {fmt}")
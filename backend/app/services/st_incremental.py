@@ -0,0 +1,284 @@
+"""
+ST 增量解析
+
+編輯器每次送出修改時，只重新解析受影響的 POU，並回傳變數差異：
+
+- 每份文件（document_id）快取上一版的原始碼、內容雜湊與解析結果（LRU，上限可設定）
+- 修改可以是文字差異（edits，以上一版的字元位置表示），也可以是整份程式碼；
+  整份程式碼會先以共同前綴 / 後綴換算成單一修改
+- 受影響範圍會擴張到前後最近的完整 POU 邊界（END_xxx 之後為乾淨的 token 邊界），
+  只解析該範圍，其後的 POU 僅位移 offset / 行號
+- 範圍內出現無法局部判斷的狀況（匿名頂層 POU、未閉合的 POU / 註解 / TYPE）時改為整份重新解析
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .st_tokenizer import COMMENT, POU, STProgram, VarDecl, parse_program, tokenize
+
+
+class StaleDocumentError(Exception):
+    """edits 的基準版本與快取不符（或快取已被淘汰），client 需要送出整份程式碼"""
+
+
+@dataclass
+class TextEdit:
+    start: int      # 上一版原始碼的字元位置
+    end: int
+    text: str
+
+
+@dataclass
+class ParseDelta:
+    document_id: str
+    version: int
+    full_reparse: bool
+    reparsed_pous: List[str] = field(default_factory=list)
+    added: List[VarDecl] = field(default_factory=list)
+    removed: List[VarDecl] = field(default_factory=list)
+    changed: List[VarDecl] = field(default_factory=list)
+    variable_count: int = 0
+
+
+@dataclass
+class _DocState:
+    version: int
+    digest: str
+    program: STProgram
+    variable_count: int
+
+
+def _digest(source: str) -> str:
+    return hashlib.sha1(source.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+def _common_prefix_len(a: str, b: str) -> int:
+    """二分搜尋共同前綴長度（每次比較都是 C 層級的字串比較）"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def diff_to_edit(old: str, new: str) -> TextEdit:
+    """將整份新程式碼換算為單一修改"""
+    prefix = _common_prefix_len(old, new)
+    max_suffix = min(len(old), len(new)) - prefix
+    suffix = _common_prefix_len(old[::-1][:max_suffix], new[::-1][:max_suffix])
+    return TextEdit(start=prefix, end=len(old) - suffix, text=new[prefix:len(new) - suffix])
+
+
+def apply_edits(source: str, edits: Iterable[TextEdit]) -> Tuple[str, int, int, int]:
+    """
+    套用修改（位置皆以上一版為準，不可重疊）
+
+    Returns:
+        (新原始碼, 舊版受影響起點, 舊版受影響終點, 長度變化)
+    """
+    ordered = sorted(edits, key=lambda e: e.start)
+    parts: List[str] = []
+    pos = 0
+    delta = 0
+    for e in ordered:
+        if e.start < pos or e.end < e.start or e.end > len(source):
+            raise ValueError(f"無效的修改範圍: {e.start}-{e.end}")
+        parts.append(source[pos:e.start])
+        parts.append(e.text)
+        delta += len(e.text) - (e.end - e.start)
+        pos = e.end
+    parts.append(source[pos:])
+    return "".join(parts), ordered[0].start, ordered[-1].end, delta
+
+
+def _shift_pou(pou: POU, offset: int, lines: int) -> None:
+    """就地位移 POU 與其區塊、宣告的位置"""
+    if not offset and not lines:
+        return
+    pou.start += offset
+    pou.end += offset
+    pou.body_start += offset
+    pou.body_end += offset
+    pou.extra_bodies = [(a + offset, b + offset) for a, b in pou.extra_bodies]
+    pou.line += lines
+    if pou.end_line:
+        pou.end_line += lines
+    for section in pou.sections:
+        section.start += offset
+        section.end += offset
+        section.body_start += offset
+        section.body_end += offset
+        section.line += lines
+        for d in section.declarations:
+            d.start += offset
+            d.end += offset
+            d.line += lines
+
+
+def _decl_key(d: VarDecl) -> Tuple[str, str, str]:
+    # 不同 FB 的同名 METHOD / ACTION 以外層 FB 區分
+    return d.parent, d.pou, d.identifier.upper()
+
+
+def _decl_sig(d: VarDecl) -> Tuple:
+    return d.section, d.address, d.var_type, d.initial_value, d.comment
+
+
+def _diff_decls(old: Iterable[VarDecl], new: Iterable[VarDecl], delta: ParseDelta) -> None:
+    old_map: Dict[Tuple[str, str, str], VarDecl] = {_decl_key(d): d for d in old}
+    for d in new:
+        prev = old_map.pop(_decl_key(d), None)
+        if prev is None:
+            delta.added.append(d)
+        elif _decl_sig(prev) != _decl_sig(d) or prev.line != d.line:
+            delta.changed.append(d)
+    delta.removed.extend(old_map.values())
+
+
+def _clean_tail(text: str) -> bool:
+    """區段最後一個 POU 之後只能有已閉合的註解，否則會影響到區段之外的解析"""
+    for tok in tokenize(text):
+        if tok.kind != COMMENT:
+            return False
+        v = tok.value
+        closed = v.startswith("//") or (len(v) >= 4 and v.endswith(("*)", "*/")))
+        if not closed:
+            return False
+    return True
+
+
+class IncrementalParser:
+    """
+    以 document_id 快取解析結果的增量解析器
+
+    可在多個執行緒中呼叫（快取本身有鎖）；同一份文件的 update 必須由呼叫端依序執行
+    """
+
+    def __init__(self, max_documents: int = 64):
+        self.max_documents = max_documents
+        self._docs: "OrderedDict[str, _DocState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def drop(self, document_id: str) -> bool:
+        with self._lock:
+            return self._docs.pop(document_id, None) is not None
+
+    def get_program(self, document_id: str) -> Optional[STProgram]:
+        with self._lock:
+            state = self._docs.get(document_id)
+        return state.program if state else None
+
+    def update(
+        self,
+        document_id: str,
+        version: int,
+        *,
+        code: Optional[str] = None,
+        edits: Optional[List[TextEdit]] = None,
+        base_version: Optional[int] = None,
+    ) -> ParseDelta:
+        """
+        套用新版本並回傳變數差異
+
+        Raises:
+            StaleDocumentError: 只給 edits 但快取不存在或版本不符
+            ValueError: code / edits 都沒有，或 edits 範圍無效
+        """
+        with self._lock:
+            state = self._docs.get(document_id)
+
+        if code is None:
+            if not edits:
+                raise ValueError("需要提供 code 或 edits")
+            if state is None:
+                raise StaleDocumentError(f"文件 {document_id} 不在快取中，請送出完整程式碼")
+            if base_version is not None and base_version != state.version:
+                raise StaleDocumentError(
+                    f"文件 {document_id} 版本不符（快取 {state.version}，修改基準 {base_version}）"
+                )
+            new_source, lo, hi, shift = apply_edits(state.program.source, edits)
+        elif state is None:
+            return self._full(document_id, version, code, None)
+        else:
+            digest = _digest(code)
+            if digest == state.digest:
+                state.version = version
+                with self._lock:
+                    if document_id in self._docs:
+                        self._docs.move_to_end(document_id)
+                return ParseDelta(document_id, version, full_reparse=False,
+                                  variable_count=state.variable_count)
+            edit = diff_to_edit(state.program.source, code)
+            new_source, lo, hi, shift = code, edit.start, edit.end, len(edit.text) - (edit.end - edit.start)
+
+        return self._incremental(document_id, version, state, new_source, lo, hi, shift)
+
+    # ---------- internals ----------
+    def _store(self, document_id: str, version: int, program: STProgram, variable_count: int) -> None:
+        state = _DocState(version, _digest(program.source), program, variable_count)
+        with self._lock:
+            self._docs[document_id] = state
+            self._docs.move_to_end(document_id)
+            while len(self._docs) > self.max_documents:
+                self._docs.popitem(last=False)
+
+    def _full(self, document_id: str, version: int, source: str, old: Optional[STProgram]) -> ParseDelta:
+        program = parse_program(source)
+        delta = ParseDelta(document_id, version, full_reparse=True,
+                           reparsed_pous=[p.qualified_name for p in program.pous])
+        _diff_decls(old.declarations if old else (), program.declarations, delta)
+        delta.variable_count = sum(1 for _ in program.declarations)
+        self._store(document_id, version, program, delta.variable_count)
+        return delta
+
+    def _incremental(
+        self, document_id: str, version: int, state: _DocState,
+        new_source: str, lo: int, hi: int, shift: int,
+    ) -> ParseDelta:
+        old = state.program
+        pous = old.pous
+        if not pous or any(p.kind == "" or not p.end_line for p in pous):
+            return self._full(document_id, version, new_source, old)
+
+        # 受影響範圍：前一個完全在修改之前的 POU 結尾 ~ 下一個完全在修改之後的 POU 開頭；
+        # 巢狀 METHOD / ACTION 與外層 FB 一起重新解析，範圍不會從 FB 中間開始或結束
+        first = 0
+        while first < len(pous) and pous[first].end < lo:
+            first += 1
+        last = first
+        while last < len(pous) and (pous[last].start <= hi or (last > first and pous[last].parent)):
+            last += 1
+        region_start = max(p.end for p in pous[:first]) if first > 0 else 0
+        old_region_end = pous[last].start if last < len(pous) else len(old.source)
+        new_region_end = old_region_end + shift
+
+        region = new_source[region_start:new_region_end]
+        reparsed = parse_program(region)
+        region_pous = [p for p in reparsed.pous if p.kind or p.sections]
+        if any(p.kind == "" or not p.end_line for p in region_pous):
+            return self._full(document_id, version, new_source, old)
+        tail_from = max(p.end for p in region_pous) if region_pous else 0
+        if not _clean_tail(region[tail_from:]):
+            return self._full(document_id, version, new_source, old)
+
+        base_line = new_source.count("\n", 0, region_start)
+        for p in region_pous:
+            _shift_pou(p, region_start, base_line)
+        line_shift = region.count("\n") - old.source.count("\n", region_start, old_region_end)
+        for p in pous[last:]:
+            _shift_pou(p, shift, line_shift)
+
+        program = STProgram(source=new_source, pous=pous[:first] + region_pous + pous[last:])
+        delta = ParseDelta(document_id, version, full_reparse=False,
+                           reparsed_pous=[p.qualified_name for p in region_pous])
+        old_decls = [d for p in pous[first:last] for d in p.declarations]
+        new_decls = [d for p in region_pous for d in p.declarations]
+        _diff_decls(old_decls, new_decls, delta)
+        delta.variable_count = state.variable_count - len(old_decls) + len(new_decls)
+        self._store(document_id, version, program, delta.variable_count)
+        return delta
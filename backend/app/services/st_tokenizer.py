@@ -0,0 +1,525 @@
+"""
+IEC 61131-3 Structured Text 單次掃描 tokenizer 與結構解析器
+
+- tokenize(): 線性時間切出 token（識別字、數值、字串、直接位址、註解、運算子）
+- parse_program(): 依 token 串流辨識 POU（PROGRAM / FUNCTION_BLOCK / FUNCTION / METHOD ...）、
+  所有 VAR 區塊種類（VAR_INPUT、VAR_OUTPUT、VAR_GLOBAL ...）與其中的宣告
+
+此模組不依賴 FastAPI / Pydantic，可直接在 process pool 或 benchmark 中使用。
+"""
+import re
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+# ==================== Token ====================
+IDENT = "IDENT"
+NUMBER = "NUMBER"
+STRING = "STRING"
+DIRECT = "DIRECT"        # 直接位址，例如 %IX0.0、%MW10
+TYPED = "TYPED"          # 型別常值，例如 T#1s、INT#16#FF、DT#2024-01-01-12:00:00
+COMMENT = "COMMENT"      # // ...、(* ... *)、/* ... */
+PRAGMA = "PRAGMA"        # {attribute 'xxx'}
+OP = "OP"
+
+
+class Token(NamedTuple):
+    kind: str
+    value: str
+    start: int
+    end: int
+    line: int
+
+
+# 每個分支都是「必定成功」的型式：字串的結尾引號為可選且不跨行，區塊註解未閉合時吃到檔尾，
+# 因此任何輸入都不會觸發回溯，整體為線性時間。
+_TOKEN_RE = re.compile(
+    r"""
+      (?P<ws>\s+)
+    | (?P<COMMENT>//[^\n]*|\(\*(?:[^*]|\*(?!\)))*(?:\*\)|\Z)|/\*(?:[^*]|\*(?!/))*(?:\*/|\Z))
+    | (?P<PRAGMA>\{[^}\n]*\}?)
+    | (?P<STRING>'(?:[^'$\n]|\$[^\n])*'?|"(?:[^"$\n]|\$[^\n])*"?)
+    | (?P<DIRECT>%[A-Za-z][\w.]*)
+    | (?P<TYPED>[A-Za-z_]\w*\#(?:[\w.:]|-(?=\d))+)
+    | (?P<NUMBER>\d[\d_]*(?:\#[0-9A-Fa-f_]+)?(?:\.\d[\d_]*)?(?:[eE][+-]?\d+)?)
+    | (?P<IDENT>[A-Za-z_]\w*)
+    | (?P<OP>:=|=>|<=|>=|<>|\*\*|\.\.|[-+*/<>=&:;,.()\[\]^\#@]|.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+def tokenize(source: str, *, keep_comments: bool = True) -> Iterator[Token]:
+    """
+    單次掃描切出 token（略過空白）
+
+    Args:
+        source: ST 原始碼
+        keep_comments: 是否輸出 COMMENT / PRAGMA token
+
+    Yields:
+        Token: (kind, value, start, end, line)，line 從 1 開始
+    """
+    line = 1
+    for m in _TOKEN_RE.finditer(source):
+        kind = m.lastgroup
+        value = m.group()
+        if kind == "ws":
+            if "\n" in value:
+                line += value.count("\n")
+            continue
+        if kind == COMMENT or kind == PRAGMA:
+            if keep_comments:
+                yield Token(kind, value, m.start(), m.end(), line)
+            if "\n" in value:
+                line += value.count("\n")
+            continue
+        yield Token(kind, value, m.start(), m.end(), line)
+
+
+# ==================== 語法結構 ====================
+POU_KEYWORDS = {
+    "PROGRAM": "END_PROGRAM",
+    "FUNCTION_BLOCK": "END_FUNCTION_BLOCK",
+    "FUNCTION": "END_FUNCTION",
+    "METHOD": "END_METHOD",
+    "ACTION": "END_ACTION",
+    "INTERFACE": "END_INTERFACE",
+    "CONFIGURATION": "END_CONFIGURATION",
+    "RESOURCE": "END_RESOURCE",
+}
+POU_END_KEYWORDS = set(POU_KEYWORDS.values())
+
+VAR_SECTION_KEYWORDS = {
+    "VAR", "VAR_INPUT", "VAR_OUTPUT", "VAR_IN_OUT", "VAR_GLOBAL", "VAR_EXTERNAL",
+    "VAR_TEMP", "VAR_STAT", "VAR_INST", "VAR_CONFIG", "VAR_ACCESS",
+}
+VAR_QUALIFIERS = {"CONSTANT", "RETAIN", "NON_RETAIN", "PERSISTENT"}
+POU_MODIFIERS = {"PUBLIC", "PRIVATE", "PROTECTED", "INTERNAL", "ABSTRACT", "FINAL"}
+
+
+@dataclass
+class VarDecl:
+    """單一變數宣告"""
+    identifier: str
+    section: str                  # VAR / VAR_INPUT / ... （含修飾字，例如 "VAR RETAIN"）
+    var_type: str
+    address: str = ""
+    initial_value: str = ""
+    comment: str = ""
+    pou: str = ""
+    line: int = 0
+    start: int = 0                # 宣告在原始碼中的位置（含 ; ）
+    end: int = 0
+    parent: str = ""              # 所屬 POU 為巢狀 METHOD / ACTION 時，外層 FUNCTION_BLOCK 的名稱
+
+    @property
+    def qualified_pou(self) -> str:
+        """不同 FB 的同名 METHOD / ACTION 以 FB_A.Init 區分"""
+        return f"{self.parent}.{self.pou}" if self.parent else self.pou
+
+
+@dataclass
+class VarSection:
+    """VAR_xxx ... END_VAR 區塊"""
+    kind: str
+    qualifiers: List[str]
+    start: int                    # VAR 關鍵字起點
+    end: int                      # END_VAR 結尾
+    body_start: int               # 區塊內容（不含關鍵字）
+    body_end: int
+    line: int
+    declarations: List[VarDecl] = field(default_factory=list)
+
+    @property
+    def class_name(self) -> str:
+        return " ".join([self.kind, *self.qualifiers])
+
+
+@dataclass
+class POU:
+    """程式組織單元；kind 為空字串時代表檔案頂層（沒有 PROGRAM 包裹的片段）"""
+    kind: str
+    name: str
+    start: int
+    end: int
+    line: int
+    end_line: int = 0
+    sections: List[VarSection] = field(default_factory=list)
+    body_start: int = 0
+    body_end: int = 0
+    parent: str = ""              # 巢狀 METHOD / ACTION 所屬的 FUNCTION_BLOCK
+    extra_bodies: List[Tuple[int, int]] = field(default_factory=list)  # 巢狀 END_METHOD 之後繼續的本體
+
+    @property
+    def qualified_name(self) -> str:
+        return f"{self.parent}.{self.name}" if self.parent else self.name
+
+    @property
+    def body_ranges(self) -> List[Tuple[int, int]]:
+        return [(self.body_start, self.body_end), *self.extra_bodies]
+
+    @property
+    def declarations(self) -> Iterator[VarDecl]:
+        for section in self.sections:
+            yield from section.declarations
+
+
+@dataclass
+class STProgram:
+    """parse_program() 的結果"""
+    source: str
+    pous: List[POU]
+
+    @property
+    def declarations(self) -> Iterator[VarDecl]:
+        for pou in self.pous:
+            yield from pou.declarations
+
+    @property
+    def sections(self) -> Iterator[VarSection]:
+        for pou in self.pous:
+            yield from pou.sections
+
+    def var_section_text(self) -> str:
+        """所有 VAR 區塊內容（不含 VAR / END_VAR 關鍵字），以空行分隔"""
+        return "\n\n".join(
+            self.source[s.body_start:s.body_end].strip() for s in self.sections
+        ).strip()
+
+    def logic_code(self) -> str:
+        """所有 POU 的邏輯本體（最後一個 END_VAR 之後到 END_xxx 之前）"""
+        bodies = (self.source[a:b].strip() for p in self.pous for a, b in p.body_ranges)
+        return "\n\n".join(b for b in bodies if b)
+
+
+def _flatten(text: str) -> str:
+    """多行的型別 / 初始值合併為單行（字串常值不跨行，因此只處理行首尾空白）"""
+    if "\n" not in text:
+        return text.strip()
+    return " ".join(part.strip() for part in text.splitlines() if part.strip())
+
+
+class _Parser:
+    """以 token 串流為輸入的單次掃描解析器（只保留少量 lookahead，不會整份展開）"""
+
+    def __init__(self, source: str, tokens: Iterable[Token]):
+        self.source = source
+        self._it = iter(tokens)
+        self._buf: Deque[Token] = deque()
+        self._last: Optional[Token] = None
+
+    # ---------- token helpers ----------
+    def _next(self) -> Optional[Token]:
+        tok = self._buf.popleft() if self._buf else next(self._it, None)
+        if tok is not None:
+            self._last = tok
+        return tok
+
+    def _peek(self) -> Optional[Token]:
+        if not self._buf:
+            tok = next(self._it, None)
+            if tok is None:
+                return None
+            self._buf.append(tok)
+        return self._buf[0]
+
+    def _push_back(self, tok: Token) -> None:
+        self._buf.appendleft(tok)
+
+    def _next_code(self) -> Optional[Token]:
+        """下一個非註解 token（會前進）"""
+        while True:
+            tok = self._next()
+            if tok is None or (tok.kind != COMMENT and tok.kind != PRAGMA):
+                return tok
+
+    def _peek_code(self) -> Optional[Token]:
+        for tok in self._buf:
+            if tok.kind != COMMENT and tok.kind != PRAGMA:
+                return tok
+        while True:
+            tok = next(self._it, None)
+            if tok is None:
+                return None
+            self._buf.append(tok)
+            if tok.kind != COMMENT and tok.kind != PRAGMA:
+                return tok
+
+    # ---------- top level ----------
+    def parse(self) -> STProgram:
+        source = self.source
+        top = POU(kind="", name="", start=0, end=len(source), line=1)
+        pous: List[POU] = []
+        stack: List[POU] = []
+        resume: Dict[int, int] = {}   # id(外層 POU) → 巢狀 POU 結束後本體繼續的位置
+
+        def close_resumed(pou: POU, end: int) -> None:
+            start = resume.pop(id(pou), None)
+            if start is not None and source[start:end].strip():
+                pou.extra_bodies.append((start, end))
+
+        while True:
+            tok = self._next_code()
+            if tok is None:
+                break
+            if tok.kind != IDENT:
+                continue
+            word = tok.value.upper()
+            current = stack[-1] if stack else top
+
+            if word in VAR_SECTION_KEYWORDS:
+                section = self._parse_section(tok, word, current.name, current.parent)
+                current.sections.append(section)
+                current.body_start = max(current.body_start, section.end)
+            elif word in POU_KEYWORDS:
+                if stack and not stack[-1].body_end:
+                    stack[-1].body_end = tok.start  # 巢狀 METHOD / ACTION 之前為外層本體
+                elif stack:
+                    close_resumed(stack[-1], tok.start)
+                pou = self._parse_pou_header(tok, word)
+                if stack:
+                    pou.parent = stack[-1].name
+                stack.append(pou)
+                pous.append(pou)
+            elif word in POU_END_KEYWORDS and stack:
+                pou = stack.pop()
+                pou.end = tok.end
+                pou.end_line = tok.line
+                if not pou.body_end:
+                    pou.body_end = tok.start
+                close_resumed(pou, tok.start)
+                if stack:
+                    resume[id(stack[-1])] = tok.end
+            elif word == "TYPE":
+                self._skip_until("END_TYPE")
+
+        for pou in stack:  # 缺少 END_xxx：延伸到檔尾
+            pou.end = len(source)
+            if not pou.body_end:
+                pou.body_end = len(source)
+            close_resumed(pou, len(source))
+
+        # 沒有任何 POU 包裹時，整份檔案即為一個匿名 POU
+        if not pous:
+            top.body_end = len(source)
+            return STProgram(source=source, pous=[top])
+        if top.sections:
+            top.body_start = top.body_end = 0
+            pous.insert(0, top)
+        return STProgram(source=source, pous=pous)
+
+    def _skip_until(self, end_word: str) -> None:
+        while True:
+            tok = self._next_code()
+            if tok is None or (tok.kind == IDENT and tok.value.upper() == end_word):
+                return
+
+    def _parse_pou_header(self, tok: Token, word: str) -> POU:
+        name = ""
+        nxt = self._peek_code()
+        while nxt is not None and nxt.kind == IDENT and nxt.value.upper() in POU_MODIFIERS:
+            self._next_code()
+            nxt = self._peek_code()
+        if nxt is not None and nxt.kind == IDENT and nxt.value.upper() not in VAR_SECTION_KEYWORDS:
+            name = nxt.value
+            self._next_code()
+
+        # 標頭（名稱、回傳型別、EXTENDS ...）佔一行，本體從下一行開始
+        anchor = self._last.end
+        eol = self.source.find("\n", anchor)
+        body_start = len(self.source) if eol < 0 else eol + 1
+        return POU(
+            kind=word, name=name, start=tok.start, end=len(self.source), line=tok.line,
+            body_start=body_start,
+        )
+
+    # ---------- VAR sections ----------
+    def _parse_section(self, tok: Token, word: str, pou_name: str, parent: str = "") -> VarSection:
+        qualifiers: List[str] = []
+        while True:
+            nxt = self._peek_code()
+            if nxt is None or nxt.kind != IDENT or nxt.value.upper() not in VAR_QUALIFIERS:
+                break
+            qualifiers.append(nxt.value.upper())
+            self._next_code()
+
+        section = VarSection(
+            kind=word, qualifiers=qualifiers, start=tok.start, end=len(self.source),
+            body_start=self._last.end, body_end=len(self.source), line=tok.line,
+        )
+        self._parse_declarations(section, pou_name, stop_at_end_var=True, parent=parent)
+        return section
+
+    def _close_section(self, section: VarSection, tok: Token) -> None:
+        section.body_end = tok.start
+        section.end = tok.end
+
+    def _parse_declarations(
+        self, section: VarSection, pou_name: str, stop_at_end_var: bool, parent: str = "",
+    ) -> None:
+        """
+        解析宣告直到 END_VAR（或 token 結束）
+
+        宣告格式：name {, name} [AT %addr] : type [:= init] ; [// comment]
+        無法辨識的內容會略過到下一個 ; 以重新同步。
+        """
+        source = self.source
+        class_name = section.class_name
+
+        while True:
+            tok = self._next_code()
+            if tok is None:
+                return
+            if tok.kind == IDENT:
+                word = tok.value.upper()
+                if word == "END_VAR":
+                    if stop_at_end_var:
+                        self._close_section(section, tok)
+                        return
+                    continue
+                if stop_at_end_var and word in _SECTION_BREAKERS:
+                    # 缺少 END_VAR：區塊在下一個結構關鍵字之前結束
+                    section.body_end = section.end = tok.start
+                    self._push_back(tok)
+                    return
+            elif not (tok.kind == OP and tok.value == ";"):
+                self._resync()
+                continue
+            else:
+                continue
+
+            # ---- 名稱列表 ----
+            decl_start = tok.start
+            decl_line = tok.line
+            names = [tok.value]
+            nxt = self._next_code()
+            while nxt is not None and nxt.kind == OP and nxt.value == ",":
+                ident = self._next_code()
+                if ident is None or ident.kind != IDENT:
+                    nxt = ident
+                    break
+                names.append(ident.value)
+                nxt = self._next_code()
+            if nxt is None:
+                return
+
+            # ---- AT %addr ----
+            address = ""
+            if nxt.kind == IDENT and nxt.value.upper() == "AT":
+                addr = self._next_code()
+                if addr is None:
+                    return
+                address = f"AT {addr.value}"
+                nxt = self._next_code()
+                if nxt is None:
+                    return
+
+            if not (nxt.kind == OP and nxt.value == ":"):
+                self._push_back(nxt)
+                self._resync()
+                continue
+
+            # ---- type [:= init] ; ----
+            type_start = type_end = -1
+            init_start = init_end = -1
+            in_init = False
+            depth = 0
+            terminator: Optional[Token] = None
+            while True:
+                t = self._next_code()
+                if t is None:
+                    break
+                if t.kind == OP:
+                    v = t.value
+                    if v in _OPEN_BRACKETS:
+                        depth += 1
+                    elif v in _CLOSE_BRACKETS:
+                        depth -= 1
+                    elif depth <= 0 and v == ";":
+                        terminator = t
+                        break
+                    elif depth <= 0 and v == ":=" and not in_init:
+                        in_init = True
+                        continue
+                elif t.kind == IDENT and depth <= 0 and t.value.upper() == "END_VAR":
+                    self._push_back(t)  # 缺少 ; ：交給外層迴圈處理 END_VAR
+                    break
+                if in_init:
+                    if init_start < 0:
+                        init_start = t.start
+                    init_end = t.end
+                else:
+                    if type_start < 0:
+                        type_start = t.start
+                    type_end = t.end
+
+            var_type = _flatten(source[type_start:type_end]) if type_start >= 0 else ""
+            initial_value = _flatten(source[init_start:init_end]) if init_start >= 0 else ""
+            decl_end = terminator.end if terminator else max(type_end, init_end, decl_start)
+
+            # ---- 同一行的行尾註解 ----
+            comment = ""
+            if terminator is not None:
+                after = self._peek()
+                if after is not None and after.kind == COMMENT and after.line == terminator.line:
+                    comment = after.value.strip()
+                    self._next()
+
+            last = len(names) - 1
+            for k, name in enumerate(names):
+                section.declarations.append(VarDecl(
+                    identifier=name,
+                    section=class_name,
+                    var_type=var_type,
+                    address=address,
+                    # 初始值只套用到單一變數宣告；註解只套用到該行最後一個變數
+                    initial_value=initial_value if last == 0 else "",
+                    comment=comment if k == last else "",
+                    pou=pou_name,
+                    line=decl_line,
+                    start=decl_start,
+                    end=decl_end,
+                    parent=parent,
+                ))
+
+    def _resync(self) -> None:
+        """略過到下一個 ; 或 END_VAR（END_VAR 保留給呼叫端）"""
+        while True:
+            tok = self._peek_code()
+            if tok is None:
+                return
+            if tok.kind == OP and tok.value == ";":
+                self._next_code()
+                return
+            if tok.kind == IDENT and tok.value.upper() in _SECTION_BREAKERS | {"END_VAR"}:
+                return
+            self._next_code()
+
+
+_OPEN_BRACKETS = {"(", "["}
+_CLOSE_BRACKETS = {")", "]"}
+_SECTION_BREAKERS = VAR_SECTION_KEYWORDS | set(POU_KEYWORDS) | POU_END_KEYWORDS
+
+
+def parse_program(source: str) -> STProgram:
+    """解析完整 ST 原始碼（可含多個 POU）"""
+    return _Parser(source, tokenize(source)).parse()
+
+
+def parse_declarations(text: str, section: str = "VAR", pou: str = "") -> List[VarDecl]:
+    """
+    解析宣告片段
+
+    text 可以是不含 VAR / END_VAR 的區塊內容，也可以包含一或多個完整的 VAR_xxx 區塊。
+    """
+    program = parse_program(text)
+    decls = list(program.declarations)
+    if decls:
+        return decls
+
+    parser = _Parser(text, tokenize(text))
+    bare = VarSection(kind=section, qualifiers=[], start=0, end=len(text),
+                      body_start=0, body_end=len(text), line=1)
+    parser._parse_declarations(bare, pou, stop_at_end_var=False)
+    return bare.declarations
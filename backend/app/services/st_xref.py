@@ -0,0 +1,258 @@
+"""
+ST 交叉參照索引
+
+由 VAR 宣告與邏輯本體的 token 建立「識別字 → 宣告 + 讀 / 寫 / 呼叫位置」的索引，
+可同時載入多個程式（例如一個專案的多個 POU 檔與 GVL），查詢時不需重新掃描原始碼。
+
+名稱解析順序：所在 POU → 外層 FUNCTION_BLOCK（METHOD / ACTION）→ 任一已載入程式的 VAR_GLOBAL。
+巢狀 METHOD / ACTION 的 scope 以 FB_A.Init 形式的完整名稱區分，不同 FB 的同名 METHOD 互不影響。
+尚未能解析到宣告的參照會暫存，之後載入對應的 VAR_GLOBAL 時自動補上。
+"""
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .st_tokenizer import IDENT, OP, POU, STProgram, Token, VarDecl, tokenize
+
+READ = "read"
+WRITE = "write"
+CALL = "call"
+
+# 邏輯本體中不是變數參照的關鍵字 / 運算子
+LOGIC_KEYWORDS = {
+    "IF", "THEN", "ELSIF", "ELSE", "END_IF", "CASE", "OF", "END_CASE",
+    "FOR", "TO", "BY", "DO", "END_FOR", "WHILE", "END_WHILE", "REPEAT", "UNTIL", "END_REPEAT",
+    "EXIT", "CONTINUE", "RETURN", "JMP", "AND", "AND_THEN", "OR", "OR_ELSE", "XOR", "NOT", "MOD",
+    "TRUE", "FALSE", "THIS", "SUPER", "REF", "ADR", "SIZEOF",
+}
+
+
+@dataclass
+class Reference:
+    program: str
+    pou: str
+    kind: str         # read / write / call
+    line: int
+    start: int
+    end: int
+
+
+@dataclass
+class Symbol:
+    program: str
+    decl: VarDecl
+    references: List[Reference] = field(default_factory=list)
+
+    @property
+    def is_global(self) -> bool:
+        return self.decl.section.split(" ", 1)[0] == "VAR_GLOBAL"
+
+    def count(self, kind: str) -> int:
+        return sum(1 for r in self.references if r.kind == kind)
+
+
+def scan_body(source: str, pou: POU) -> Iterable[Tuple[Token, str]]:
+    """
+    掃描 POU 邏輯本體（含巢狀 END_METHOD 之後繼續的部分），產生 (識別字 token, read/write/call)
+
+    - 指定敘述左側的 designator（a、a.b、a[i]^.c）的基底識別字為 write，其餘為 read
+    - 呼叫時的形式參數名稱（fb(IN := x, Q => y)）略過；=> 右側的變數為 write
+    - 成員存取（. 之後的識別字）不視為獨立參照
+    """
+    for start, end in pou.body_ranges:
+        if end > start:
+            yield from _scan_range(source, start, end)
+
+
+def _scan_range(source: str, start: int, end: int) -> Iterable[Tuple[Token, str]]:
+    text = source[start:end]
+    base_line = source.count("\n", 0, start)
+    tokens = [
+        t._replace(start=t.start + start, end=t.end + start, line=t.line + base_line)
+        for t in tokenize(text, keep_comments=False)
+    ]
+
+    refs: List[List] = []                 # [token, kind]，kind 之後可能被改為 write
+    base: Optional[List] = None           # 目前 designator 的基底參照
+    base_stack: List[Optional[List]] = []  # [ ] 內為新的 designator
+    paren_depth = 0
+    output_binding = False
+    prev: Optional[Token] = None
+
+    for i, tok in enumerate(tokens):
+        if tok.kind == IDENT:
+            word = tok.value.upper()
+            nxt = tokens[i + 1] if i + 1 < len(tokens) else None
+            if word in LOGIC_KEYWORDS:
+                base = None
+            elif prev is not None and prev.kind == OP and prev.value == ".":
+                pass  # 成員名稱，仍屬同一個 designator
+            elif paren_depth > 0 and nxt is not None and nxt.kind == OP and nxt.value in (":=", "=>"):
+                base = None  # 形式參數名稱
+            else:
+                kind = CALL if nxt is not None and nxt.kind == OP and nxt.value == "(" else READ
+                if output_binding:
+                    kind = WRITE
+                    output_binding = False
+                ref = [tok, kind]
+                refs.append(ref)
+                base = ref
+        elif tok.kind == OP:
+            v = tok.value
+            if v == ":=":
+                if paren_depth == 0 and base is not None and base[1] == READ:
+                    base[1] = WRITE
+                base = None
+            elif v == "=>":
+                output_binding = True
+                base = None
+            elif v == "[":
+                base_stack.append(base)
+                base = None
+            elif v == "]":
+                base = base_stack.pop() if base_stack else None
+            elif v == "(":
+                paren_depth += 1
+                base = None
+            elif v == ")":
+                paren_depth = max(paren_depth - 1, 0)
+                base = None
+            elif v not in (".", "^"):
+                base = None
+        else:
+            base = None
+        prev = tok
+
+    for tok, kind in refs:
+        yield tok, kind
+
+
+def scan_program(program: STProgram) -> List[Tuple[POU, Token, str]]:
+    """程式所有 POU 本體中的識別字 (POU, token, 種類)；不使用索引狀態，可在執行緒中先行計算"""
+    return [(pou, tok, kind) for pou in program.pous for tok, kind in scan_body(program.source, pou)]
+
+
+class SymbolIndex:
+    """
+    多個程式的交叉參照索引（非執行緒安全，於 event loop 內同步呼叫）
+
+    整個專案的解析與本體掃描（scan_program）在執行緒中完成後再交給 add_program，event loop 只做索引更新
+    """
+
+    def __init__(self):
+        self._programs: Dict[str, List[Symbol]] = {}
+        self._by_name: Dict[str, List[Symbol]] = defaultdict(list)
+        self._globals: Dict[str, List[Symbol]] = defaultdict(list)
+        # 尚未解析的參照：名稱 → [Reference]
+        self._unresolved: Dict[str, List[Reference]] = defaultdict(list)
+
+    @property
+    def programs(self) -> List[str]:
+        return list(self._programs)
+
+    # ---------- 載入 / 移除 ----------
+    def add_program(
+        self, program_id: str, program: STProgram, scanned: Optional[List[Tuple[POU, Token, str]]] = None,
+    ) -> int:
+        """加入（或取代）一個程式，回傳宣告數；scanned 為 scan_program(program) 的結果（省略時在此掃描）"""
+        self.remove_program(program_id)
+
+        symbols: List[Symbol] = []
+        scopes: Dict[str, Dict[str, Symbol]] = {}   # POU 完整名稱（FB_A.Init）→ 名稱 → 宣告
+        new_globals: List[Symbol] = []
+        for pou in program.pous:
+            scope = scopes.setdefault(pou.qualified_name, {})
+            for decl in pou.declarations:
+                sym = Symbol(program=program_id, decl=decl)
+                symbols.append(sym)
+                scope[decl.identifier.upper()] = sym
+                self._by_name[decl.identifier.upper()].append(sym)
+                if sym.is_global:
+                    self._globals[decl.identifier.upper()].append(sym)
+                    new_globals.append(sym)
+        self._programs[program_id] = symbols
+
+        for pou, tok, kind in scanned if scanned is not None else scan_program(program):
+            name = tok.value.upper()
+            ref = Reference(program_id, pou.qualified_name, kind, tok.line, tok.start, tok.end)
+            sym = self._resolve(name, program_id, pou, scopes)
+            if sym is not None:
+                sym.references.append(ref)
+            else:
+                self._unresolved[name].append(ref)
+
+        # 之前無法解析、現在有了 VAR_GLOBAL 的參照
+        for sym in new_globals:
+            name = sym.decl.identifier.upper()
+            pending = self._unresolved.pop(name, None)
+            if pending:
+                sym.references.extend(pending)
+        return len(symbols)
+
+    def remove_program(self, program_id: str) -> bool:
+        symbols = self._programs.pop(program_id, None)
+        if symbols is None:
+            return False
+        gone = {id(s) for s in symbols}
+        for sym in symbols:
+            name = sym.decl.identifier.upper()
+            self._by_name[name] = [s for s in self._by_name[name] if id(s) not in gone]
+            if not self._by_name[name]:
+                del self._by_name[name]
+            if sym.is_global:
+                self._globals[name] = [s for s in self._globals[name] if id(s) not in gone]
+                if not self._globals[name]:
+                    del self._globals[name]
+                # 其他程式對此全域變數的參照回到未解析狀態（或改指向同名的其他全域變數）
+                foreign = [r for r in sym.references if r.program != program_id]
+                if foreign:
+                    target = self._globals.get(name)
+                    if target:
+                        target[0].references.extend(foreign)
+                    else:
+                        self._unresolved[name].extend(foreign)
+        for name in list(self._unresolved):
+            refs = [r for r in self._unresolved[name] if r.program != program_id]
+            if refs:
+                self._unresolved[name] = refs
+            else:
+                del self._unresolved[name]
+        return True
+
+    def _resolve(
+        self, name: str, program_id: str, pou: POU, scopes: Dict[str, Dict[str, Symbol]],
+    ) -> Optional[Symbol]:
+        sym = scopes.get(pou.qualified_name, {}).get(name)
+        if sym is None and pou.parent:
+            # 外層 FUNCTION_BLOCK 為頂層 POU，完整名稱即 pou.parent
+            sym = scopes.get(pou.parent, {}).get(name)
+        if sym is None:
+            # 同一程式的 VAR_GLOBAL 優先，其次為其他已載入程式
+            candidates = self._globals.get(name)
+            if candidates:
+                sym = next((s for s in candidates if s.program == program_id), candidates[0])
+        return sym
+
+    # ---------- 查詢 ----------
+    def lookup(self, name: str, program: Optional[str] = None, pou: Optional[str] = None) -> List[Symbol]:
+        """pou 可為完整名稱（FB_A.Init，只取該 FB 的 METHOD）或名稱（Init，所有同名 POU）"""
+        symbols = self._by_name.get(name.upper(), [])
+        return [
+            s for s in symbols
+            if (program is None or s.program == program)
+            and (pou is None or pou in (s.decl.qualified_pou, s.decl.pou))
+        ]
+
+    def unused(self, program: Optional[str] = None) -> List[Symbol]:
+        """沒有任何參照的宣告（VAR_INPUT / VAR_OUTPUT 也列入，呼叫端可自行過濾）"""
+        programs = [program] if program is not None else list(self._programs)
+        return [s for p in programs for s in self._programs.get(p, []) if not s.references]
+
+    def unresolved(self, program: Optional[str] = None) -> Dict[str, List[Reference]]:
+        """無法解析到宣告的識別字（函式、列舉值、型別或拼錯的變數）"""
+        result: Dict[str, List[Reference]] = {}
+        for name, refs in self._unresolved.items():
+            picked = [r for r in refs if program is None or r.program == program]
+            if picked:
+                result[name] = picked
+        return result
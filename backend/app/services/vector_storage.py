@@ -0,0 +1,234 @@
+"""
+Compressed vector storage
+
+FAISS 索引的向量儲存格式（RAG_VECTOR_STORAGE）：
+
+- flat：IndexFlatL2，float32 原始向量（每維 4 bytes）
+- fp16：IndexScalarQuantizer QT_fp16（每維 2 bytes）
+- sq8 ：IndexScalarQuantizer QT_8bit，每維 int8 純量量化（每維 1 byte）
+- pq  ：乘積量化（每個向量 M × nbits / 8 bytes）；以單一 list、非 residual 的 IndexIVFPQ 實作，
+        編碼與 IndexPQ 相同，但支援 IDSelector（metadata 篩選），每個向量多 8 bytes id
+
+壓縮模式另外把 float32 原始向量存成 .npy 放在磁碟上，查詢時以 memmap 讀取候選向量，
+對前 N 個候選做精確 L2 重新排序（只有候選向量會被讀進記憶體）。
+"""
+import math
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+STORAGE_MODES = ("flat", "fp16", "sq8", "pq")
+
+
+def index_type(storage: str, pq_m: int = 64, pq_nbits: int = 8) -> str:
+    """記錄在 index manifest 的索引型別；flat 保留原本的名稱，既有快取不需重建"""
+    if storage == "flat":
+        return "IndexFlatL2"
+    if storage == "fp16":
+        return "IndexScalarQuantizer:fp16"
+    if storage == "sq8":
+        return "IndexScalarQuantizer:8bit"
+    if storage == "pq":
+        return f"IndexIVFPQ:1,{pq_m}x{pq_nbits}"
+    raise ValueError(f"不支援的向量儲存模式: {storage}（可用: {', '.join(STORAGE_MODES)}）")
+
+
+def _pq_shape(dim: int, n: int, pq_m: int, pq_nbits: int) -> Tuple[int, int]:
+    """M 必須整除維度；nbits 受訓練樣本數限制（每個 centroid 至少要有一個樣本）"""
+    m = max(d for d in range(1, min(pq_m, dim) + 1) if dim % d == 0)
+    nbits = max(1, min(pq_nbits, int(math.log2(max(n, 2)))))
+    return m, nbits
+
+
+def create_index(vectors: np.ndarray, storage: str, pq_m: int = 64, pq_nbits: int = 8) -> faiss.Index:
+    """
+    建立（並以 vectors 訓練）空的索引，向量由呼叫端再 add 進去
+
+    Raises:
+        ValueError: 不支援的儲存模式
+    """
+    index_type(storage)  # 檢查模式名稱
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, dim = vectors.shape
+    if storage == "flat":
+        return faiss.IndexFlatL2(dim)
+    if storage == "fp16":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2)
+    elif storage == "sq8":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+    else:
+        m, nbits = _pq_shape(dim, n, pq_m, pq_nbits)
+        if (m, nbits) != (pq_m, pq_nbits):
+            print(f"ℹ️ PQ 參數調整為 M={m}, nbits={nbits}（維度 {dim}，訓練樣本 {n}）")
+        index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, 1, m, nbits, faiss.METRIC_L2)
+        index.by_residual = False
+    if not index.is_trained:
+        index.train(vectors)
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()  # reconstruct（LangChain MMR）需要 id → 位置對照
+    return index
+
+
+def _search_params(index: faiss.Index, bitmap: Optional[np.ndarray]):
+    """bitmap 必須在 search 結束前保持存活（selector 只保存指標）"""
+    if bitmap is None:
+        return None
+    # 第一個參數為 bitmap 的 byte 數（不是 id 數）：超出 bitmap 的 id 視為不符合，不會讀到 bitmap 之外
+    selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+    if isinstance(index, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=index.nlist)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    params.referenced_objects = [selector, bitmap]
+    return params
+
+
+def owned_copy(index: faiss.Index) -> faiss.Index:
+    """
+    可加入向量的完整複本：mmap 載入（IO_FLAG_MMAP_IFC）的索引以 clone_index 複製時仍指向唯讀的 mapping，
+    之後 add 會失敗，因此經序列化複製
+    """
+    return faiss.deserialize_index(faiss.serialize_index(index))
+
+
+def memory_bytes(index: faiss.Index) -> int:
+    """索引序列化後的大小，約等於常駐記憶體用量"""
+    return int(faiss.serialize_index(index).size)
+
+
+def resident_bytes(index: faiss.Index) -> int:
+    """常駐記憶體估計（不序列化索引，避免大索引載入時多佔一份）：編碼 + IVF id / direct map + codebook"""
+    n = index.ntotal
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return n * int(getattr(index, "code_size", index.d * 4))
+    size = n * (int(ivf.code_size) + 16) + ivf.nlist * ivf.d * 4
+    pq = getattr(index, "pq", None)
+    if pq is not None:
+        size += pq.M * pq.ksub * pq.dsub * 4
+    return size
+
+
+# ==================== Full-precision vectors on disk ====================
+def save_full_vectors(vectors, path) -> Path:
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(path, np.ascontiguousarray(vectors, dtype=np.float32))
+    return path
+
+
+def load_full_vectors(path) -> Optional[np.ndarray]:
+    """以 memmap 開啟，不會把整個矩陣讀進記憶體"""
+    path = Path(path)
+    if not path.exists():
+        return None
+    try:
+        return np.load(path, mmap_mode="r")
+    except Exception as e:
+        print(f"✗ 原始向量讀取失敗 ({path}): {e}")
+        return None
+
+
+class AppendableVectors:
+    """
+    磁碟 memmap 的原始向量 + 之後匯入的向量（留在記憶體），以 faiss id 索引
+
+    append 以新陣列取代舊陣列，進行中的查詢讀到的是一致的快照
+    """
+
+    def __init__(self, base: np.ndarray):
+        self.base = base
+        self.extra = np.empty((0, base.shape[1]), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self.base) + len(self.extra)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return len(self), self.base.shape[1]
+
+    def append(self, vectors: np.ndarray) -> None:
+        self.extra = np.concatenate([self.extra, np.asarray(vectors, dtype=np.float32)])
+
+    def __getitem__(self, ids) -> np.ndarray:
+        ids = np.asarray(ids)
+        n, extra = len(self.base), self.extra
+        if ids.size == 0 or ids.max() < n:
+            return self.base[ids]
+        out = np.empty((len(ids), self.base.shape[1]), dtype=np.float32)
+        in_base = ids < n
+        out[in_base] = self.base[ids[in_base]]
+        out[~in_base] = extra[ids[~in_base] - n]
+        return out
+
+
+def touch(vectors, block_rows: int = 16384) -> int:
+    """依序讀過整個原始向量矩陣，把 memmap 的分頁載入 page cache（暖機用）；回傳讀取的 bytes"""
+    base = vectors.base if isinstance(vectors, AppendableVectors) else vectors
+    total = 0
+    for start in range(0, len(base), block_rows):
+        block = np.asarray(base[start:start + block_rows])
+        block.sum()  # 確實讀取，不只建立 view
+        total += block.nbytes
+    return total
+
+
+# ==================== Search ====================
+def search(
+    index: faiss.Index,
+    query: Sequence[float],
+    k: int = 3,
+    fetch_k: int = 20,
+    lambda_mult: float = 0.5,
+    full_vectors: Optional[np.ndarray] = None,
+    rerank: int = 0,
+    mmr: bool = True,
+    bitmap: Optional[np.ndarray] = None,
+) -> List[Tuple[int, float]]:
+    """
+    查詢索引，回傳 [(faiss id, L2 距離)]
+
+    - rerank > 0 且有原始向量時：先從壓縮索引取 max(rerank, fetch_k) 個候選，
+      以 float32 原始向量計算精確距離重新排序
+    - mmr=True 時以 MMR 從前 fetch_k 個候選挑出 k 個（與 as_retriever(search_type="mmr") 相同）；
+      候選向量優先取原始向量，否則由索引 reconstruct（壓縮模式為近似值）
+    - bitmap（metadata_filter.MetadataIndex.select）在索引掃描時即排除範圍外的向量，
+      候選數與不篩選時相同
+    """
+    q = np.asarray(query, dtype=np.float32).reshape(1, -1)
+    use_exact = full_vectors is not None and rerank > 0
+    n_fetch = max(k, fetch_k if mmr else k, rerank if use_exact else 0)
+    if bitmap is not None:
+        bitmap = np.ascontiguousarray(bitmap, dtype=np.uint8)
+        if not bitmap.any():
+            return []
+    params = _search_params(index, bitmap)
+    distances, ids = index.search(q, min(n_fetch, max(index.ntotal, 1)), params=params)
+    valid = ids[0] >= 0
+    ids, distances = ids[0][valid], distances[0][valid]
+    if ids.size == 0:
+        return []
+
+    candidates = None
+    if use_exact:
+        order = np.sort(ids)  # memmap 依位置順序讀取
+        exact = np.asarray(full_vectors[order], dtype=np.float32)
+        exact_dist = ((exact - q) ** 2).sum(axis=1)
+        ranked = np.argsort(exact_dist, kind="stable")
+        ids, distances, candidates = order[ranked], exact_dist[ranked], exact[ranked]
+
+    if not mmr:
+        return [(int(i), float(d)) for i, d in zip(ids[:k], distances[:k])]
+
+    ids, distances = ids[:fetch_k], distances[:fetch_k]
+    if candidates is not None:
+        candidates = candidates[:fetch_k]
+    elif full_vectors is not None:
+        candidates = np.asarray(full_vectors[ids], dtype=np.float32)
+    else:
+        candidates = index.reconstruct_batch(ids)
+    picked = maximal_marginal_relevance(q, list(candidates), lambda_mult=lambda_mult, k=k)
+    return [(int(ids[i]), float(distances[i])) for i in picked]
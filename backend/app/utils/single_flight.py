@@ -0,0 +1,148 @@
+# single_flight.py
+"""
+Single-flight for streamed LLM replies.
+
+Identical concurrent requests (same normalized key: provider, model, prompt,
+question, parameters, index version) share one upstream generation. The first
+request starts a producer task; every subscriber, including late joiners, reads
+the flight's transcript through its own cursor, so it first replays the text
+already produced and then follows live. Subscriber state is just that cursor, so
+buffering is bounded by one reply no matter how many subscribers there are or
+how slowly they read.
+
+The producer runs as a child span of the leader's request span (the task
+inherits the leader's context), so retrieval and LLM spans, forced sampling and
+the profiler all apply to the leader's trace; followers record the leader's
+trace id as `flight_trace`. If the leader's trace ends first, the producer's
+open spans are exported cut at the leader's end with status "unfinished".
+The producer is cancelled (closing the upstream
+stream) only when the last subscriber leaves. A finished flight is removed
+immediately: this de-duplicates in-flight work, it is not a response cache.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import unicodedata
+from contextlib import aclosing
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from ..core.metrics import registry
+from ..core.tracing import current_span, current_trace, span
+
+logger = logging.getLogger(__name__)
+
+_subscriptions = registry.counter(
+    "single_flight_subscriptions_total",
+    "Chat streams served by single-flight, by endpoint and role (leader started upstream / follower joined)",
+)
+_flights_active = registry.gauge("single_flight_active", "Upstream generations currently shared by single-flight")
+_subscribers_active = registry.gauge("single_flight_subscribers", "Subscribers attached to in-flight generations")
+
+
+def normalize_question(question: str) -> str:
+    """Unicode-normalize, case-fold and collapse whitespace."""
+    return " ".join(unicodedata.normalize("NFKC", question).casefold().split())
+
+
+def flight_key(provider: str, model: str, prompt: str, question: str, **params) -> str:
+    payload = json.dumps(
+        [provider, model, prompt, normalize_question(question), params],
+        sort_keys=True, ensure_ascii=False, default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self.trace_id: Optional[str] = None   # leader's trace, linked from followers
+        self._changed = asyncio.Event()
+
+    def notify(self) -> None:
+        # Waiters hold the old event; swapping in a fresh one avoids clear() races.
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+
+class SingleFlight:
+    def __init__(self, name: str, enabled: bool = True):
+        self.name = name
+        self.enabled = enabled
+        self._flights: Dict[str, _Flight] = {}
+        _flights_active.set_function(lambda: len(self._flights), flights=name)
+        _subscribers_active.set_function(
+            lambda: sum(f.subscribers for f in self._flights.values()), flights=name
+        )
+
+    async def _produce(self, flight: _Flight, produce: Callable[[], AsyncIterator[str]], endpoint: str) -> None:
+        try:
+            with span("single_flight.produce", flight=flight.key[:16], endpoint=endpoint) as s:
+                async with aclosing(produce()) as texts:
+                    async for text in texts:
+                        flight.chunks.append(text)
+                        flight.notify()
+                s.set(chunks=len(flight.chunks), subscribers=flight.subscribers)
+        except asyncio.CancelledError:
+            flight.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            flight.notify()
+
+    async def stream(
+        self, key: str, produce: Callable[[], AsyncIterator[str]], endpoint: str = "",
+    ) -> AsyncIterator[str]:
+        """
+        Yield the text of the flight for `key`, starting `produce()` if none is running.
+        Errors raised by the producer are re-raised to every subscriber.
+        """
+        if not self.enabled:
+            async with aclosing(produce()) as texts:
+                async for text in texts:
+                    yield text
+            return
+
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = self._flights[key] = _Flight(key)
+            trace = current_trace()
+            flight.trace_id = trace.trace_id if trace is not None else None
+            # The task copies this context: its spans are children of the leader's current span.
+            flight.task = asyncio.create_task(self._produce(flight, produce, endpoint))
+        flight.subscribers += 1
+        role = "leader" if leader else "follower"
+        _subscriptions.inc(endpoint=endpoint, role=role)
+        current_span().set(
+            flight=key[:16], flight_role=role, flight_replayed=len(flight.chunks),
+            flight_trace=None if leader else flight.trace_id,
+        )
+        position = 0
+        try:
+            while True:
+                changed = flight._changed
+                while position < len(flight.chunks):
+                    yield flight.chunks[position]
+                    position += 1
+                if flight.done:
+                    break
+                await changed.wait()
+            if flight.error is not None:
+                raise flight.error
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                # Last subscriber left: stop the upstream generation.
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
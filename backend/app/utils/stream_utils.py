@@ -1,9 +1,22 @@
 # stream_utils.py
-from typing import Callable, AsyncIterable, Any, Optional
+from typing import Callable, AsyncIterable, AsyncIterator, Any, Awaitable, Optional
+import asyncio
+import inspect
 import logging
+from contextlib import aclosing
+
+from ..core.config import STREAM_DISCONNECT_POLL_MS
+from ..core.metrics import registry
+from ..core.tracing import current_span, current_trace
 
 logger = logging.getLogger(__name__)
 
+_active_streams = registry.gauge("chat_streams_active", "Chat streams currently being generated")
+_disconnects = registry.counter(
+    "chat_stream_cancellations_total",
+    "Chat streams cancelled because the client disconnected, by endpoint and the stage that was running",
+)
+
 TextExtractor = Callable[[Any], Optional[str]]
 
 # Optional: built-in extractors by provider key
@@ -26,6 +39,28 @@ def get_extractor(provider: str) -> TextExtractor:
     except KeyError:
         raise ValueError(f"Unknown provider '{provider}'. Provide a custom extractor.")
 
+async def stream_text(
+    response: AsyncIterable[Any],
+    provider: str
+) -> AsyncIterator[str]:
+    """
+    Yield the non-empty text deltas of an async LLM chunk stream.
+    The upstream stream is closed when iteration ends or is cancelled.
+    """
+    get_text = get_extractor(provider)
+    try:
+        async for chunk in response:
+            try:
+                text = get_text(chunk) or ""
+            except Exception:
+                text = ""  # ignore malformed chunks
+
+            if text:
+                yield text
+    finally:
+        await close_upstream(response)
+
+
 async def stream_content(
     response: AsyncIterable[Any],
     provider: str
@@ -34,29 +69,120 @@ async def stream_content(
     Convert an async LLM chunk stream to Server-Sent Events (SSE).
     Yields: 'data: <line>\\n' per line, blank line between events, and final [DONE].
     """
-    get_text = get_extractor(provider)
+    async with aclosing(sse_events(stream_text(response, provider))) as lines:
+        async for line in lines:
+            yield line
 
-    full_reply = ""
-    async for chunk in response:
-        try:
-            text = get_text(chunk) or ""
-        except Exception:
-            text = ""  # ignore malformed chunks
 
-        if not text: continue
+async def upstream_texts(connect: Callable[[], Awaitable[Any]], provider: str) -> AsyncIterator[str]:
+    """Open a provider stream with `connect()` and yield its text deltas (e.g. as a single-flight producer)."""
+    response = await connect()
+    async with aclosing(stream_text(response, provider)) as texts:
+        async for text in texts:
+            yield text
+
 
-        print(text, flush=True)
+async def sse_events(texts: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Format text deltas as SSE events (see stream_content); closes `texts` when done."""
+    full_reply = ""
+    async with aclosing(texts) as texts:
+        async for text in texts:
+            print(text, flush=True)
 
-        # normalize newlines
-        content = text.replace("\r\n", "\n").replace("\r", "\n")
-        if content != "":
-            for line in content.split("\n"):
-                yield f"data: {line}\n"
-            yield "\n"  # SSE event delimiter
-            full_reply += text
+            # normalize newlines
+            content = text.replace("\r\n", "\n").replace("\r", "\n")
+            if content != "":
+                for line in content.split("\n"):
+                    yield f"data: {line}\n"
+                yield "\n"  # SSE event delimiter
+                full_reply += text
 
     yield "data: [DONE]\n\n"
     print("[A] [DONE]", flush=True)
     logger.info("Streaming completed. Output length: %d", len(full_reply))
 
 
+async def close_upstream(response: Any) -> None:
+    """
+    Close a provider stream so its HTTP connection goes back to the pool
+    (OpenAI-compatible AsyncStream.close() / async generator aclose()).
+    """
+    close = getattr(response, "aclose", None) or getattr(response, "close", None)
+    if close is None:
+        return
+    try:
+        result = close()
+        if inspect.isawaitable(result):
+            await result
+    except Exception as e:
+        logger.debug("Closing upstream stream failed: %s", e)
+
+
+def _running_stage() -> str:
+    """Name of the innermost unfinished span (rag.retrieve / llm.connect / llm.stream ...)."""
+    trace = current_trace()
+    if trace is None:
+        return "unknown"
+    running = [s for s in trace.spans[1:] if not s.end_ns]
+    return running[-1].name if running else "other"
+
+
+_END = object()
+
+
+async def cancel_on_disconnect(
+    request,
+    events: AsyncIterator[Any],
+    endpoint: str,
+    poll_interval: float = STREAM_DISCONNECT_POLL_MS / 1000,
+) -> AsyncIterator[Any]:
+    """
+    Relay `events` until the client disconnects, then cancel them.
+
+    The generator runs in its own task while `request.is_disconnected()` is polled
+    concurrently, so a client that leaves during retrieval, while the provider is
+    still connecting, or between tokens is noticed within `poll_interval` instead of
+    on the next write. Cancellation is raised inside the generator at whatever it is
+    awaiting (upstream read, retrieval thread, ...), which closes the upstream stream.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+
+    async def produce():
+        try:
+            async for item in events:
+                await queue.put((item, None))
+        except Exception as e:
+            await queue.put((_END, e))
+            return
+        await queue.put((_END, None))
+
+    async def watch():
+        while not await request.is_disconnected():
+            await asyncio.sleep(poll_interval)
+
+    producer = asyncio.create_task(produce())
+    watcher = asyncio.create_task(watch())
+    _active_streams.inc(endpoint=endpoint)
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            await asyncio.wait({getter, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if watcher.done():
+                getter.cancel()
+                stage = _running_stage()
+                _disconnects.inc(endpoint=endpoint, stage=stage)
+                current_span().set(client_disconnected=True, cancelled_stage=stage)
+                logger.info("Client disconnected from %s during %s, cancelling", endpoint, stage)
+                return
+            item, error = getter.result()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        _active_streams.dec(endpoint=endpoint)
+        watcher.cancel()
+        if not producer.done():
+            producer.cancel()
+            await asyncio.wait({producer})
@@ -0,0 +1,98 @@
+"""
+ST parser benchmark
+
+在 backend/ 目錄下執行：
+    python -m benchmarks.bench_st_parser --size-mb 1 2 4 8
+
+產生多 MB 的合成 PLC 專案（多個 POU、所有 VAR 區塊種類、多行宣告、區塊註解），
+量測 tokenize / parse 的吞吐量；另外量測病態長行，確認耗時隨輸入大小線性成長。
+"""
+import argparse
+import random
+import time
+
+from app.services.st_tokenizer import parse_program, tokenize
+
+SECTION_KINDS = ["VAR", "VAR_INPUT", "VAR_OUTPUT", "VAR_IN_OUT", "VAR_TEMP", "VAR RETAIN", "VAR CONSTANT"]
+TYPES = ["BOOL", "INT", "DINT", "REAL", "TIME", "STRING(32)", "ARRAY[1..16] OF INT", "TON"]
+
+
+def _pou(idx: int, rnd: random.Random) -> str:
+    kind = rnd.choice(["PROGRAM", "FUNCTION_BLOCK"])
+    lines = [f"{kind} POU_{idx}"]
+    names = []
+    for s in range(rnd.randint(1, 4)):
+        lines.append(rnd.choice(SECTION_KINDS))
+        for v in range(rnd.randint(5, 40)):
+            name = f"v{idx}_{s}_{v}"
+            names.append(name)
+            var_type = rnd.choice(TYPES)
+            if var_type.startswith("ARRAY") and rnd.random() < 0.5:
+                lines.append(f"    {name} : {var_type} :=\n        [1, 2, 3, 4,\n         5, 6, 7, 8];")
+            elif rnd.random() < 0.3:
+                lines.append(f"    {name} AT %MW{v} : {var_type}; // address {v}")
+            else:
+                lines.append(f"    {name} : {var_type}; (* comment for {name} *)")
+        lines.append("END_VAR")
+    for _ in range(rnd.randint(10, 60)):
+        a, b = rnd.choice(names), rnd.choice(names)
+        lines.append(f"IF {a} > 10 THEN\n    {b} := {a} + 1; // update\nEND_IF;")
+    lines.append(f"END_{kind}\n")
+    return "\n".join(lines)
+
+
+def make_project(size_mb: float, seed: int = 0) -> str:
+    rnd = random.Random(seed)
+    target = int(size_mb * 1024 * 1024)
+    parts, total, idx = [], 0, 0
+    while total < target:
+        pou = _pou(idx, rnd)
+        parts.append(pou)
+        total += len(pou)
+        idx += 1
+    return "\n".join(parts)
+
+
+def _timed(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - t0
+
+
+def bench_project(size_mb: float) -> None:
+    source = make_project(size_mb)
+    mb = len(source) / (1024 * 1024)
+    n_tokens, t_tok = _timed(lambda s: sum(1 for _ in tokenize(s)), source)
+    program, t_parse = _timed(parse_program, source)
+    n_decls = sum(1 for _ in program.declarations)
+    print(
+        f"project {mb:6.2f} MB | tokens {n_tokens:>9,} | tokenize {t_tok:6.3f}s ({mb / t_tok:5.2f} MB/s)"
+        f" | parse {t_parse:6.3f}s ({mb / t_parse:5.2f} MB/s) | POUs {len(program.pous):>6,} | decls {n_decls:>8,}"
+    )
+
+
+def bench_pathological(size_mb: float) -> None:
+    n = int(size_mb * 1024 * 1024)
+    cases = {
+        "long ident list": "VAR\n" + ", ".join(f"x{i}" for i in range(n // 8)) + "\nEND_VAR",
+        "unterminated (*": "VAR\n" + "(* a " * (n // 5) + "\nEND_VAR",
+        "unterminated '": "VAR\n" + ("s : STRING := 'abc\n" * (n // 20)) + "END_VAR",
+    }
+    for name, source in cases.items():
+        _, t = _timed(parse_program, source)
+        print(f"pathological {name:<16} {len(source) / (1024 * 1024):6.2f} MB | parse {t:6.3f}s")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--size-mb", type=float, nargs="+", default=[1, 2, 4])
+    args = ap.parse_args()
+
+    for size in args.size_mb:
+        bench_project(size)
+    for size in args.size_mb:
+        bench_pathological(size)
+
+
+if __name__ == "__main__":
+    main()
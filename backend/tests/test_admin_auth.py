@@ -0,0 +1,29 @@
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from app.api import routes_admin
+
+
+def _client():
+    app = FastAPI()
+
+    @app.get("/guarded", dependencies=[Depends(routes_admin.require_admin)])
+    def guarded():
+        return "ok"
+
+    return TestClient(app)
+
+
+def test_admin_endpoints_disabled_without_token(monkeypatch):
+    monkeypatch.setattr(routes_admin, "ADMIN_TOKEN", "")
+    client = _client()
+    assert client.get("/guarded").status_code == 403
+    assert client.get("/guarded", headers={"X-Admin-Token": ""}).status_code == 403
+
+
+def test_admin_token_must_match(monkeypatch):
+    monkeypatch.setattr(routes_admin, "ADMIN_TOKEN", "secret")
+    client = _client()
+    assert client.get("/guarded").status_code == 403
+    assert client.get("/guarded", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.get("/guarded", headers={"X-Admin-Token": "secret"}).status_code == 200
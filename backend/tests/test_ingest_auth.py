@@ -0,0 +1,18 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api import routes_admin
+from app.api.routes_ingest import router
+
+
+def test_ingest_refused_without_admin_token(monkeypatch):
+    monkeypatch.setattr(routes_admin, "ADMIN_TOKEN", "")
+    app = FastAPI()
+    app.include_router(router)
+    client = TestClient(app)
+
+    upload = client.post("/api/ingest", params={"filename": "manual.pdf"}, content=b"%PDF-1.4")
+    assert upload.status_code == 403
+    assert client.post("/api/ingest/job1/retry").status_code == 403
+    assert client.get("/api/ingest").status_code == 403
+    assert client.get("/api/ingest/job1").status_code == 403
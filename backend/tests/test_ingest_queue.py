@@ -0,0 +1,68 @@
+import sqlite3
+import time
+
+from app.services.ingest_queue import JobStore
+
+
+def _stores(tmp_path, lease_seconds=60.0):
+    path = tmp_path / "jobs.sqlite3"
+    a = JobStore(path, lease_seconds=lease_seconds, owner="a")
+    b = JobStore(path, lease_seconds=lease_seconds, owner="b")
+    a.create("job1", "docs", "manual.pdf", "/tmp/manual.pdf", 1)
+    return a, b
+
+
+def test_live_lease_is_not_requeued_or_claimed(tmp_path):
+    a, b = _stores(tmp_path)
+    assert a.claim()["id"] == "job1"
+
+    # 另一個行程啟動：a 仍在處理，不放回佇列也不能領取
+    assert b.requeue_interrupted() == 0
+    assert b.claim() is None
+    assert b.get("job1")["owner"] == "a"
+
+
+def test_expired_lease_is_requeued_and_taken_over(tmp_path):
+    a, b = _stores(tmp_path, lease_seconds=0.05)
+    a.claim()
+    time.sleep(0.1)
+
+    assert b.requeue_interrupted() == 1
+    job = b.claim()
+    assert (job["id"], job["owner"], job["attempts"]) == ("job1", "b", 2)
+    # 租約過期的 a 不能覆蓋 b 的工作
+    assert not a.update("job1", status="failed", error="stale")
+    assert b.update("job1", status="done")
+    assert b.get("job1")["status"] == "done"
+
+
+def test_heartbeat_extends_lease(tmp_path):
+    a, b = _stores(tmp_path, lease_seconds=0.2)
+    a.claim()
+    for _ in range(3):
+        time.sleep(0.1)
+        assert a.heartbeat() == 1
+    assert b.claim() is None
+
+
+def test_old_database_is_migrated(tmp_path):
+    path = tmp_path / "jobs.sqlite3"
+    conn = sqlite3.connect(str(path))
+    conn.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, kb TEXT NOT NULL, filename TEXT NOT NULL, path TEXT NOT NULL, "
+        "size INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL DEFAULT 'queued', stage TEXT, "
+        "done INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0, chunks INTEGER NOT NULL DEFAULT 0, "
+        "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, "
+        "finished_at REAL)"
+    )
+    conn.execute(
+        "INSERT INTO jobs (id, kb, filename, path, status, created_at, updated_at) "
+        "VALUES ('old', 'docs', 'a.pdf', '/tmp/a.pdf', 'running', 0, 0)"
+    )
+    conn.commit()
+    conn.close()
+
+    # 舊版本留下的 running 工作沒有租約，視為已中斷
+    store = JobStore(path, owner="a")
+    assert store.requeue_interrupted() == 1
+    assert store.claim()["id"] == "old"
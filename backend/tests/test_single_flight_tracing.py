@@ -0,0 +1,76 @@
+import asyncio
+from contextlib import aclosing
+
+from app.core import tracing
+from app.core.tracing import current_trace, span, trace_root
+from app.utils.single_flight import SingleFlight
+
+
+async def _produce():
+    with span("rag.retrieve"):
+        await asyncio.sleep(0.01)
+    with span("llm.stream"):
+        for text in ("a", "b"):
+            await asyncio.sleep(0.01)
+            yield text
+
+
+async def _request(flights, name, traces):
+    with trace_root(name, force=True) as root:
+        traces[name] = (current_trace(), root)
+        return "".join([text async for text in flights.stream("k", _produce, "test")])
+
+
+def test_producer_spans_belong_to_leader_trace(monkeypatch):
+    monkeypatch.setattr(tracing.exporter, "submit", lambda trace: None)
+    flights, traces = SingleFlight("test"), {}
+
+    async def main():
+        leader = asyncio.create_task(_request(flights, "leader", traces))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(_request(flights, "follower", traces))
+        return await asyncio.gather(leader, follower)
+
+    assert asyncio.run(main()) == ["ab", "ab"]
+
+    trace, root = traces["leader"]
+    spans = {s.name: s for s in trace.spans}
+    assert {"rag.retrieve", "llm.stream", "single_flight.produce"} <= set(spans)
+    assert spans["single_flight.produce"].parent_id == root.span_id
+    assert spans["rag.retrieve"].parent_id == spans["single_flight.produce"].span_id
+    assert root.attributes["flight_role"] == "leader"
+
+    follower_trace, follower_root = traces["follower"]
+    assert [s.name for s in follower_trace.spans] == ["follower"]
+    assert follower_root.attributes["flight_trace"] == trace.trace_id
+
+
+def test_leader_leaving_early_exports_unfinished_producer_spans(monkeypatch):
+    exported = []
+    monkeypatch.setattr(tracing.exporter, "submit", exported.append)
+    flights, traces = SingleFlight("test"), {}
+
+    async def leader():
+        with trace_root("leader", force=True) as root:
+            traces["leader"] = (current_trace(), root)
+            async with aclosing(flights.stream("k", _produce, "test")) as texts:
+                async for _ in texts:
+                    break   # client disconnects after the first token
+
+    async def main():
+        first = asyncio.create_task(leader())
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(_request(flights, "follower", traces))
+        await first
+        return await follower
+
+    assert asyncio.run(main()) == "ab"
+
+    trace, root = traces["leader"]
+    assert exported[0] is trace
+    spans = {s.name: s for s in trace.spans}
+    for name in ("single_flight.produce", "llm.stream"):
+        assert spans[name].status == "unfinished"
+        assert spans[name].end_ns == root.end_ns
+    assert spans["rag.retrieve"].status == "ok"
+    assert root.attributes["unfinished_spans"] == 2
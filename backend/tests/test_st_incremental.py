@@ -0,0 +1,50 @@
+from app.services.st_incremental import IncrementalParser
+
+from .test_st_xref import TWO_FBS
+
+# 兩個 FB 的 METHOD Init 都宣告區域變數 tmp
+SAME_LOCALS = """
+FUNCTION_BLOCK FB_A
+METHOD Init : BOOL
+VAR
+    tmp : INT;
+END_VAR
+tmp := 1;
+END_METHOD
+END_FUNCTION_BLOCK
+
+FUNCTION_BLOCK FB_B
+METHOD Init : BOOL
+VAR
+    tmp : DINT;
+END_VAR
+tmp := 2;
+END_METHOD
+END_FUNCTION_BLOCK
+"""
+
+
+def test_same_named_methods_in_one_region_do_not_collide():
+    parser = IncrementalParser()
+    parser.update("doc", 1, code=SAME_LOCALS)
+    # 同一次修改涵蓋兩個 FB，兩個 Init 在同一個重新解析的範圍內
+    code = SAME_LOCALS.replace("tmp := 1;", "tmp := 3;").replace("tmp := 2;", "tmp := 4;")
+    delta = parser.update("doc", 2, code=code)
+
+    assert not delta.full_reparse
+    assert delta.reparsed_pous == ["FB_A", "FB_A.Init", "FB_B", "FB_B.Init"]
+    assert delta.added == delta.removed == delta.changed == []
+
+    delta = parser.update("doc", 3, code=SAME_LOCALS.replace("tmp : DINT;", "tmp : LINT;"))
+    assert [(d.qualified_pou, d.var_type) for d in delta.changed] == [("FB_B.Init", "LINT")]
+    assert delta.added == delta.removed == []
+
+
+def test_edit_inside_second_fb_reparses_only_that_fb():
+    parser = IncrementalParser()
+    parser.update("doc", 1, code=TWO_FBS)
+    delta = parser.update("doc", 2, code=TWO_FBS.replace("x := 5;", "x := 6;"))
+
+    assert not delta.full_reparse
+    assert delta.reparsed_pous == ["FB_B", "FB_B.Init"]
+    assert delta.added == delta.removed == delta.changed == []
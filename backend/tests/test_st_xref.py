@@ -0,0 +1,67 @@
+from app.services.st_tokenizer import parse_program
+from app.services.st_xref import READ, WRITE, SymbolIndex
+
+# 兩個 FB 各有同名的 METHOD Init；FB_B.Init 沒有自己的 x，x 應解析到 FB_B 的成員
+TWO_FBS = """
+FUNCTION_BLOCK FB_A
+VAR
+    a : INT;
+END_VAR
+a := 1;
+METHOD Init : BOOL
+VAR
+    x : INT;
+END_VAR
+x := a;
+END_METHOD
+a := a + 2;
+END_FUNCTION_BLOCK
+
+FUNCTION_BLOCK FB_B
+VAR
+    x : DINT;
+END_VAR
+METHOD Init : BOOL
+x := 5;
+END_METHOD
+x := x + 1;
+END_FUNCTION_BLOCK
+"""
+
+
+def _refs(symbol):
+    return [(r.pou, r.kind) for r in sorted(symbol.references, key=lambda r: r.start)]
+
+
+def _index():
+    index = SymbolIndex()
+    index.add_program("prog", parse_program(TWO_FBS))
+    return index
+
+
+def test_same_named_methods_have_separate_scopes():
+    index = _index()
+    (a_local,) = index.lookup("x", pou="FB_A.Init")
+    (b_member,) = index.lookup("x", pou="FB_B")
+
+    assert a_local.decl.qualified_pou == "FB_A.Init"
+    assert _refs(a_local) == [("FB_A.Init", WRITE)]
+    # FB_B.Init 的 x 與 FB_B 本體（END_METHOD 之後）的 x 都指向 FB_B 的成員
+    assert _refs(b_member) == [
+        ("FB_B.Init", WRITE), ("FB_B", WRITE), ("FB_B", READ),
+    ]
+
+
+def test_lookup_by_bare_method_name_matches_all():
+    index = _index()
+    assert {s.decl.qualified_pou for s in index.lookup("x", pou="Init")} == {"FB_A.Init"}
+    assert {s.decl.qualified_pou for s in index.lookup("x")} == {"FB_A.Init", "FB_B"}
+
+
+def test_body_after_nested_method_is_scanned():
+    index = _index()
+    (a,) = index.lookup("a", pou="FB_A")
+    assert _refs(a) == [
+        ("FB_A", WRITE), ("FB_A.Init", READ), ("FB_A", WRITE), ("FB_A", READ),
+    ]
+    assert "a := a + 2;" in parse_program(TWO_FBS).logic_code()
@@ -19,9 +19,20 @@ import ChatBox from './ChatBox';
 import InputBar from './InputBar';
 
 import { generateId } from 'utils/generateId';
+import { chatSocket } from 'utils/chatSocket';
+import { useSetting } from '../settings/context';
 
 const APPBAR_HEIGHT = 64;
 const MAX_CHAT_WIDTH = 768;
+const PREFETCH_DEBOUNCE_MS = 250;
+
+// model id -> provider name on the /ws/chat socket
+const SOCKET_PROVIDERS = {
+    gemini: 'gemini',
+    geminiNative: 'gemini_native',
+    dms: 'dms',
+    openrouter: 'openrouter'
+};
 
 export default function ChatLayout({
     title = 'LLM Chat',
@@ -44,6 +55,32 @@ export default function ChatLayout({
     ]);
     const [isStreaming, setIsStreaming] = React.useState(false);
     const eventSourceRef = React.useRef(null);
+    const socketStreamRef = React.useRef(null);
+    const [transport] = useSetting('transport');
+
+    // Retrieval prefetch: 輸入時先讓後端檢索，送出時以同一個 id 沿用結果
+    const prefetchIdRef = React.useRef(generateId());
+    const prefetchTimerRef = React.useRef(null);
+
+    const handleDraftChange = React.useCallback(
+        (text) => {
+            clearTimeout(prefetchTimerRef.current);
+            const draft = text.trim();
+            if (model !== 'gemini' || draft.length < 4) return;
+            prefetchTimerRef.current = setTimeout(() => {
+                const params = new URLSearchParams({
+                    prefetch_id: prefetchIdRef.current,
+                    question: draft
+                });
+                fetch(`/api/prefetch?${params}`, { method: 'POST' }).catch(
+                    () => {} // best effort：失敗時送出會照常檢索
+                );
+            }, PREFETCH_DEBOUNCE_MS);
+        },
+        [model]
+    );
+
+    React.useEffect(() => () => clearTimeout(prefetchTimerRef.current), []);
 
     const endpointFor = React.useCallback((mode) => {
         switch (mode) {
@@ -87,69 +124,117 @@ export default function ChatLayout({
                 }
             ]);
 
-            // 3) open SSE
-            const endpoint = endpointFor(model);
-            const url = `/api${endpoint}?question=${encodeURIComponent(
-                userQuestion
-            )}`;
+            // 3) stream the reply: multiplexed WebSocket when enabled, otherwise SSE
+            let prefetchId = null;
+            if (model === 'gemini') {
+                clearTimeout(prefetchTimerRef.current);
+                prefetchId = prefetchIdRef.current;
+                prefetchIdRef.current = generateId();
+            }
 
-            const es = new EventSource(url);
-            eventSourceRef.current = es;
-
-            let accumulatedText = '';
-            let isFirstChunk = true;
+            const updateLast = (patch) =>
+                setMessages((prev) => {
+                    const copy = [...prev];
+                    const last = copy.length - 1;
+                    copy[last] = { ...copy[last], ...patch };
+                    return copy;
+                });
 
-            es.onmessage = (event) => {
-                if (event.data === '[DONE]') {
-                    es.close();
-                    setIsStreaming(false);
-                    return;
+            const openSse = () => {
+                const endpoint = endpointFor(model);
+                let url = `/api${endpoint}?question=${encodeURIComponent(
+                    userQuestion
+                )}`;
+                if (prefetchId) {
+                    url += `&prefetch_id=${encodeURIComponent(prefetchId)}`;
                 }
 
-                if (event.data?.startsWith?.('[錯誤]')) {
-                    setMessages((prev) => {
-                        const copy = [...prev];
-                        const last = copy.length - 1;
-                        copy[last] = {
-                            ...copy[last],
-                            content: `[連線錯誤] ${event.data}`
-                        };
-                        return copy;
-                    });
-                    es.close();
-                    setIsStreaming(false);
-                    return;
-                }
+                const es = new EventSource(url);
+                eventSourceRef.current = es;
 
-                if (isFirstChunk) {
-                    accumulatedText = '';
-                    isFirstChunk = false;
-                }
-                if (event.data) {
-                    accumulatedText += event.data;
-                    setMessages((prev) => {
-                        const copy = [...prev];
-                        const last = copy.length - 1;
-                        copy[last] = {
-                            ...copy[last],
+                let accumulatedText = '';
+                let isFirstChunk = true;
+
+                es.onmessage = (event) => {
+                    if (event.data === '[DONE]') {
+                        es.close();
+                        setIsStreaming(false);
+                        return;
+                    }
+
+                    if (event.data?.startsWith?.('[錯誤]')) {
+                        updateLast({ content: `[連線錯誤] ${event.data}` });
+                        es.close();
+                        setIsStreaming(false);
+                        return;
+                    }
+
+                    if (isFirstChunk) {
+                        accumulatedText = '';
+                        isFirstChunk = false;
+                    }
+                    if (event.data) {
+                        accumulatedText += event.data;
+                        updateLast({
                             content: accumulatedText,
                             timestamp: Date.now()
-                        };
-                        return copy;
-                    });
-                }
-            };
+                        });
+                    }
+                };
 
-            es.onerror = (err) => {
-                console.error('EventSource error:', err);
-                es.close();
-                setIsStreaming(false);
+                es.onerror = (err) => {
+                    console.error('EventSource error:', err);
+                    es.close();
+                    setIsStreaming(false);
+                };
             };
+
+            const provider = SOCKET_PROVIDERS[model];
+            if (transport !== 'websocket' || !provider) {
+                openSse();
+                return;
+            }
+
+            let accumulatedText = '';
+            chatSocket
+                .openStream({
+                    provider,
+                    question: userQuestion,
+                    ...(prefetchId && { prefetch_id: prefetchId }),
+                    onDelta: (delta) => {
+                        accumulatedText += delta;
+                        updateLast({
+                            content: accumulatedText,
+                            timestamp: Date.now()
+                        });
+                    },
+                    onEnd: () => {
+                        socketStreamRef.current = null;
+                        setIsStreaming(false);
+                    },
+                    onError: (message) => {
+                        updateLast({ content: `[連線錯誤] ${message}` });
+                        socketStreamRef.current = null;
+                        setIsStreaming(false);
+                    }
+                })
+                .then((stream) => {
+                    socketStreamRef.current = stream;
+                })
+                .catch((err) => {
+                    console.warn('WebSocket unavailable, falling back to SSE:', err);
+                    openSse();
+                });
         },
-        [endpointFor, isStreaming, model]
+        [endpointFor, isStreaming, model, transport]
     );
 
     const handleStop = React.useCallback(() => {
+        if (socketStreamRef.current) {
+            socketStreamRef.current.cancel();
+            socketStreamRef.current = null;
+            setIsStreaming(false);
+        }
         if (eventSourceRef.current) {
             eventSourceRef.current.close();
             eventSourceRef.current = null;
@@ -239,6 +324,7 @@ export default function ChatLayout({
                         isStreaming={isStreaming}
                         onSend={handleSend}
                         onStop={handleStop}
+                        onDraftChange={handleDraftChange}
                         maxWidth={MAX_CHAT_WIDTH}
                     />
                 </Stack>
@@ -10,6 +10,7 @@ import HybridTextField from '../components/HybridTextField';
 export default function InputBar({
     onSend,
     onStop,
+    onDraftChange,
     isStreaming,
     disabled,
     maxWidth = 768
@@ -60,7 +61,10 @@ export default function InputBar({
                 fullWidth
                 placeholder={isStreaming ? 'Receiving…' : 'Type your message'}
                 value={value}
-                onChange={(e) => setValue(e.target.value)}
+                onChange={(e) => {
+                    setValue(e.target.value);
+                    onDraftChange?.(e.target.value);
+                }}
                 onKeyDown={onKeyDown}
                 disabled={disabled}
                 minRows={1}
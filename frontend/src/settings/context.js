@@ -9,15 +9,15 @@ import React, {
 import { registry, STORAGE_KEY } from './registry';
 
 function loadInitialState() {
-    try {
-        const raw = localStorage.getItem(STORAGE_KEY);
-        if (raw) return JSON.parse(raw);
-    } catch {}
-    // Fill defaults from registry
+    // Fill defaults from registry (also covers settings added after the state was saved)
     const init = {};
     for (const [key, def] of Object.entries(registry)) {
         init[key] = def.default;
     }
+    try {
+        const raw = localStorage.getItem(STORAGE_KEY);
+        if (raw) return { ...init, ...JSON.parse(raw) };
+    } catch {}
     return init;
 }
 
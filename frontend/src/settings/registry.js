@@ -16,6 +16,18 @@ export const registry = {
             { value: 'dark', label: 'Dark' },
             { value: 'system', label: 'System' }
         ]
+    },
+
+    transport: {
+        label: 'Streaming connection',
+        group: 'Chat',
+
+        type: 'radio',
+        default: 'websocket',
+        options: [
+            { value: 'websocket', label: 'WebSocket (shared)' },
+            { value: 'sse', label: 'SSE (per message)' }
+        ]
     }
 
     // compactUI: {
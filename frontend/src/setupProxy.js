@@ -15,7 +15,8 @@ module.exports = function (app) {
             '/api/gemini_native_stream',
             '/api/gemini_stream',
             '/api/openrouter_stream',
-            '/api/dms_stream'
+            '/api/dms_stream',
+            '/api/prefetch'
         ],
         createProxyMiddleware({
             target: TARGET_URL,
@@ -36,6 +37,17 @@ module.exports = function (app) {
         })
     );
 
+    // ①-b WebSocket（多工 chat）：/api/ws/chat -> /ws/chat
+    app.use(
+        '/api/ws',
+        createProxyMiddleware({
+            target: TARGET_URL,
+            changeOrigin: true,
+            ws: true,
+            pathRewrite: { '^/api': '' }
+        })
+    );
+
     // ② 這組：其餘 /api/*（後端本來就有 /api 前綴）→ 原封不動轉
     app.use(
         '/api',
@@ -0,0 +1,95 @@
+// ============================
+// src/utils/chatSocket.js
+// ============================
+// Multiplexed chat streams over one WebSocket (backend: /ws/chat).
+// Frames are JSON arrays; see backend/app/api/routes_ws.py for the protocol.
+import { generateId } from './generateId';
+
+const WINDOW = 65536; // chars the server may send before waiting for credit
+const CREDIT_STEP = WINDOW / 2; // return credit once this many chars are consumed
+
+function socketUrl() {
+    const scheme = window.location.protocol === 'https:' ? 'wss' : 'ws';
+    return `${scheme}://${window.location.host}/api/ws/chat`;
+}
+
+class ChatSocket {
+    constructor(url) {
+        this.url = url;
+        this.ws = null;
+        this.ready = null;
+        this.streams = new Map();
+    }
+
+    connect() {
+        if (this.ready) return this.ready;
+        this.ready = new Promise((resolve, reject) => {
+            const ws = new WebSocket(this.url);
+            ws.onopen = () => {
+                this.ws = ws;
+                resolve(ws);
+            };
+            ws.onerror = (err) => reject(err);
+            ws.onclose = () => {
+                this.ws = null;
+                this.ready = null;
+                for (const stream of this.streams.values()) {
+                    stream.onError?.('WebSocket 連線中斷');
+                }
+                this.streams.clear();
+                reject(new Error('WebSocket closed'));
+            };
+            ws.onmessage = (event) => this.dispatch(JSON.parse(event.data));
+        });
+        return this.ready;
+    }
+
+    send(frame) {
+        if (this.ws?.readyState === WebSocket.OPEN) {
+            this.ws.send(JSON.stringify(frame));
+        }
+    }
+
+    dispatch(events) {
+        for (const [type, id, payload] of events) {
+            const stream = this.streams.get(id);
+            if (!stream) continue;
+            if (type === 'd') {
+                stream.onDelta?.(payload);
+                stream.consumed += payload.length;
+                if (stream.consumed >= CREDIT_STEP) {
+                    this.send(['credit', id, stream.consumed]);
+                    stream.consumed = 0;
+                }
+            } else if (type === 'e') {
+                this.streams.delete(id);
+                stream.onEnd?.(payload === 'cancelled');
+            } else if (type === 'x') {
+                this.streams.delete(id);
+                stream.onError?.(payload);
+            }
+        }
+    }
+
+    /**
+     * Start a chat stream. Resolves with { cancel } once the request is sent;
+     * rejects if the socket cannot be opened (callers may fall back to SSE).
+     */
+    async openStream({ provider, question, onDelta, onEnd, onError, ...options }) {
+        await this.connect();
+        const id = generateId();
+        this.streams.set(id, { onDelta, onEnd, onError, consumed: 0 });
+        this.send([
+            'start',
+            id,
+            { provider, q: question, window: WINDOW, ...options }
+        ]);
+        return {
+            cancel: () => {
+                if (this.streams.delete(id)) this.send(['cancel', id]);
+            }
+        };
+    }
+}
+
+export const chatSocket = new ChatSocket(socketUrl());